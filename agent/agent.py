@@ -10,6 +10,7 @@ import hashlib
 import platform
 import multiprocessing
 import shutil
+import httplib
 
 import ConfigParser as configparser
 
@@ -24,6 +25,7 @@ import logger
 
 from util import version, str2bool
 
+import chunker
 import http
 from http import HTTPRequest, HTTPResponse, HTTPBadRequest
 
@@ -40,6 +42,11 @@ class AgentHandler(SimpleHTTPRequestHandler):
 
     get_status_count = 0
 
+    # path -> (size, mtime, sha256 hexdigest)
+    sha256_cache = {}
+
+    chunk_jobs = chunker.ChunkJobs()
+
     # Override BaseHTTPRequestHandler call to socket.getfqdn
     # AgentHandler inherits from SimpleHTTPRequestHandler, which
     # inherits from BaseHTTPRequestHandler which calls socket.getfqdn
@@ -103,6 +110,14 @@ class AgentHandler(SimpleHTTPRequestHandler):
                 xid = int(req.query['xid'][0])
             except (ValueError, KeyError, TypeError):
                 raise http.HTTPBadRequest()
+            if 'wait' in req.query:
+                # long-poll: reply when the command finishes or
+                # after 'wait' seconds, whichever is first.
+                try:
+                    wait = float(req.query['wait'][0])
+                except ValueError:
+                    raise http.HTTPBadRequest()
+                self.server.processmanager.wait(xid, wait)
             data = self.server.processmanager.getinfo(xid)
         else:
             raise http.HTTPBadRequest()
@@ -160,37 +175,106 @@ class AgentHandler(SimpleHTTPRequestHandler):
             }
         return d
 
+    def get_range(self, req, size):
+        """Returns (offset, end) from a 'bytes=N-' or 'bytes=N-M' header,
+        end being exclusive, or None for the whole file."""
+        value = req.handler.headers.get('range', '')
+        if not value.startswith('bytes='):
+            return None
+        try:
+            first, last = value[len('bytes='):].split('-', 1)
+            offset = int(first)
+            if last:
+                end = min(int(last) + 1, size)
+            else:
+                end = size
+        except ValueError:
+            return None
+        if offset >= end:
+            return None
+        return (offset, end)
+
     def handle_file_GET(self, req):
         path = self.get_path_from_query(req)
         if not os.path.isfile(path):
             raise HTTPNotFound(path)
         res = req.response
         # FIXME: catch IOError, OSError
-        res.setfile(open(path, 'r'))
-        res.set_content_length()
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        offset, end = 0, size
+        byte_range = self.get_range(req, size)
+        if byte_range:
+            offset, end = byte_range
+            f.seek(offset)
+            res.status_code = httplib.PARTIAL_CONTENT
+            res.content_range = 'bytes %d-%d/%d' % (offset, end - 1, size)
+        res.setfile(f)
+        res.content_length = end - offset
         return res
 
+    def get_put_offset(self, req):
+        # 'Content-Range: bytes N-M/*' writes the body at offset N of an
+        # existing file instead of replacing the file.
+        value = req.handler.headers.get('content-range', '')
+        if not value.startswith('bytes '):
+            return None
+        try:
+            return int(value[len('bytes '):].split('-', 1)[0])
+        except ValueError:
+            raise HTTPBadRequest("Invalid Content-Range: " + value)
+
     def handle_file_PUT(self, req):
         path = self.get_path_from_query(req)
-	self.server.log.info("handle_file_POST: %s", path)
-        # FIXME: catch IOError, OSError
-        with open(path, 'w') as f:
-            if req.content_length:
-#                FYI: this hangs:
-#                shutil.copyfileobj(req.rfile, f, req.content_length)
-                # fixme: check to make sure all was read?
-                data = req.rfile.read(req.content_length)
-                f.write(data)
+        self.server.log.info("handle_file_PUT: %s", path)
+        offset = self.get_put_offset(req)
+        if offset is None or not os.path.isfile(path):
+            mode = 'wb'
+        else:
+            mode = 'r+b'
+        try:
+            with open(path, mode) as f:
+                if offset:
+                    f.seek(offset)
+                remaining = req.content_length
+                if remaining:
+                    rfile = req.rfile
+                    while remaining > 0:
+                        data = rfile.read(min(remaining, http.CHUNK_SIZE))
+                        if not data:
+                            raise HTTPBadRequest("short PUT body")
+                        f.write(data)
+                        remaining -= len(data)
+        except (IOError, OSError), e:
+            return {'status': 'FAILED', 'error': str(e)}
         return req.response
 
     def handle_file_DELETE(self, req):
         path = self.get_path_from_query(req)
-        # FIXME: test for OSError
-        os.remove(path)
-        return req.response
-
-    def compute_sha256(self, data):
-        return hashlib.sha256(data).hexdigest()
+        try:
+            os.remove(path)
+        except OSError, e:
+            return {'status': 'FAILED', 'error': str(e)}
+        return {'status': 'OK'}
+
+    def compute_sha256(self, path):
+        """Hash the file in blocks.  The result is cached by
+        (path, size, mtime) so unchanged files are not hashed again."""
+        st = os.stat(path)
+        cached = self.sha256_cache.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(http.CHUNK_SIZE)
+                if not data:
+                    break
+                sha.update(data)
+        h = sha.hexdigest()
+        AgentHandler.sha256_cache[path] = (st.st_size, st.st_mtime, h)
+        return h
 
     def handle_sha256(self, req):
         path = self.get_required_json_parameter(req, 'path')
@@ -200,14 +284,79 @@ class AgentHandler(SimpleHTTPRequestHandler):
             d['error'] = 'File does not exist: ' + path
             return d
 
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        h = self.compute_sha256(data)
+        h = self.compute_sha256(path)
         d['status'] = 'OK'
         d['hash'] = h
         return d
 
+    def handle_manifest(self, req):
+        """Hash a list of files ('paths') or the files under a directory
+        ('path').  Files that can't be read are reported in 'errors'."""
+        if 'paths' in req.json:
+            paths = req.json['paths']
+        else:
+            top = self.get_required_json_parameter(req, 'path')
+            if not os.path.isdir(top):
+                return {'status': 'FAILED',
+                        'error': "Not a valid directory: '" + top + "'"}
+            paths = []
+            for dirpath, _, filenames in os.walk(top):
+                for name in filenames:
+                    paths.append(os.path.join(dirpath, name))
+
+        files = {}
+        errors = {}
+        for path in paths:
+            try:
+                files[path] = {'hash': self.compute_sha256(path),
+                               'size': os.path.getsize(path)}
+            except (IOError, OSError), e:
+                errors[path] = str(e)
+        d = {'status': 'OK', 'files': files}
+        if errors:
+            d['errors'] = errors
+        return d
+
+    def handle_checksums(self, req):
+        """MD5 of byte ranges ('ranges' is a list of [offset, length]) of
+        a file, used to check parts of a file uploaded while it was still
+        being written.  Missing or short ranges are reported as None."""
+        path = self.get_required_json_parameter(req, 'path')
+        ranges = self.get_required_json_parameter(req, 'ranges')
+        if not os.path.isfile(path):
+            return {'status': 'FAILED',
+                    'error': 'File does not exist: ' + path}
+
+        checksums = []
+        with open(path, 'rb') as f:
+            for offset, length in ranges:
+                f.seek(offset)
+                md5 = hashlib.md5()
+                remaining = length
+                while remaining > 0:
+                    data = f.read(min(remaining, http.CHUNK_SIZE))
+                    if not data:
+                        break
+                    md5.update(data)
+                    remaining -= len(data)
+                if remaining:
+                    checksums.append(None)
+                else:
+                    checksums.append(md5.hexdigest())
+        return {'status': 'OK', 'size': os.path.getsize(path),
+                'checksums': checksums}
+
+    def handle_chunks(self, req):
+        """Split a file into content-defined chunks (see chunker.py).
+        The first request starts the job and returns RUNNING, the ones
+        after that return RUNNING until the result is ready."""
+        path = self.get_required_json_parameter(req, 'path')
+        if not os.path.isfile(path):
+            return {'status': 'FAILED',
+                    'error': 'File does not exist: ' + path}
+        avg_size = int(req.json.get('avg-size', chunker.CHUNK_AVG_SIZE))
+        return self.chunk_jobs.run(path, avg_size, self.server.log)
+
     def handle_move(self, req):
         src = self.get_required_json_parameter(req, 'source')
         dst = self.get_required_json_parameter(req, 'destination')
@@ -267,6 +416,12 @@ class AgentHandler(SimpleHTTPRequestHandler):
 	self.server.log.info("handle_file_POST: %s", action)
         if action == 'SHA256':
             return self.handle_sha256(req)
+        if action == 'MANIFEST':
+            return self.handle_manifest(req)
+        if action == 'CHUNKS':
+            return self.handle_chunks(req)
+        if action == 'CHECKSUMS':
+            return self.handle_checksums(req)
         if action == 'MOVE':
             return self.handle_move(req)
         if action == 'LISTDIR':
@@ -335,12 +490,10 @@ class AgentHandler(SimpleHTTPRequestHandler):
         return self.handle_method('POST')
 
     def do_DELETE(self):
-        return {'status': "OK"}
-	# return self.handle_method('DELETE')
+        return self.handle_method('DELETE')
 
     def do_PUT(self):
-        return {'status': "OK"}
-        # return self.handle_method('PUT')
+        return self.handle_method('PUT')
 
 class Agent(TCPServer):
 
@@ -0,0 +1,102 @@
+""" Content-defined chunking of files for the controller's dedup store. """
+import hashlib
+import os
+import threading
+
+# Average content-defined chunk size
+CHUNK_AVG_SIZE = 1024 * 1024
+
+# A boundary can only follow this byte pair, which str.find() locates at
+# C speed.  In compressed data (most of a backup) it occurs about every
+# 64KB.  Like WINDOW and the hash below, it must never change: the chunk
+# boundaries of stored backups depend on it.
+MARKER = '\x9e\x37'
+MARKER_SPACING = 1 << 16
+# The bytes before a candidate that decide whether it is a boundary.
+WINDOW = 48
+
+def is_boundary(data, pos, ratio):
+    """Whether the marker at 'pos' is a boundary: about one in 'ratio'
+    candidates is, depending only on the bytes around it."""
+    window = data[pos - WINDOW:pos + len(MARKER)]
+    return int(hashlib.md5(window).hexdigest()[:8], 16) % ratio == 0
+
+def split(path, avg_size=CHUNK_AVG_SIZE):
+    """Split a file into content-defined chunks.  Returns the size, the
+    sha256 of the whole file and the [offset, length, sha256] of each
+    chunk.  As a boundary only depends on the bytes just before it,
+    an insertion or deletion only changes the chunks around it."""
+    min_size = max(avg_size // 4, WINDOW)
+    max_size = avg_size * 4
+    ratio = max((avg_size - min_size) // MARKER_SPACING, 1)
+
+    chunks = []
+    offset = 0
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        buf = ''
+        eof = False
+        while True:
+            if not eof and len(buf) < max_size:
+                data = f.read(max_size - len(buf))
+                if data:
+                    buf += data
+                    continue
+                eof = True
+            if not buf:
+                break
+            # Without a boundary, the chunk ends at max_size (or EOF).
+            cut = len(buf)
+            pos = buf.find(MARKER, min_size)
+            while pos >= 0 and pos + len(MARKER) < len(buf):
+                if is_boundary(buf, pos, ratio):
+                    cut = pos + len(MARKER)
+                    break
+                pos = buf.find(MARKER, pos + 1)
+            chunk = buf[:cut]
+            sha.update(chunk)
+            chunks.append([offset, cut, hashlib.sha256(chunk).hexdigest()])
+            offset += cut
+            buf = buf[cut:]
+    return offset, sha.hexdigest(), chunks
+
+class ChunkJobs(object):
+    """Runs split() in the background so a large file doesn't hold the
+    connection to the controller: the controller repeats the request
+    until the result is ready."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (path, avg_size) -> [(size, mtime), result or None]
+        self.jobs = {}
+
+    def run(self, path, avg_size, log):
+        key = (path, avg_size)
+        st = os.stat(path)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and job[1] is not None:
+                del self.jobs[key]
+                if job[0] == (st.st_size, st.st_mtime):
+                    return job[1]
+                # The file changed since, e.g. a result nobody collected.
+                job = None
+            if job is None:
+                job = [(st.st_size, st.st_mtime), None]
+                self.jobs[key] = job
+                thread = threading.Thread(target=self._split,
+                                          args=(job, path, avg_size, log))
+                thread.daemon = True
+                thread.start()
+        return {'status': 'RUNNING'}
+
+    def _split(self, job, path, avg_size, log):
+        try:
+            size, digest, chunks = split(path, avg_size)
+            result = {'status': 'OK', 'size': size, 'sha256': digest,
+                      'chunks': chunks}
+        except (IOError, OSError), e:
+            result = {'status': 'FAILED', 'error': str(e)}
+        log.info("chunks: '%s' done: %s", path, result['status'])
+        with self.lock:
+            job[1] = result
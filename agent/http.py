@@ -2,10 +2,12 @@ import os
 import httplib
 import urlparse
 import json
-import shutil
 
 from cStringIO import StringIO
 
+# Size of the blocks used to read and send file bodies.
+CHUNK_SIZE = 1024 * 1024
+
 class HTTPRequest(object):
 
     def __init__(self, handler, method):
@@ -68,6 +70,7 @@ class HTTPResponse(object):
         self.status_code = 200
         self.content_type = 'text/plain'
         self.content_length = -1
+        self.content_range = None
         self.wfile = StringIO()
 
     def __getattr__(self, name):
@@ -80,7 +83,7 @@ class HTTPResponse(object):
         self.wfile = wfile
 
     def set_content_length(self):
-        info = os.fstat(self.wfile)
+        info = os.fstat(self.wfile.fileno())
         self.content_length = info.st_size
 
     def flush(self):
@@ -92,12 +95,27 @@ class HTTPResponse(object):
             self.content_length = len(body)
 
         self.handler.send_header('Content-Length', self.content_length)
+        if self.content_range:
+            self.handler.send_header('Content-Range', self.content_range)
         self.handler.end_headers()
         if not body is None:
             self.handler.wfile.write(body)
         else:
-            shutil.copyfileobj(self.wfile, self.handler.wfile,
-                               self.content_length)
+            # Send exactly content_length bytes: a (Range) response covers
+            # only part of the file and the file may still be growing.
+            remaining = self.content_length
+            while remaining > 0:
+                data = self.wfile.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    break
+                self.handler.wfile.write(data)
+                remaining -= len(data)
+            if remaining > 0:
+                # The file was truncated: the client would wait for the
+                # missing bytes, so the connection can't be reused.
+                self.wfile.close()
+                self.handler.close_connection = 1
+                return
         self.wfile.close()
         self.handler.close_connection = 0
         
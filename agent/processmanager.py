@@ -2,6 +2,7 @@ import os
 import shutil
 import subprocess
 import copy
+import threading
 
 class ProcessManager(object):
 
@@ -14,6 +15,8 @@ class ProcessManager(object):
             else:
                 val = pathenv
             os.environ['PATH'] = val
+        # xid -> threading.Event, set when the process exits.
+        self.done_events = {}
 
     def start(self, xid, cmd, env={}, immediate=False):
         dirpath = os.path.join(self.xid_dir, str(xid))
@@ -35,8 +38,20 @@ class ProcessManager(object):
 
         if immediate:
             p.wait()
+            return
+
+        # Watch the process so wait() can return as soon as it exits.
+        event = threading.Event()
+        self.done_events[xid] = event
+        def watch():
+            p.wait()
+            event.set()
+        t = threading.Thread(target=watch)
+        t.daemon = True
+        t.start()
         
     def cleanup(self, xid):
+        self.done_events.pop(xid, None)
         dirpath = os.path.join(self.xid_dir, str(xid))
         shutil.rmtree(dirpath)
 
@@ -60,6 +75,12 @@ class ProcessManager(object):
             d['run-status'] = 'running';
         return d;
 
+    def wait(self, xid, timeout):
+        """Wait up to 'timeout' seconds for the command to finish."""
+        event = self.done_events.get(xid)
+        if event is not None:
+            event.wait(timeout)
+
     def isdone(self, xid):
         dirpath = os.path.join(self.xid_dir, str(xid))
         if not os.path.isdir(dirpath):
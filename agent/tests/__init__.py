@@ -0,0 +1 @@
+from test_chunker import ChunkerTest
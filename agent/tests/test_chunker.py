@@ -0,0 +1,60 @@
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+
+import chunker
+
+class ChunkerTest(unittest.TestCase):
+
+    AVG_SIZE = 256 * 1024
+
+    def setUp(self):
+        size = 8 * 1024 * 1024
+        bits = random.Random(25).getrandbits(size * 8)
+        self.data = ('%0*x' % (size * 2, bits)).decode('hex')
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+
+    def split(self, data):
+        fd, path = tempfile.mkstemp()
+        self.paths.append(path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return chunker.split(path, self.AVG_SIZE)
+
+    def test_split(self):
+        size, digest, chunks = self.split(self.data)
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+
+        offset = 0
+        for chunk_offset, length, chunk_digest in chunks:
+            self.assertEqual(chunk_offset, offset)
+            self.assertTrue(length <= self.AVG_SIZE * 4)
+            data = self.data[offset:offset + length]
+            self.assertEqual(chunk_digest, hashlib.sha256(data).hexdigest())
+            offset += length
+        self.assertEqual(offset, size)
+        # Content-defined boundaries, not just max_size cuts.
+        self.assertTrue(len(chunks) > size // (self.AVG_SIZE * 4))
+
+    def test_boundaries_after_insert(self):
+        _, _, chunks = self.split(self.data)
+        pos = len(self.data) // 2
+        data = self.data[:pos] + 'inserted' + self.data[pos:]
+        _, _, new_chunks = self.split(data)
+
+        old = set(c[2] for c in chunks)
+        new = set(c[2] for c in new_chunks)
+        # Only the chunk with the insertion (or the ones around it) differ.
+        self.assertTrue(len(new - old) <= 2)
+        self.assertTrue(len(old - new) <= 2)
+
+    def test_empty(self):
+        self.assertEqual(self.split(''),
+                         (0, hashlib.sha256('').hexdigest(), []))
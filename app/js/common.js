@@ -20,6 +20,7 @@ function ($, topic, status, paging, Dropdown)
      */
     var eventFilter = {
         seq: 0,
+        etag: null, /* version of the last monitor data received */
         ref: null, /* timestamp as an epoch float, microsecond resolution */
         selectors: {'status':'0', 'type':'0'},
         /* currently displayed list */
@@ -32,6 +33,9 @@ function ($, topic, status, paging, Dropdown)
             var array = [];
 
             array.push('seq=' + ++this.seq);
+            if (this.etag != null) {
+                array.push('etag=' + this.etag);
+            }
 
             if (!needEvents) {
                 array.push('event=false');
@@ -290,6 +294,13 @@ function ($, topic, status, paging, Dropdown)
         }
         delete data['interval'];
 
+        /* The server only sends 'unchanged' if we have its current data. */
+        eventFilter.etag = data['etag'] != null ? data['etag'] : null;
+        delete data['etag'];
+        if (data['unchanged']) {
+            return true;
+        }
+
         var json = JSON.stringify(data);
         
         /*
@@ -427,6 +438,7 @@ function ($, topic, status, paging, Dropdown)
             clearTimeout(timer);
         }
         eventFilter.seq = 0;
+        eventFilter.etag = null;
         poll();
     }
 
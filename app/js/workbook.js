@@ -32,6 +32,33 @@ function ($, common, paging, Dropdown, EditBox)
         return '?' + array.join('&');
     }
 
+    /*
+     * renderUpdates(id, data)
+     * Render the revisions of one workbook.  Only the newest are sent
+     * with the list; the 'more' link requests all of them.
+     */
+    function renderUpdates(id, data) {
+        var selector = '#updates-' + id;
+        $(selector).render('workbook-updates-template', {
+            'id': id,
+            'updates': data['updates'],
+            'update-count': data['update-count'],
+            'more-updates': data['more-updates']
+        });
+        $(selector + ' .more-updates a').bind('click', function(event) {
+            event.preventDefault();
+            event.stopPropagation();
+            $.ajax({
+                url: '/rest/workbooks/updates?id=' + id,
+                success: function(data) {
+                    renderUpdates(id, data);
+                    EditBox.bind(selector + ' .editbox');
+                },
+                error: common.ajaxError
+            });
+        });
+    }
+
     /*
      * update(data)
      * Handle a successful response from an AJAX request.
@@ -51,6 +78,9 @@ function ($, common, paging, Dropdown, EditBox)
         if (populated) {
             $(".filter-dropdowns").removeClass('hidden');
             $('#workbook-list').render('workbook-list-template', data);
+            $.each(data['workbooks'], function(index, item) {
+                renderUpdates(item['workbookid'], item);
+            });
         } else {
             $(".filter-dropdowns").addClass('hidden');
             if (publisher_only) {
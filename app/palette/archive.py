@@ -2,12 +2,28 @@
 # pylint: enable=missing-docstring,relative-import
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, namedtuple
+import threading
+import time
 
-from controller.profile import UserProfile
+from sqlalchemy import func
+from webob import exc
+
+import akiri.framework.sqlalchemy as meta
+
+from controller.profile import UserProfile, Role
+from controller.sites import Site
+from controller.projects import Project
 from controller.util import UNDEFINED
 
 from .rest import PaletteRESTApplication
 
+# What the pages use of the site and project rows.  The cache holds these
+# instead of the ORM instances, which belong to the session that loaded
+# them and can't be shared between requests (threads).
+SiteData = namedtuple('SiteData', ['id', 'name'])
+ProjectData = namedtuple('ProjectData', ['id', 'name', 'site_id'])
+
 class ArchiveUserCache(dict):
     """ Cache of system_user_id -> display_name objects.
     The users table may be too big to pull in entirely so user objects
@@ -35,6 +51,49 @@ class ArchiveUserCache(dict):
         dict.__setitem__(self, system_user_id, display_name)
         return display_name
 
+    def preload(self, system_user_ids):
+        """ Look up all of 'system_user_ids' with a single query. """
+        ids = set([int(i) for i in system_user_ids if i is not None])
+        ids = [i for i in ids if not dict.__contains__(self, i)]
+        if not ids:
+            return
+        query = meta.Session.query(UserProfile).\
+                filter(UserProfile.envid == self.envid).\
+                filter(UserProfile.system_user_id.in_(ids))
+        for user in query:
+            dict.__setitem__(self, user.system_user_id, user.display_name())
+        for system_user_id in ids:
+            if not dict.__contains__(self, system_user_id):
+                dict.__setitem__(self, system_user_id, UNDEFINED)
+
+
+class TimedCache(object):
+    """ Values that are expensive to compute (counts, the site and project
+    lists) shared by all requests and kept for 'ttl' seconds.
+    """
+    MAX_KEYS = 1000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, function):
+        """ Return the value for key, calling function() to compute it
+        if it isn't cached or has expired. """
+        now = time.time()
+        with self.lock:
+            if key in self.data:
+                timestamp, value = self.data[key]
+                if now - timestamp < self.ttl:
+                    return value
+        value = function()
+        with self.lock:
+            if len(self.data) >= self.MAX_KEYS:
+                self.data = {}
+            self.data[key] = (now, value)
+        return value
+
 
 class ArchiveApplication(PaletteRESTApplication):
     """ Base class for all REST handlers. """
@@ -44,6 +103,119 @@ class ArchiveApplication(PaletteRESTApplication):
     ALL_SITES_OPTION = "All Sites"
     ALL_PROJECTS_OPTION = "All Projects"
 
+    # Number of revisions returned with each item of the list; the rest
+    # are requested from the 'updates' action.
+    UPDATES_LIMIT = 5
+
+    cache = TimedCache(30)
+
+    # Set by subclasses: the archived items, their revisions and the
+    # column linking the two.
+    ENTRY_CLASS = None
+    UPDATE_CLASS = None
+    KEY = None
+
+    def count(self, filters):
+        """ The (cached) number of entries matching filters. """
+        key = (self.ENTRY_CLASS.__tablename__,) + \
+              tuple(sorted(filters.items()))
+        return self.cache.get(key,
+                              lambda: self.ENTRY_CLASS.count(filters=filters))
+
+    @classmethod
+    def lookup_caches(cls, envid):
+        """ Return the (cached) sites and projects for the environment.
+        The dicts are copies so callers may change them. """
+        sites = cls.cache.get(('sites', envid),
+                              lambda: cls._load_sites(envid))
+        projects = cls.cache.get(('projects', envid),
+                                 lambda: cls._load_projects(envid))
+        return OrderedDict(sites), OrderedDict(projects)
+
+    @classmethod
+    def _load_sites(cls, envid):
+        return OrderedDict([(key, SiteData(site.id, site.name)) \
+                            for key, site in Site.cache(envid).items()])
+
+    @classmethod
+    def _load_projects(cls, envid):
+        return OrderedDict([(key, ProjectData(project.id, project.name,
+                                              project.site_id)) \
+                            for key, project in Project.cache(envid).items()])
+
+    def latest_updates(self, ids, limit):
+        """ Return a dict of id -> the newest 'limit' updates for each of
+        'ids' (newest first), loaded with one windowed query instead of
+        one relationship load per item. """
+        update_class = self.UPDATE_CLASS
+        updates = dict([(i, []) for i in ids])
+        if not ids:
+            return updates
+        column = getattr(update_class, self.KEY)
+        pkey = update_class.__mapper__.primary_key[0]
+        rownum = func.row_number().over(partition_by=column,
+                                        order_by=update_class.revision.desc())
+        window = meta.Session.query(pkey.label('pkey'),
+                                    rownum.label('rownum')).\
+                 filter(column.in_(ids)).\
+                 subquery()
+        query = meta.Session.query(update_class).\
+                join(window, pkey == window.c.pkey).\
+                filter(window.c.rownum <= limit).\
+                order_by(column, update_class.revision.desc())
+        for update in query:
+            updates[getattr(update, self.KEY)].append(update)
+        return updates
+
+    def update_counts(self, ids):
+        """ Return a dict of id -> number of updates, with one query. """
+        if not ids:
+            return {}
+        column = getattr(self.UPDATE_CLASS, self.KEY)
+        query = meta.Session.query(column, func.count()).\
+                filter(column.in_(ids)).\
+                group_by(column)
+        return dict(query.all())
+
+    def handle_updates(self, req):
+        """ Return the revisions of one item, for the 'updates' action.
+        Takes 'id' and optionally 'offset' and 'limit'. """
+        update_class = self.UPDATE_CLASS
+        entryid = req.params_getint('id')
+        if entryid is None:
+            raise exc.HTTPBadRequest()
+        entry = self.ENTRY_CLASS.get_unique_by_keys({'envid': req.envid,
+                                                     self.KEY: entryid},
+                                                    default=None)
+        if entry is None:
+            raise exc.HTTPNotFound()
+        if req.remote_user.roleid == Role.NO_ADMIN and \
+                entry.system_user_id != req.remote_user.system_user_id:
+            raise exc.HTTPForbidden()
+
+        column = getattr(update_class, self.KEY)
+        query = meta.Session.query(update_class).\
+                filter(column == entryid).\
+                order_by(update_class.revision.desc())
+        offset = req.params_getint('offset', default=0)
+        limit = req.params_getint('limit')
+        query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        updates = query.all()
+
+        users = ArchiveUserCache(req.envid)
+        users.preload([update.system_user_id for update in updates])
+        count = update_class.count(filters={self.KEY: entryid})
+        return {'id': entryid,
+                'updates': self.build_updates(updates, users),
+                'update-count': count}
+
+    @abstractmethod
+    def build_updates(self, updates, users):
+        """ Build the list of dicts for the updates."""
+        pass
+
     def _site_options(self, sites):
         """ Build the config information for the site dropdown. """
         options = [{"item": self.ALL_SITES_OPTION, "id": 0}]
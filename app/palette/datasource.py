@@ -65,6 +65,10 @@ class DatasourceSort(DictOption):
 class DatasourceApplication(ArchiveApplication):
     """ The REST application for the datasource archive page. """
 
+    ENTRY_CLASS = DataSourceEntry
+    UPDATE_CLASS = DataSourceUpdateEntry
+    KEY = 'dsid'
+
     def show_options(self, req):
         valueid = req.params_getint('show', DatasourceShow.ALL)
         return DatasourceShow(valueid).default()
@@ -149,17 +153,17 @@ class DatasourceApplication(ArchiveApplication):
 
         return query.all()
 
-    def _build_updates_for_datasources(self, entry, users):
-        """ Build a list of updates for the specified datasource entry."""
-        updates = []
-        for update in entry.updates:
+    def build_updates(self, updates, users):
+        """ Build a list of dicts for the specified datasource updates."""
+        result = []
+        for update in updates:
             data = update.todict(pretty=True, exclude='tds')
             data['username'] = users[update.system_user_id]
             if 'url' in data and data['url']:
                 # FIXME: make this configurable
                 data['url'] = '/data/datasource-archive/' + data['url']
-            updates.append(data)
-        return updates
+            result.append(data)
+        return result
 
     def handle_get(self, req):
         # pylint: disable=too-many-locals
@@ -171,8 +175,7 @@ class DatasourceApplication(ArchiveApplication):
             publisher_only = False
 
         # total count for this environment
-        # FIXME: too heavy weight for setting populated
-        if DataSourceEntry.count(filters={'envid':req.envid}) > 0:
+        if self.count({'envid':req.envid}) > 0:
             populated = True
         else:
             populated = False
@@ -180,22 +183,33 @@ class DatasourceApplication(ArchiveApplication):
         if populated and enabled:
             filters = self.build_query_filters(req)
             entries = self.do_query(req, filters)
-            count = DataSourceEntry.count(filters=filters)
+            count = self.count(filters)
         else:
             entries = []
             count = 0
 
         # lookup caches
+        sites, projects = self.lookup_caches(req.envid)
+
+        # The newest revisions of every item on the page with one query.
+        ids = [entry.dsid for entry in entries]
+        limit = req.params_getint('updates', default=self.UPDATES_LIMIT)
+        latest = self.latest_updates(ids, limit)
+        update_counts = self.update_counts(ids)
+
         users = ArchiveUserCache(req.envid)
-        sites = Site.cache(req.envid)
-        projects = Project.cache(req.envid)
+        users.preload([update.system_user_id \
+                           for updates in latest.values() \
+                           for update in updates])
 
         datasources = []
         for entry in entries:
             data = entry.todict(pretty=True)
 
-            updates = self._build_updates_for_datasources(entry, users)
+            updates = self.build_updates(latest[entry.dsid], users)
             data['updates'] = updates
+            data['update-count'] = update_counts.get(entry.dsid, 0)
+            data['more-updates'] = data['update-count'] > len(updates)
 
             if updates:
                 # slight change that the first update is not yet committed.
@@ -228,6 +242,8 @@ class DatasourceApplication(ArchiveApplication):
             action = req.environ[environ_key]
             if action == 'updates/note':
                 return self.handle_update_note(req)
+            if action == 'updates' and req.method == 'GET':
+                return self.handle_updates(req)
             raise exc.HTTPNotFound()
 
         if req.method == "GET":
@@ -255,9 +271,13 @@ class DatasourceData(GenericWSGIApplication):
         if not self.check_permission(req, update):
             return exc.HTTPForbidden()
 
+        contents = update.get_tds()
+        if contents is None:
+            return exc.HTTPNotFound()
+
         res = Response()
         res.content_type = 'application/octet-stream'
-        res.text = update.tds
+        res.text = contents
         return res
 
 class DatasourceArchive(PalettePage):
@@ -1,3 +1,6 @@
+import hashlib
+import threading
+
 from sqlalchemy import or_
 from webob import exc
 from collections import OrderedDict
@@ -26,6 +29,32 @@ __all__ = ["MonitorApplication"]
 
 BUY_URL = 'https://licensing.palette-software.com/buy'
 
+# A cheap fingerprint of everything the monitor view is built from.
+# The tables without a modification_time are hashed instead.
+VERSION_STMT = """
+SELECT
+ (SELECT max(modification_time)::text || count(*)
+  FROM agent WHERE envid = %(envid)d),
+ (SELECT md5(string_agg(v.volid || ':' || coalesce(v.size, 0) || ':' ||
+                        coalesce(v.available_space, 0), ',' ORDER BY v.volid))
+  FROM agent_volumes v JOIN agent a ON a.agentid = v.agentid
+  WHERE a.envid = %(envid)d),
+ (SELECT md5(string_agg(f.firewallid || ':' || f.port || ':' ||
+                        coalesce(f.color, ''), ',' ORDER BY f.firewallid))
+  FROM firewall f JOIN agent a ON a.agentid = f.agentid
+  WHERE a.envid = %(envid)d),
+ (SELECT max(modification_time)::text || count(*) FROM ports),
+ (SELECT max(modification_time)::text || count(*) FROM license),
+ (SELECT max(modification_time)::text || count(*) FROM tableau_processes),
+ (SELECT max(modification_time)::text || count(*) FROM notifications),
+ (SELECT max(modification_time)::text || count(*)
+  FROM system WHERE envid = %(envid)d),
+ (SELECT max(eventid) FROM events WHERE envid = %(envid)d)
+"""
+
+# Request parameters that don't change the content of the response.
+VOLATILE_PARAMS = ('seq', 'etag')
+
 class Colors(object):
     RED_NUM = 1
     YELLOW_NUM = 2
@@ -104,9 +133,15 @@ def calculate_main_state(req, agents):
 
 class MonitorApplication(PaletteRESTApplication):
     """The main monitor callback to handle status and event updates."""
+    SNAPSHOT_CACHE_SIZE = 100
+    INTERVAL = 1000 # ms
+
     def __init__(self):
         super(MonitorApplication, self).__init__()
         self.event = EventHandler()
+        # etag -> response (without 'seq'), most recent last
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
 
     def status_options(self, req):
         valueid = req.params_get('status', '0')
@@ -219,7 +254,53 @@ class MonitorApplication(PaletteRESTApplication):
 
         return lowest_color_num
 
+    def etag(self, req):
+        """Identifies the response: it changes when any of the data
+        the response is built from or the request parameters change."""
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(VERSION_STMT % {'envid': req.envid})
+            version = tuple(result.fetchone())
+        finally:
+            connection.close()
+
+        params = sorted([(key, value) for key, value in req.GET.items() \
+                         if key not in VOLATILE_PARAMS])
+        key = repr((version, req.envid,
+                    req.remote_user.userid, req.remote_user.roleid,
+                    req.palette_domain.trial_days(), params))
+        return hashlib.md5(key).hexdigest()
+
     def handle_monitor(self, req):
+        """Return the state for this environment needed by the UI.
+        If the client already has the current version ('etag'), only
+        a short 'unchanged' reply is sent.  Otherwise the response is
+        built once per version and shared by all clients."""
+        etag = self.etag(req)
+        seq = req.params_getint('seq')
+
+        if req.params_get('etag', None) == etag:
+            monitor_ret = {'etag': etag, 'unchanged': True}
+        else:
+            with self.lock:
+                snapshot = self.snapshots.get(etag)
+            if snapshot is None:
+                snapshot = self.build_monitor(req)
+                if snapshot is None:
+                    return
+                with self.lock:
+                    self.snapshots[etag] = snapshot
+                    while len(self.snapshots) > self.SNAPSHOT_CACHE_SIZE:
+                        self.snapshots.popitem(last=False)
+            monitor_ret = dict(snapshot)
+            monitor_ret['etag'] = etag
+
+        if not seq is None:
+            monitor_ret['seq'] = seq
+        monitor_ret['interval'] = self.INTERVAL
+        return monitor_ret
+
+    def build_monitor(self, req):
         """Collect all state for this environment needed by the UI."""
 
         # FIXME: just generate a list of dicts here using agent.todict()
@@ -244,10 +325,6 @@ class MonitorApplication(PaletteRESTApplication):
         config = [self.status_options(req), self.type_options(req)]
         monitor_ret['config'] = config
 
-        seq = req.params_getint('seq')
-        if not seq is None:
-            monitor_ret['seq'] = seq
-
         if not 'event' in req.GET or \
            ('event' in req.GET and req.GET['event'] != 'false'):
 
@@ -255,8 +332,6 @@ class MonitorApplication(PaletteRESTApplication):
             monitor_ret['events'] = events['events']
             monitor_ret['item-count'] = events['count']
 
-        monitor_ret['interval'] = 1000 # ms
-
         return monitor_ret
 
     def get_admin_view(self, req, main_state, state_control_entry,
@@ -61,7 +61,13 @@
       <i class="expand"></i>
     </div>
     <div class="description">
-      <ul>
+      <ul id="updates-{{workbookid}}"></ul>
+    </div>
+  </article>
+  {{/workbooks}}
+</script>
+
+<script id="workbook-updates-template" type="x-tmpl-mustache">
         {{#updates}}
         <li>
           <div>
@@ -82,10 +88,11 @@
           </div>
         </li>
         {{/updates}}
-      </ul>
-    </div>
-  </article>
-  {{/workbooks}}
+        {{#more-updates}}
+        <li class="more-updates">
+          <a href="#" data-id="{{id}}">Show all {{update-count}} revisions</a>
+        </li>
+        {{/more-updates}}
 </script>
 
 <script src="/js/vendor/require.js" data-main="/js/workbook.js">
@@ -64,6 +64,10 @@ class WorkbookSort(DictOption):
 class WorkbookApplication(ArchiveApplication):
     """ The REST application for the workbook archive page. """
 
+    ENTRY_CLASS = WorkbookEntry
+    UPDATE_CLASS = WorkbookUpdateEntry
+    KEY = 'workbookid'
+
     def show_options(self, req):
         valueid = req.params_getint('show', WorkbookShow.ALL)
         return WorkbookShow(valueid).default()
@@ -149,17 +153,17 @@ class WorkbookApplication(ArchiveApplication):
 
         return query.all()
 
-    def _build_updates_for_workbook(self, entry, users):
-        """ Build a list of updates for the specified workbook entry."""
-        updates = []
-        for update in entry.updates:
+    def build_updates(self, updates, users):
+        """ Build a list of dicts for the specified workbook updates."""
+        result = []
+        for update in updates:
             data = update.todict(pretty=True, exclude='twb')
             data['username'] = users[update.system_user_id]
             if 'url' in data and data['url']:
                 # FIXME: make this configurable
                 data['url'] = '/data/workbook-archive/' + data['url']
-            updates.append(data)
-        return updates
+            result.append(data)
+        return result
 
     # FIXME: move build options to a separate file.
     def handle_get(self, req):
@@ -173,8 +177,7 @@ class WorkbookApplication(ArchiveApplication):
             publisher_only = False
 
         # total count for this environment
-        # FIXME: too heavy weight for setting populated
-        if WorkbookEntry.count(filters={'envid':req.envid}) > 0:
+        if self.count({'envid':req.envid}) > 0:
             populated = True
         else:
             populated = False
@@ -182,23 +185,34 @@ class WorkbookApplication(ArchiveApplication):
         if populated and enabled:
             filters = self.build_query_filters(req)
             entries = self.do_query(req, filters)
-            count = WorkbookEntry.count(filters=filters)
+            count = self.count(filters)
         else:
             entries = []
             count = 0
 
         # lookup caches
-        users = ArchiveUserCache(req.envid)
-        sites = Site.cache(req.envid)
-        projects = Project.cache(req.envid)
+        sites, projects = self.lookup_caches(req.envid)
         projects = self._remove_sample_project(projects)
 
+        # The newest revisions of every item on the page with one query.
+        ids = [entry.workbookid for entry in entries]
+        limit = req.params_getint('updates', default=self.UPDATES_LIMIT)
+        latest = self.latest_updates(ids, limit)
+        update_counts = self.update_counts(ids)
+
+        users = ArchiveUserCache(req.envid)
+        users.preload([update.system_user_id \
+                           for updates in latest.values() \
+                           for update in updates])
+
         workbooks = []
         for entry in entries:
             data = entry.todict(pretty=True)
 
-            updates = self._build_updates_for_workbook(entry, users)
+            updates = self.build_updates(latest[entry.workbookid], users)
             data['updates'] = updates
+            data['update-count'] = update_counts.get(entry.workbookid, 0)
+            data['more-updates'] = data['update-count'] > len(updates)
 
             if updates:
                 # slight change that the first update is not yet committed.
@@ -244,6 +258,8 @@ class WorkbookApplication(ArchiveApplication):
             action = req.environ[environ_key]
             if action == 'updates/note':
                 return self.handle_update_note(req)
+            if action == 'updates' and req.method == 'GET':
+                return self.handle_updates(req)
             raise exc.HTTPNotFound()
 
         if req.method == "GET":
@@ -271,9 +287,13 @@ class WorkbookData(GenericWSGIApplication):
         if not self.check_permission(req, update):
             return exc.HTTPForbidden()
 
+        contents = update.get_twb()
+        if contents is None:
+            return exc.HTTPNotFound()
+
         res = Response()
         res.content_type = 'application/octet-stream'
-        res.text = update.twb
+        res.text = contents
         return res
 
 class WorkbookArchive(PalettePage):
@@ -0,0 +1 @@
+from test_archive import TimedCacheTest, LookupCachesTest
@@ -0,0 +1,78 @@
+import unittest
+
+from palette import archive
+from palette.archive import ArchiveApplication, TimedCache
+
+class FakeRow(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TimedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.now = 1000.0
+        self.real_time = archive.time.time
+        archive.time.time = lambda: self.now
+
+    def tearDown(self):
+        archive.time.time = self.real_time
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_cached(self):
+        cache = TimedCache(30)
+        self.assertEqual(cache.get('key', self.compute), 1)
+        self.now += 29
+        self.assertEqual(cache.get('key', self.compute), 1)
+        self.assertEqual(cache.get('other', self.compute), 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_expired(self):
+        cache = TimedCache(30)
+        self.assertEqual(cache.get('key', self.compute), 1)
+        self.now += 30
+        self.assertEqual(cache.get('key', self.compute), 2)
+        self.now += 10
+        self.assertEqual(cache.get('key', self.compute), 2)
+
+    def test_max_keys(self):
+        cache = TimedCache(30)
+        for i in range(TimedCache.MAX_KEYS):
+            cache.get(i, lambda: 'value')
+        self.assertEqual(len(cache.data), TimedCache.MAX_KEYS)
+        cache.get('key', self.compute)
+        self.assertEqual(len(cache.data), 1)
+
+
+class LookupCachesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.site_cache = archive.Site.cache
+        self.project_cache = archive.Project.cache
+        sites = [(1, FakeRow(id=1, name='Default'))]
+        projects = [(3, FakeRow(id=3, name='Sales', site_id=1))]
+        archive.Site.cache = classmethod(lambda cls, envid: dict(sites))
+        archive.Project.cache = \
+            classmethod(lambda cls, envid: dict(projects))
+        self.cache = ArchiveApplication.cache
+        ArchiveApplication.cache = TimedCache(30)
+
+    def tearDown(self):
+        ArchiveApplication.cache = self.cache
+        archive.Site.cache = self.site_cache
+        archive.Project.cache = self.project_cache
+
+    def test_plain_data(self):
+        sites, projects = ArchiveApplication.lookup_caches(1)
+        self.assertEqual(sites, {1: (1, 'Default')})
+        self.assertEqual(projects[3].site_id, 1)
+        self.assertNotIsInstance(projects[3], FakeRow)
+        # The callers get copies.
+        del sites[1]
+        sites, _ = ArchiveApplication.lookup_caches(1)
+        self.assertEqual(sites[1].name, 'Default')
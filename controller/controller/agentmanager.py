@@ -27,6 +27,7 @@ from odbc import ODBC
 from filemanager import FileManager
 from system import SystemKeys
 from util import sizestr, is_ip, traceback_string, failed
+from prlock import PriorityRLock
 
 logger = logging.getLogger()
 
@@ -47,6 +48,9 @@ class AgentConnection(object):
     # pylint: disable=too-many-instance-attributes
     _CID = 1
 
+    # Size of the blocks used to stream files to and from the agent.
+    CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, server, conn, addr, peername):
         self.server = server
         self.socket = conn
@@ -65,7 +69,9 @@ class AgentConnection(object):
 
         # Each agent connection has its own lock to allow only
         # one thread to send/recv  on the agent socket at a time.
-        self.lockobj = threading.RLock()
+        # Pings take the priority lane so they don't queue up behind
+        # other waiting requests.
+        self.lockobj = PriorityRLock()
 
         # A lock to allow only one user action (backup/restore/etc.)
         # at a time.
@@ -108,6 +114,61 @@ class AgentConnection(object):
         body = json.dumps(data)
         return self.http_send('POST', uri, body=body, headers=headers)
 
+    def http_get_file(self, uri, fileobj, offset=0, progress=None,
+                      length=None):
+        """GET 'uri' and write the response body to 'fileobj' in chunks
+           of CHUNK_SIZE instead of reading it all into memory.
+           If 'offset' is non-zero, only the rest of the file is requested
+           (Range).  If the agent returns the whole file instead,
+           'fileobj' is truncated first.  With 'length', only that many
+           bytes starting at 'offset' are requested and the agent must
+           honor the Range.  'progress' is called as
+           progress(bytes_done, bytes_total) after each chunk.
+           Returns the total size."""
+        # pylint: disable=too-many-arguments
+        headers = {}
+        if length is not None:
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        elif offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        self.lock()
+        try:
+            self.httpconn.request('GET', uri, None, headers)
+            res = self.httpconn.getresponse()
+            if res.status == httplib.OK:
+                if length is not None:
+                    res.read()
+                    raise IOError("range %d-%d not supported by the agent" \
+                                  % (offset, offset + length - 1))
+                if offset:
+                    fileobj.seek(0)
+                    fileobj.truncate()
+                    offset = 0
+            elif res.status != httplib.PARTIAL_CONTENT or \
+                    not headers.get('Range'):
+                self._httpexc(res, method='GET')
+
+            length = res.getheader('content-length')
+            if length is None:
+                total = None
+            else:
+                total = offset + int(length)
+
+            done = offset
+            while True:
+                data = res.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                fileobj.write(data)
+                done += len(data)
+                if progress:
+                    progress(done, total)
+            if total is not None and done != total:
+                raise IOError("short read: %d of %d bytes" % (done, total))
+            return done
+        finally:
+            self.unlock()
+
     # This function is slighly diffent, it proxies a GET through the agent.
     # It return the HTTPResponse object but with a 'body' member which is
     #  the result of the calling read().
@@ -129,12 +190,17 @@ class AgentConnection(object):
         finally:
             self.unlock()
 
-    def lock(self):
-        self.lockobj.acquire()
+    def lock(self, priority=False, polite=False):
+        self.lockobj.acquire(priority=priority, polite=polite)
 
     def unlock(self):
         self.lockobj.release()
 
+    def busy(self):
+        """Returns how many seconds another thread has been using the
+           connection or None if it is idle."""
+        return self.lockobj.busy()
+
     def user_action_lock(self, blocking=True):
         return self.user_action_lockobj.acquire(blocking)
 
@@ -151,6 +217,10 @@ class AgentManager(threading.Thread):
 
     SSL_HANDSHAKE_TIMEOUT_DEFAULT = 5
 
+    # Seconds, beyond 'cli_status_wait', the connection must have been
+    # busy before a ping is skipped instead of waiting its turn.
+    PING_BUSY_SLACK = 30
+
     # Agent types
     AGENT_TYPE_PRIMARY = "primary"
     AGENT_TYPE_WORKER = "worker"
@@ -1536,6 +1606,20 @@ class AgentManager(threading.Thread):
 
         stateman = self.server.state_manager
 
+        # A long request in progress already shows the agent is there: if
+        # it stops responding that request fails on the socket timeout and
+        # the agent is removed.  Don't wait behind it (e.g. a large
+        # /file GET or a long /sql query).  A command status poll only
+        # holds the connection for 'cli_status_wait' seconds and the ping
+        # gets the connection first when it is released, so just wait.
+        busy = agent.connection.busy()
+        if busy is not None and \
+                busy > self.server.cli_status_wait + self.PING_BUSY_SLACK:
+            logger.debug("Ping: Agent '%s', conn_id %d, skipped: connection "
+                         "busy for %d seconds.",
+                         agent.displayname, agent.conn_id, busy)
+            return True
+
         body = self.server.ping(agent)
         if body.has_key('error'):
             if stateman.upgrading():
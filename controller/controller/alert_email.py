@@ -3,6 +3,7 @@ import logging
 import time
 from datetime import datetime
 import threading
+import Queue
 from sqlalchemy.orm.exc import NoResultFound
 
 import akiri.framework.sqlalchemy as meta
@@ -24,11 +25,45 @@ mako.runtime.UNDEFINED = UNDEFINED
 
 logger = logging.getLogger()
 
+class EmailDispatcher(threading.Thread):
+    """Sends the queued emails one at a time so that event generation
+       never waits for the SMTP server.  When the queue is full, new
+       emails are dropped (and logged) rather than blocking."""
+
+    def __init__(self, system, max_pending):
+        super(EmailDispatcher, self).__init__()
+        self.daemon = True
+        self.system = system
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+
+    def put(self, to_emails, bcc, subject, message):
+        try:
+            self.queue.put_nowait((to_emails, bcc, subject, message))
+        except Queue.Full:
+            self.dropped += 1
+            logger.error("Email queue full (%d).  Not sending: Subject: %s",
+                         self.queue.maxsize, subject)
+
+    def run(self):
+        while True:
+            to_emails, bcc, subject, message = self.queue.get()
+            try:
+                mailer = Mailer(self.system[SystemKeys.FROM_EMAIL])
+                mailer.send(to_emails, subject, message, bcc=bcc)
+            except StandardError:
+                logger.exception("Email dispatch failed: Subject: %s",
+                                 subject)
+            finally:
+                meta.Session.remove()
+
+
 class AlertEmail(object):
     #pylint: disable=too-many-instance-attributes
 
     DEFAULT_ALERT_LEVEL = 1
     DEFAULT_MAX_SUBJECT_LEN = 1000
+    DEFAULT_EMAIL_QUEUE_SIZE = 100
 
     def __init__(self, server):
         self.envid = server.environment.envid
@@ -45,6 +80,14 @@ class AlertEmail(object):
                          self.alert_level, self.DEFAULT_ALERT_LEVEL)
             self.alert_level = self.DEFAULT_ALERT_LEVEL
 
+        # email_message -> compiled mako Template
+        self.templates = {}
+
+        max_pending = self.config.getint("alert", "email_queue_size",
+                                         default=self.DEFAULT_EMAIL_QUEUE_SIZE)
+        self.dispatcher = EmailDispatcher(self.system, max_pending)
+        self.dispatcher.start()
+
     def admin_emails(self, event_entry):
         """Return a list of admins that have an email address, enabled
            and aren't the palette user."""
@@ -87,12 +130,16 @@ class AlertEmail(object):
 
         return [entry.email]
 
-    def send(self, event_entry, data, recipient=None, eventid=None):
+    def send(self, event_entry, data, recipient=None, eventid=None,
+             sync=False):
         """Send an alert.
             Arguments:
                 key:    The key to look up.
                 data:   A Dictionary with the event information.
+                sync:   Send before returning instead of queueing
+                        the email for the dispatcher thread.
         """
+        # pylint: disable=too-many-arguments
         # pylint: disable=too-many-branches
         # pylint: disable=too-many-locals
         # pylint: disable=too-many-statements
@@ -115,7 +162,10 @@ class AlertEmail(object):
         message = event_entry.email_message
         if message:
             try:
-                mako_template = Template(message)
+                mako_template = self.templates.get(message)
+                if mako_template is None:
+                    mako_template = Template(message)
+                    self.templates[message] = mako_template
                 message = mako_template.render(**data)
             except StandardError:
                 message = "Email mako template message conversion failure: " + \
@@ -206,7 +256,7 @@ class AlertEmail(object):
                 sendit = self._mute_reconn_check(data)
 
         if sendit:
-            self._do_send(to_emails, bcc, subject, message)
+            self._do_send(to_emails, bcc, subject, message, sync=sync)
 
     def _mute_reconn_check(self, data):
         """
@@ -304,8 +354,12 @@ class AlertEmail(object):
                      agentid, subject)
         self._do_send(to_emails, bcc, subject, message)
 
-    def _do_send(self, to_emails, bcc, subject, message):
+    def _do_send(self, to_emails, bcc, subject, message, sync=False):
         """ Do the actual send for a plain-text message """
+        # pylint: disable=too-many-arguments
+        if not sync:
+            self.dispatcher.put(to_emails, bcc, subject, message)
+            return
         mailer = Mailer(self.system[SystemKeys.FROM_EMAIL])
         mailer.send(to_emails, subject, message, bcc=bcc)
 
@@ -0,0 +1,414 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, func
+from sqlalchemy import UniqueConstraint, text
+from sqlalchemy.schema import ForeignKey
+
+import akiri.framework.sqlalchemy as meta
+
+from agentmanager import AgentManager
+from archive_mixin import ArchiveException, ArchiveError
+from manager import Manager
+from mixin import BaseMixin, BaseDictMixin
+
+logger = logging.getLogger()
+
+class ArchiveJobEntry(meta.Base, BaseMixin, BaseDictMixin):
+    """One workbook, datasource or extract refresh waiting to be archived.
+       The rows are the persistent state of the ArchiveQueue: they survive
+       a controller restart, along with the retry count and time."""
+    # pylint: disable=no-init
+    __tablename__ = "archive_jobs"
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_FAILED = "failed"
+
+    jobid = Column(BigInteger, unique=True, nullable=False,
+                   autoincrement=True, primary_key=True)
+    envid = Column(BigInteger, ForeignKey("environment.envid"),
+                   nullable=False)
+    # The ArchiveQueue handler name, e.g. 'workbook'.
+    kind = Column(String, nullable=False)
+    # The wuid, dsuid or sid of the row to archive (depends on 'kind').
+    itemid = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default=STATUS_QUEUED)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, server_default=func.now())
+    error = Column(String)
+    creation_time = Column(DateTime, server_default=func.now())
+    modification_time = Column(DateTime, server_default=func.now(),
+                               onupdate=func.current_timestamp())
+
+    __table_args__ = (UniqueConstraint('kind', 'itemid'),)
+
+
+class ArchiveJob(object):
+    """A claimed job as seen by the handler.  The handler updates
+       'stage' as the item moves from one step to the next."""
+
+    def __init__(self, jobid, kind, itemid, attempts):
+        self.jobid = jobid
+        self.kind = kind
+        self.itemid = itemid
+        self.attempts = attempts
+        self.stage = 'start'
+        self.start_time = time.time()
+
+    def todict(self):
+        return {'kind': self.kind,
+                'itemid': self.itemid,
+                'attempts': self.attempts,
+                'stage': self.stage,
+                'seconds': int(time.time() - self.start_time)}
+
+
+class ArchiveQueue(Manager):
+    """Archives workbook, datasource and extract refresh files with a pool
+       of worker threads instead of one item after another.
+
+       Each worker takes the next ready job from the archive_jobs table
+       and runs it through all of the steps (tabcmd get, twbx/tdsx
+       extraction, copy to the controller, placement) so the steps of
+       different items overlap.  A failed item is retried with an
+       exponential backoff up to 'archive_retry_max' times.
+
+       Handlers are registered per kind and provide:
+            archive_enabled(kind): True if archiving is on.
+            archive_item(agent, job): Returns True when the item is done
+                                      (or gone), False to retry it and
+                                      None if it couldn't be tried yet.
+            archive_retain(kind): Remove versions past the retain count.
+    """
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_RETRY_DELAY = 60    # seconds, doubled after each failure
+    DEFAULT_RETRY_MAX = 5
+
+    # How long an idle worker waits before looking for ready jobs again.
+    POLL_INTERVAL = 60
+    # How long a worker waits after failing to get a job (e.g. no DB).
+    ERROR_INTERVAL = 10
+
+    def __init__(self, server):
+        super(ArchiveQueue, self).__init__(server)
+        config = server.config
+        self.workers = max(config.getint('controller', 'archive_workers',
+                                         default=self.DEFAULT_WORKERS), 1)
+        self.retry_delay = config.getint('controller', 'archive_retry_delay',
+                                         default=self.DEFAULT_RETRY_DELAY)
+        self.retry_max = config.getint('controller', 'archive_retry_max',
+                                       default=self.DEFAULT_RETRY_MAX)
+
+        self.handlers = {}      # kind -> handler
+        self.active = {}        # jobid -> ArchiveJob
+        self.dirty = set()      # kinds archived since the last retain
+        self.retaining = False  # no job is claimed while True
+        self.cond = threading.Condition()
+
+        self.start_time = None
+        self.queued = 0
+        self.archived = 0
+        self.retried = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def start(self):
+        """Requeue the jobs that were running when the controller stopped
+           and start the workers."""
+        stmt = text("UPDATE archive_jobs SET status = :queued, " + \
+                    "modification_time = NOW() " + \
+                    "WHERE envid = :envid AND status = :running")
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(stmt, envid=self.envid,
+                                        queued=ArchiveJobEntry.STATUS_QUEUED,
+                                        running=ArchiveJobEntry.STATUS_RUNNING)
+        finally:
+            connection.close()
+        if result.rowcount:
+            logger.info("archive queue: resuming %d interrupted jobs",
+                        result.rowcount)
+
+        self.start_time = time.time()
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='archive-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def add(self, kind, itemids):
+        """Queue the items for archiving.  Items that failed for good
+           are given another try.  Returns the number of new jobs."""
+        itemids = list(set(itemids))
+        if not itemids:
+            return 0
+
+        params = {'envid': self.envid, 'kind': kind,
+                  'queued': ArchiveJobEntry.STATUS_QUEUED,
+                  'failed': ArchiveJobEntry.STATUS_FAILED}
+        values = []
+        for i, itemid in enumerate(itemids):
+            values.append("(CAST(:itemid%d AS BIGINT))" % i)
+            params['itemid%d' % i] = itemid
+        items = "items (itemid) AS (VALUES " + ", ".join(values) + ")"
+
+        retry_stmt = text(
+            "WITH " + items + " " + \
+            "UPDATE archive_jobs j SET status = :queued, attempts = 0, " + \
+            "next_attempt = NOW(), error = NULL, " + \
+            "modification_time = NOW() " + \
+            "FROM items i " + \
+            "WHERE j.kind = :kind AND j.itemid = i.itemid " + \
+            "AND j.status = :failed")
+        insert_stmt = text(
+            "WITH " + items + " " + \
+            "INSERT INTO archive_jobs " + \
+            "(envid, kind, itemid, status, attempts) " + \
+            "SELECT :envid, :kind, i.itemid, :queued, 0 FROM items i " + \
+            "WHERE NOT EXISTS (SELECT 1 FROM archive_jobs j " + \
+            "WHERE j.kind = :kind AND j.itemid = i.itemid)")
+
+        # 'WITH' statements aren't autocommitted, so commit explicitly.
+        connection = meta.get_connection()
+        try:
+            with connection.begin():
+                connection.execute(retry_stmt, **params)
+                result = connection.execute(insert_stmt, **params)
+        finally:
+            connection.close()
+
+        with self.cond:
+            self.queued += result.rowcount
+            self.cond.notify_all()
+
+        logger.debug("archive queue: %d %s items, %d new jobs",
+                     len(itemids), kind, result.rowcount)
+        return result.rowcount
+
+    def _enabled_kinds(self):
+        kinds = []
+        for kind, handler in self.handlers.items():
+            try:
+                if handler.archive_enabled(kind):
+                    kinds.append(kind)
+            except StandardError:
+                logger.exception("archive queue: %s enabled check failed",
+                                 kind)
+            finally:
+                meta.Session.remove()
+        return kinds
+
+    def _claim(self, kinds):
+        """Mark the next ready job as running and return it or None.
+           Called with self.cond so only one worker claims at a time."""
+        params = {'envid': self.envid,
+                  'queued': ArchiveJobEntry.STATUS_QUEUED,
+                  'running': ArchiveJobEntry.STATUS_RUNNING}
+        names = []
+        for i, kind in enumerate(kinds):
+            names.append(":kind%d" % i)
+            params['kind%d' % i] = kind
+
+        stmt = text(
+            "UPDATE archive_jobs SET status = :running, " + \
+            "modification_time = NOW() " + \
+            "WHERE jobid = (SELECT jobid FROM archive_jobs " + \
+            "WHERE envid = :envid AND status = :queued " + \
+            "AND next_attempt <= NOW() " + \
+            "AND kind IN (" + ", ".join(names) + ") " + \
+            "ORDER BY next_attempt, jobid LIMIT 1) " + \
+            "RETURNING jobid, kind, itemid, attempts")
+
+        connection = meta.get_connection()
+        try:
+            row = connection.execute(stmt, **params).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return ArchiveJob(row[0], row[1], row[2], row[3])
+
+    def _next(self):
+        """Wait for a job that is ready to run and return it.
+           The retain counts are applied once the queue runs dry, with
+           the other workers kept from claiming jobs meanwhile."""
+        while True:
+            kinds = self._enabled_kinds()
+            with self.cond:
+                job = None
+                if kinds and not self.retaining:
+                    job = self._claim(kinds)
+                if job:
+                    self.active[job.jobid] = job
+                    return job
+                retain = None
+                if self.dirty and not self.active and not self.retaining:
+                    retain = self.dirty
+                    self.dirty = set()
+                    self.retaining = True
+                else:
+                    self.cond.wait(self.POLL_INTERVAL)
+            if retain:
+                try:
+                    self._retain(retain)
+                finally:
+                    with self.cond:
+                        self.retaining = False
+                        self.cond.notify_all()
+
+    def _retain(self, kinds):
+        for kind in kinds:
+            try:
+                removed = self.handlers[kind].archive_retain(kind)
+                logger.debug("archive queue: %s retain removed %d",
+                             kind, removed)
+            except StandardError:
+                logger.exception("archive queue: %s retain failed", kind)
+            finally:
+                meta.Session.remove()
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._next()
+            except StandardError:
+                logger.exception("archive queue: failed to get a job")
+                time.sleep(self.ERROR_INTERVAL)
+                continue
+            finally:
+                meta.Session.remove()
+            try:
+                done, error = self._run(job)
+            except StandardError as ex:
+                logger.exception("archive queue: %s %d failed",
+                                 job.kind, job.itemid)
+                done, error = False, str(ex)
+            finally:
+                meta.Session.remove()
+
+            try:
+                self._finish(job, done, error)
+            except StandardError:
+                logger.exception("archive queue: failed to update job %d",
+                                 job.jobid)
+
+    def _run(self, job):
+        """Returns (done, error).  done is None if the job didn't run."""
+        agent = self.server.agentmanager.agent_by_type(
+                                            AgentManager.AGENT_TYPE_PRIMARY)
+        if not agent or not agent.connection:
+            return None, 'No primary agent connected.'
+        if not self.server.odbc_ok():
+            return None, 'Archiving is not possible in state: %s' % \
+                         self.server.state_manager.get_state()
+
+        # Don't start an item while an upgrade is in progress.
+        rwlock = self.server.upgrade_rwlock
+        if not rwlock.read_acquire(blocking=False):
+            return None, 'Upgrading.'
+        try:
+            return self.handlers[job.kind].archive_item(agent, job), None
+        except ArchiveException as ex:
+            if ex.value != ArchiveError.BAD_CREDENTIALS:
+                raise
+            # The handler has disabled archiving: keep the job for later.
+            return None, ex.value
+        finally:
+            rwlock.read_release()
+
+    def _finish(self, job, done, error):
+        elapsed = time.time() - job.start_time
+        gave_up = False
+        if done:
+            stmt = text("DELETE FROM archive_jobs WHERE jobid = :jobid")
+            params = {'jobid': job.jobid}
+        elif done is None:
+            # Not attempted: try again later without counting it.
+            stmt = text(
+                "UPDATE archive_jobs SET status = :queued, " + \
+                "error = :error, " + \
+                "next_attempt = NOW() + :delay * INTERVAL '1 second', " + \
+                "modification_time = NOW() WHERE jobid = :jobid")
+            params = {'jobid': job.jobid, 'error': error,
+                      'queued': ArchiveJobEntry.STATUS_QUEUED,
+                      'delay': self.retry_delay}
+        else:
+            attempts = job.attempts + 1
+            gave_up = attempts >= self.retry_max
+            if gave_up:
+                status = ArchiveJobEntry.STATUS_FAILED
+            else:
+                status = ArchiveJobEntry.STATUS_QUEUED
+            stmt = text(
+                "UPDATE archive_jobs SET status = :status, " + \
+                "attempts = :attempts, error = :error, " + \
+                "next_attempt = NOW() + :delay * INTERVAL '1 second', " + \
+                "modification_time = NOW() WHERE jobid = :jobid")
+            params = {'jobid': job.jobid, 'status': status,
+                      'attempts': attempts, 'error': error,
+                      'delay': self.retry_delay * 2 ** job.attempts}
+            logger.info("archive queue: %s %d attempt %d failed%s",
+                        job.kind, job.itemid, attempts,
+                        gave_up and ", giving up" or "")
+
+        try:
+            connection = meta.get_connection()
+            try:
+                connection.execute(stmt, **params)
+            finally:
+                connection.close()
+        finally:
+            # A job left 'running' by a failed update is requeued on the
+            # next start.
+            with self.cond:
+                del self.active[job.jobid]
+                if done:
+                    self.archived += 1
+                    self.busy_seconds += elapsed
+                    self.dirty.add(job.kind)
+                elif gave_up:
+                    self.failed += 1
+                elif done is not None:
+                    self.retried += 1
+                self.cond.notify_all()
+
+    def stats(self):
+        """Queue depth per kind and status, the jobs in progress and the
+           throughput since the controller started (used by the CLI)."""
+        stmt = text("SELECT kind, status, COUNT(*) FROM archive_jobs " + \
+                    "WHERE envid = :envid GROUP BY kind, status")
+        connection = meta.get_connection()
+        try:
+            rows = connection.execute(stmt, envid=self.envid).fetchall()
+        finally:
+            connection.close()
+
+        depth = {}
+        for kind, status, count in rows:
+            depth.setdefault(kind, {})[status] = count
+
+        with self.cond:
+            if self.start_time:
+                hours = max(time.time() - self.start_time, 1) / 3600.0
+            else:
+                hours = None
+            if self.archived:
+                average = round(self.busy_seconds / self.archived, 1)
+            else:
+                average = 0.0
+            return {'workers': self.workers,
+                    'depth': depth,
+                    'active': [job.todict() for job in self.active.values()],
+                    'queued': self.queued,
+                    'archived': self.archived,
+                    'retried': self.retried,
+                    'failed': self.failed,
+                    'archived-per-hour': hours and \
+                                         round(self.archived / hours, 1),
+                    'average-seconds': average}
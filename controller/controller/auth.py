@@ -15,12 +15,14 @@ logger = logging.getLogger()
 # FIXME: use the ODBC class here instead.
 class AuthManager(Manager):
 
+    SYSTEM_USERS_COLUMNS = ['name', 'email', 'hashed_password', 'salt',
+                            'friendly_name', 'admin_level', 'created_at', 'id']
+    USERS_COLUMNS = ['system_user_id', 'login_at', 'admin_level',
+                     'licensing_role_id', 'publisher_tristate']
+
     # build a cache of the Tableau 'users' table.
     def load_users(self, agent):
-        stmt = \
-            'SELECT system_user_id, login_at, admin_level,' +\
-            ' licensing_role_id, publisher_tristate ' +\
-            'FROM users'
+        stmt = 'SELECT ' + ', '.join(self.USERS_COLUMNS) + ' FROM users'
 
         data = agent.odbc.execute(stmt)
         if 'error' in data or not '' in data:
@@ -112,12 +114,22 @@ class AuthManager(Manager):
             return {"error": "Cannot run command while in state: %s" % \
                         self.server.state_manager.get_state()}
 
-        stmt = \
-            'SELECT system_users.name, system_users.email, ' +\
-            ' system_users.hashed_password, system_users.salt, ' +\
-            ' system_users.friendly_name, system_users.admin_level, ' +\
-            ' system_users.created_at, system_users.id ' +\
-            'FROM system_users'
+        # The import is skipped if neither table has changed since the
+        # last one.
+        fingerprints = [
+            agent.odbc.fingerprint('system_users', self.SYSTEM_USERS_COLUMNS),
+            agent.odbc.fingerprint('users', self.USERS_COLUMNS)]
+        if all([self.server.fingerprints.unchanged(fingerprint) \
+                    for fingerprint in fingerprints]):
+            # Send tableau readonly password-related events if appropriate.
+            self._eventit(agent, fingerprints[0].data)
+            timestamp = datetime.now().strftime(DATEFMT)
+            self.system.save(SystemKeys.AUTH_TIMESTAMP, timestamp)
+            return {u'status': 'OK', u'count': fingerprints[0].count,
+                    u'sync': fingerprints[0].todict()}
+
+        stmt = 'SELECT ' + ', '.join(self.SYSTEM_USERS_COLUMNS) + \
+               ' FROM system_users'
 
         excludes = ['guest', '_system']
 
@@ -147,6 +159,7 @@ class AuthManager(Manager):
         else:
             first_load = False
 
+        rows = []
         for row in data['']:
             name = row[0]
             if name.lower() in excludes:
@@ -155,32 +168,30 @@ class AuthManager(Manager):
             sysid = row[7]
             names.append(name)
 
-            entry = UserProfile.get_by_name(envid, name)
-            if not entry:
-                entry = UserProfile(envid=envid, name=name)
-                entry.email_level = default_email_level
-                session.add(entry)
-
-            entry.email = row[1]
-            entry.hashed_password = row[2]
-            entry.salt = row[3]
-            entry.friendly_name = row[4]
-            entry.system_admin_level = row[5]
-            entry.system_created_at = row[6]
-            entry.system_user_id = sysid
+            values = {'name': name,
+                      'email': row[1],
+                      'hashed_password': row[2],
+                      'salt': row[3],
+                      'friendly_name': row[4],
+                      'system_admin_level': row[5],
+                      'system_created_at': row[6],
+                      'system_user_id': sysid}
 
             if sysid in cache:
                 obj = cache[sysid]
-                entry.login_at = obj.login_at
-                entry.user_admin_level = obj.admin_level
-                entry.licensing_role_id = obj.licensing_role_id
-                entry.publisher = obj.publisher
+                values['login_at'] = obj.login_at
+                values['user_admin_level'] = obj.admin_level
+                values['licensing_role_id'] = obj.licensing_role_id
+                values['publisher'] = obj.publisher
 
             # On first user table import, Tableau Server Administrators
             # are set to Palette Super Admins.
-            if first_load and entry.system_admin_level == 10:
-                entry.roleid = Role.SUPER_ADMIN
+            if first_load and values['system_admin_level'] == 10:
+                values['roleid'] = Role.SUPER_ADMIN
+            rows.append(values)
 
+        sync = UserProfile.bulk_sync(envid, ['name'], rows,
+                            defaults={'email_level': default_email_level})
         session.commit()
 
         # deleted entries no longer found in Tableau are marked inactive.
@@ -191,7 +202,11 @@ class AuthManager(Manager):
         timestamp = datetime.now().strftime(DATEFMT)
         self.system.save(SystemKeys.AUTH_TIMESTAMP, timestamp)
 
-        d = {u'status': 'OK', u'count': len(data[''])}
+        for fingerprint in fingerprints:
+            self.server.fingerprints.save(fingerprint)
+
+        d = {u'status': 'OK', u'count': len(data['']),
+             u'sync': sync.todict()}
         logger.debug("auth load returning: %s", str(d))
         return d
 
@@ -1,3 +1,5 @@
+import threading
+
 from manager import Manager
 from profile import UserProfile
 from util import UNDEFINED
@@ -23,13 +25,65 @@ class TableauUserCache(object):
             return self.data[key]
         return -1
 
+# Fingerprints of the Tableau tables as of the last successful sync,
+# shared by all managers (server.fingerprints).
+class FingerprintCache(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.saved = {}     # fingerprint key -> (value, data)
+        self.checks = 0
+        self.skips = 0
+
+    def unchanged(self, fingerprint):
+        """True if the table hasn't changed since the fingerprint was
+           saved.  A failed fingerprint query counts as changed."""
+        with self.lock:
+            self.checks += 1
+            if fingerprint.error:
+                return False
+            saved = self.saved.get(fingerprint.key)
+            if saved is None or saved[0] != fingerprint.value:
+                return False
+            self.skips += 1
+            return True
+
+    def get(self, fingerprint):
+        """Returns the data saved with the fingerprint."""
+        with self.lock:
+            return self.saved[fingerprint.key][1]
+
+    def save(self, fingerprint, data=None):
+        """Called after a successful sync of the table."""
+        if fingerprint.error:
+            return
+        with self.lock:
+            self.saved[fingerprint.key] = (fingerprint.value, data)
+
+    def invalidate(self):
+        with self.lock:
+            self.saved = {}
+
+    def stats(self):
+        with self.lock:
+            return {'tables': len(self.saved),
+                    'checks': self.checks,
+                    'skips': self.skips}
+
 class TableauCacheManager(Manager):
 
+    USERS_COLUMNS = ['system_user_id', 'site_id', 'id']
+
     # build a cache of the Tableau 'users' table.
     # used to translate site_id:userid -> system_user_id
+    # The cache is only rebuilt when the table has changed.
     def load_users(self, agent):
+        fingerprint = agent.odbc.fingerprint('users', self.USERS_COLUMNS)
+        if self.server.fingerprints.unchanged(fingerprint):
+            return self.server.fingerprints.get(fingerprint)
+
         stmt = \
-            'SELECT system_user_id, site_id, id ' +\
+            'SELECT ' + ', '.join(self.USERS_COLUMNS) + ' ' +\
             'FROM users'
 
         data = agent.odbc.execute(stmt)
@@ -40,6 +94,7 @@ class TableauCacheManager(Manager):
         for row in data['']:
             cache.add(site_id=row[1], user_id=row[2],
                       system_user_id=int(row[0]))
+        self.server.fingerprints.save(fingerprint, cache)
         return cache
 
     # translate a system_user_id value to the 'username' used by eventgen.
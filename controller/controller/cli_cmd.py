@@ -75,6 +75,10 @@ class CleanupRequest(Request):
         super(CleanupRequest, self).__init__("cleanup", xid=xid)
 
 class CliCmd(object):
+
+    # Seconds before the first re-poll of an agent that doesn't long-poll.
+    FIRST_STATUS_DELAY = 0.25
+
     def __init__(self, server):
         self.server = server
 
@@ -279,6 +283,15 @@ class CliCmd(object):
             Note: Do not call this with the agent lock since
             we keep requesting status until the command is
             finished and that could be a long time.
+
+            Each request asks the agent to hold the reply for up to
+            'cli_status_wait' seconds until the command finishes
+            (long-poll).  An agent that answers at once instead is
+            polled again after a delay that doubles up to
+            'cli_get_status_interval', so short commands are noticed
+            quickly either way.  Each poll takes the connection lock
+            'politely': other threads waiting for the connection (file
+            transfers, other commands) get it first.
         """
         # pylint: disable=too-many-branches
         # pylint: disable=too-many-return-statements
@@ -289,10 +302,14 @@ class CliCmd(object):
 #        print "awake"
 
         uri = self.server.CLI_URI + "?xid=" + str(xid)
+        wait = self.server.cli_status_wait
+        if wait > 0:
+            uri += "&wait=" + str(wait)
         headers = {"Content-Type": "application/json"}
 
         aconn = agent.connection
         start_time = time.time()
+        delay = self.FIRST_STATUS_DELAY
         while True:
             now = time.time()
             if now - start_time > timeout:
@@ -329,8 +346,11 @@ class CliCmd(object):
                     (agent.displayname, agent.agent_type, agent.uuid,
                     aconn.conn_id, uri))
 
-            aconn.lock()
+            # The agent holds the reply for up to 'wait' seconds: let any
+            # other user of the connection go first before every poll.
+            aconn.lock(polite=True)
             logger.debug("Sending GET " + uri)
+            request_time = time.time()
 
             try:
                 aconn.httpconn.request("GET", uri, None, headers)
@@ -401,7 +421,11 @@ class CliCmd(object):
                                                         body['exit-status']
                 return body
             elif body['run-status'] == 'running':
-                time.sleep(self.server.cli_get_status_interval)
+                if wait > 0 and time.time() - request_time >= wait:
+                    # The agent held the request: ask again right away.
+                    continue
+                time.sleep(delay)
+                delay = min(delay * 2, self.server.cli_get_status_interval)
                 continue
             else:
                 self.server.remove_agent(agent,
@@ -12,6 +12,7 @@ import traceback
 import subprocess
 from urlparse import urlparse, urlsplit
 import unicodedata
+from StringIO import StringIO
 
 import sqlalchemy
 from sqlalchemy.orm.session import make_transient
@@ -171,6 +172,11 @@ class CliHandler(socketserver.StreamRequestHandler):
 
     AUTO_UPDATE_CRON_FILENAME = "palette-update"
 
+    # In keep-alive mode the output of every command is followed by
+    # this line so clients can send the next command on the connection.
+    END_MARKER = "."
+    keepalive = False
+
     def finish(self):
         """Overrides the StreamRequestHandler's finish().
            Handles exceptions more gracefully and
@@ -392,7 +398,7 @@ class CliHandler(socketserver.StreamRequestHandler):
 
         try:
             self.server.event_control.alert_email.send(event_entry, data,
-                                                       recipient)
+                                                       recipient, sync=True)
         except StandardError:
             logger.exception('CliHandler exception:')
             self.error(clierror.ERROR_COMMAND_FAILED, traceback_string())
@@ -827,16 +833,21 @@ class CliHandler(socketserver.StreamRequestHandler):
         self.report_status(body)
 
 
-    @usage('workbook [IMPORT|FIXUP]')
+    @usage('workbook [IMPORT|FIXUP|MIGRATE]')
     @upgrade_rwlock
     def do_workbook(self, cmd):
-        """Import workbooks table from Tableau or fixup a previous import"""
+        """Import workbooks table from Tableau or fixup a previous import.
+           migrate: Move archived twb contents to the revision store."""
 
         if len(cmd.args) != 1:
             self.print_usage(self.do_workbook.__usage__)
             return
 
         action = cmd.args[0].lower()
+        if action == 'migrate':
+            self.ack()
+            self.report_status(self.server.workbooks.migrate_twb())
+            return
         if action != 'import' and action != 'fixup':
             self.print_usage(self.do_workbook.__usage__)
             return
@@ -859,16 +870,21 @@ class CliHandler(socketserver.StreamRequestHandler):
         logger.debug("do_workbook result: %s", str(body))
         self.report_status(body)
 
-    @usage('datasource [IMPORT|FIXUP]')
+    @usage('datasource [IMPORT|FIXUP|MIGRATE]')
     @upgrade_rwlock
     def do_datasource(self, cmd):
-        """Import datasources table from Tableau or fixup a previous import"""
+        """Import datasources table from Tableau or fixup a previous import.
+           migrate: Move archived tds contents to the revision store."""
 
         if len(cmd.args) != 1:
             self.print_usage(self.do_datasource.__usage__)
             return
 
         action = cmd.args[0].lower()
+        if action == 'migrate':
+            self.ack()
+            self.report_status(self.server.datasources.migrate_tds())
+            return
         if action != 'import' and action != 'fixup':
             self.print_usage(self.do_datasource.__usage__)
             return
@@ -926,6 +942,33 @@ class CliHandler(socketserver.StreamRequestHandler):
             body = self.server.extract_archive.refresh(agent)
         self.report_status(body)
 
+    @usage('archive_queue [STATUS]')
+    def do_archive_queue(self, cmd):
+        """Report the depth and throughput of the archive work queue:
+           workbooks, datasources and extract refreshes."""
+
+        if len(cmd.args) > 1 or \
+                    (len(cmd.args) == 1 and cmd.args[0].lower() != 'status'):
+            self.print_usage(self.do_archive_queue.__usage__)
+            return
+
+        self.ack()
+        self.report_status(self.server.archive_queue.stats())
+
+
+    @usage('dedup [STATUS]')
+    def do_dedup(self, cmd):
+        """Report the size of the backups in the deduplicating chunk
+           store and of the chunks they use, per volume."""
+
+        if len(cmd.args) > 1 or \
+                    (len(cmd.args) == 1 and cmd.args[0].lower() != 'status'):
+            self.print_usage(self.do_dedup.__usage__)
+            return
+
+        self.ack()
+        self.report_status(self.server.dedup.stats())
+
 
     @usage('[/noconfig] [/nobackup] [/nolicense] restore backup-name ' + \
            '[tableau-run-as-user-password]')
@@ -1608,18 +1651,22 @@ class CliHandler(socketserver.StreamRequestHandler):
 
         self.report_status(body)
 
-    @usage('metric')
+    @usage('metric [stats]')
     @upgrade_rwlock
     def do_metric(self, cmd):
         """Check on metrics and potentially send an alert."""
 
-        if len(cmd.args):
+        if len(cmd.args) > 1 or \
+                    (len(cmd.args) == 1 and cmd.args[0].lower() != 'stats'):
             self.print_usage(self.do_metric.__usage__)
             return
 
         self.ack()
 
-        body = self.server.metrics.check()
+        if cmd.args:
+            body = self.server.metrics.stats()
+        else:
+            body = self.server.metrics.check()
 
         self.report_status(body)
 
@@ -2195,8 +2242,8 @@ class CliHandler(socketserver.StreamRequestHandler):
         self.report_status(body)
 
 
-    @usage('file [GET|PUT|DELETE|SHA256|MOVE|LISTDIR|SIZE|MKDIRS|TYPE|WRITE]' +\
-           ' <path> [arg]')
+    @usage('file [GET|RESUME|PUT|DELETE|SHA256|MANIFEST|MOVE|LISTDIR|SIZE|' +\
+           'MKDIRS|TYPE|WRITE] <path> [arg]')
     def do_file(self, cmd):
         """Manipulate a particular file on the agent."""
         # pylint: disable=too-many-return-statements
@@ -2221,6 +2268,13 @@ class CliHandler(socketserver.StreamRequestHandler):
                     return
                 self.ack()
                 body = agent.filemanager.save(path, cmd.args[2])
+            elif method == 'RESUME':
+                # GET, completing a partial target from an earlier GET.
+                if len(cmd.args) != 3:
+                    self.print_usage(self.do_file.__usage__)
+                    return
+                self.ack()
+                body = agent.filemanager.save(path, cmd.args[2], resume=True)
             elif method == 'PUT':
                 if len(cmd.args) != 3:
                     self.print_usage(self.do_file.__usage__)
@@ -2239,6 +2293,13 @@ class CliHandler(socketserver.StreamRequestHandler):
                     return
                 self.ack()
                 body = agent.filemanager.sha256(path)
+            elif method == 'MANIFEST':
+                # path is a directory
+                if len(cmd.args) != 2:
+                    self.print_usage(self.do_file.__usage__)
+                    return
+                self.ack()
+                body = agent.filemanager.manifest(path)
             elif method == 'MOVE':
                 if len(cmd.args) != 3:
                     self.print_usage(self.do_file.__usage__)
@@ -2618,14 +2679,33 @@ class CliHandler(socketserver.StreamRequestHandler):
             return
         self.report_status(body)
 
-    @usage('sync')
+    @usage('keepalive')
+    def do_keepalive(self, cmd):
+        """Keep the connection open for more commands (used by pooled
+           clients).  The output of each command is then followed by a
+           line containing only '.'."""
+        if len(cmd.args):
+            self.print_usage(self.do_keepalive.__usage__)
+            return
+        self.keepalive = True
+        if self.request is not None:
+            self.request.settimeout(self.server.cli_keepalive_timeout)
+        self.ack()
+
+    @usage('sync [FORCE]')
     @upgrade_rwlock
     def do_sync(self, cmd):
-        """Synchronize Tableau tables."""
+        """Synchronize Tableau tables.
+           FORCE pulls every table even if its fingerprint is unchanged."""
 
-        if len(cmd.args) != 0:
+        if len(cmd.args) > 1:
             self.print_usage(self.do_sync.__usage__)
             return
+        if cmd.args:
+            if cmd.args[0].upper() != 'FORCE':
+                self.print_usage(self.do_sync.__usage__)
+                return
+            self.server.fingerprints.invalidate()
 
         agent = self.get_agent(cmd.dict)
         if not agent:
@@ -2645,7 +2725,7 @@ class CliHandler(socketserver.StreamRequestHandler):
         else:
             self.print_client("%s", json.dumps(body))
 
-    @usage('system <SET|GET|DELETE> <key> [value]')
+    @usage('system <SET|GET|DELETE> <key> [value] | system STATS')
     def do_system(self, cmd):
         """ Set or Delete a 'system' table entry for the current environment."""
         # pylint: disable=too-many-branches
@@ -2657,7 +2737,13 @@ class CliHandler(socketserver.StreamRequestHandler):
             return
 
         action = cmd.args[0].upper()
-        if action == 'SET':
+        if action == 'STATS':
+            if len(cmd.args) != 1:
+                self.print_usage(self.do_system.__usage__)
+                return
+            self.ack()
+            return self.report_status(self.server.system.stats())
+        elif action == 'SET':
             if len(cmd.args) != 3:
                 self.print_usage(self.do_system.__usage__)
                 return
@@ -2702,6 +2788,8 @@ class CliHandler(socketserver.StreamRequestHandler):
                 session.delete(entry)
             body['status'] = 'OK'
         session.commit()
+        if action != 'GET':
+            self.server.system.invalidate()
         return self.report_status(body)
 
     @usage('support-case [filename.zip]')
@@ -2966,6 +3054,9 @@ class CliHandler(socketserver.StreamRequestHandler):
         while True:
             try:
                 data = self.rfile.readline().strip()
+            except socket.timeout:
+                # An idle keep-alive connection: just close it.
+                break
             except socket.error as ex:
                 self.error(clierror.ERROR_SOCKET_DISCONNECTED,
                     "CliHandler: telnet socket failure/disconnect: " + str(ex))
@@ -2974,45 +3065,69 @@ class CliHandler(socketserver.StreamRequestHandler):
             if not data:
                 break
 
-            logger.debug("telnet command: '%s'", data)
-            stateman = self.server.state_manager
-            before_state = stateman.get_state()
+            self.handle_line(data)
+            if self.keepalive:
+                # Mark the end of the output of the command.
+                self.print_client(self.END_MARKER)
 
-            try:
-                cmd = Command(self.server, data)
-            except CommandException, ex:
-                self.error(clierror.ERROR_COMMAND_SYNTAX_ERROR, str(ex))
-                continue
-            except (SystemExit, KeyboardInterrupt, GeneratorExit):
-                raise
-            except BaseException:
-                self.handle_exception(before_state, data)
-                logger.error("Fatal: Exiting clihandler command " + \
-                             " parse '%s' on exception.", data)
-                # pylint: disable=protected-access
-                os._exit(91)
-
-            if not hasattr(self, 'do_'+cmd.name):
-                self.error(clierror.ERROR_NO_SUCH_COMMAND,
-                           'invalid command: %s', cmd.name)
-                continue
+    def handle_line(self, data):
+        logger.debug("telnet command: '%s'", data)
+        stateman = self.server.state_manager
+        before_state = stateman.get_state()
 
-            # <command> /displayname=X /type=..., /uuid=Y, /hostname=Z [args]
-            session = meta.Session()
-            try:
-                f = getattr(self, 'do_'+cmd.name)
-                f(cmd)
-            # fixme on exceptions: reset state?
-            except (SystemExit, KeyboardInterrupt, GeneratorExit):
-                raise
-            except exc.InvalidStateError, ex:
-                self.error(clierror.ERROR_WRONG_STATE, ex.message)
-            except BaseException:
-                self.handle_exception(before_state, data)
-                logger.error("Fatal: Exiting clihandler command " + \
-                             "'%s' on exception.", data)
-                # pylint: disable=protected-access
-                os._exit(92)
-            finally:
-                session.rollback()
-                meta.Session.remove()
+        try:
+            cmd = Command(self.server, data)
+        except CommandException, ex:
+            self.error(clierror.ERROR_COMMAND_SYNTAX_ERROR, str(ex))
+            return
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except BaseException:
+            self.handle_exception(before_state, data)
+            logger.error("Fatal: Exiting clihandler command " + \
+                         " parse '%s' on exception.", data)
+            # pylint: disable=protected-access
+            os._exit(91)
+
+        if not hasattr(self, 'do_'+cmd.name):
+            self.error(clierror.ERROR_NO_SUCH_COMMAND,
+                       'invalid command: %s', cmd.name)
+            return
+
+        # <command> /displayname=X /type=..., /uuid=Y, /hostname=Z [args]
+        session = meta.Session()
+        try:
+            f = getattr(self, 'do_'+cmd.name)
+            f(cmd)
+        # fixme on exceptions: reset state?
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except exc.InvalidStateError, ex:
+            self.error(clierror.ERROR_WRONG_STATE, ex.message)
+        except BaseException:
+            self.handle_exception(before_state, data)
+            logger.error("Fatal: Exiting clihandler command " + \
+                         "'%s' on exception.", data)
+            # pylint: disable=protected-access
+            os._exit(92)
+        finally:
+            session.rollback()
+            meta.Session.remove()
+
+
+class LocalCliHandler(CliHandler):
+    """Runs CLI command lines inside the controller process without a
+       telnet connection.  The output that would have been sent to the
+       client is returned as a list of lines."""
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, server, lines):
+        self.server = server
+        self.request = None
+        self.client_address = ('localhost', 0)
+        self.rfile = StringIO('\n'.join(lines) + '\n')
+        self.wfile = StringIO()
+
+    def run(self):
+        self.handle()
+        return self.wfile.getvalue().splitlines()
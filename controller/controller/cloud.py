@@ -218,6 +218,28 @@ class CloudManager(Manager):
             logging.error(msg)
             raise IOError(msg)
 
+    def _instance(self, cloud_entry):
+        if cloud_entry.cloud_type == CloudManager.CLOUD_TYPE_S3:
+            return self.s3
+        elif cloud_entry.cloud_type == CloudManager.CLOUD_TYPE_GCS:
+            return self.gcs
+        msg = "Unknown cloud_type %s for cloudid %d" % \
+              (cloud_entry.cloud_type, cloud_entry.cloudid)
+        logging.error(msg)
+        raise IOError(msg)
+
+    def connect(self, cloud_entry):
+        """Returns a boto connection to the cloud of 'cloud_entry'."""
+        return self._instance(cloud_entry).connect(cloud_entry)
+
+    def delete_cloud_files(self, cloud_entry, paths, conn=None):
+        """Delete several files from one cloud (bucket), over 'conn' if
+           given.  Returns (deleted, errors): the paths removed and a
+           dict of path -> reason for the others.
+           Note: Does not remove the entries from the files table."""
+        return self._instance(cloud_entry).delete_files(cloud_entry, paths,
+                                                        conn=conn)
+
     def download(self, agent, url, pwd=None):
         """
         Download the file pointed to by 'url' into the agent data-dir and
@@ -358,6 +380,25 @@ class CloudInstance(object):
     def delete_file(self, entry, path):
         pass
 
+    @abstractmethod
+    def connect(self, entry):
+        pass
+
+    @abstractmethod
+    def delete_files(self, entry, paths, conn=None):
+        pass
+
+    @classmethod
+    def _keys(cls, entry, paths):
+        """Returns the bucket name and a dict of key name -> path."""
+        bucket_name = entry.bucket
+        keys = {}
+        for path in paths:
+            bucket_name, filename = \
+                move_bucket_subdirs_to_path(entry.bucket, path)
+            keys[filename] = path
+        return bucket_name, keys
+
     # NOTE: no bucket_subdir, include it as part of the path.
     def get(self, agent, cloud_entry, path, pwd=None):
         cloud_info = CloudInfo.from_cloud_entry(cloud_entry, path)
@@ -450,13 +491,27 @@ class S3(CloudInstance):
 
     EXE = 'ps3'
 
+    def connect(self, entry):
+        """Returns a boto connection using the credentials of 'entry'.
+        If 's3_host' is set in the [controller] section, the connection
+        goes to that S3 compatible server instead of AWS."""
+        # fixme: use temporary token if configured for it
+        config = self.server.config
+        host = config.get('controller', 's3_host', default=None)
+        if not host:
+            return connection.S3Connection(entry.access_key,
+                                           entry.secret_key)
+        port = config.getint('controller', 's3_port', default=None)
+        secure = config.getboolean('controller', 's3_secure', default=True)
+        return connection.S3Connection(entry.access_key, entry.secret_key,
+                        host=host, port=port, is_secure=secure,
+                        calling_format=connection.OrdinaryCallingFormat())
+
     def delete_file(self, entry, path):
         # Move any bucket subdirectories to the filename
         bucket_name, filename = move_bucket_subdirs_to_path(entry.bucket, path)
 
-        # fixme: use temporary token if configured for it
-        secret = aes_decrypt(entry.secret)
-        conn = connection.S3Connection(entry.access_key, secret)
+        conn = self.connect(entry)
 
         bucket = connection.Bucket(conn, bucket_name)
 
@@ -472,6 +527,34 @@ class S3(CloudInstance):
         return {'status': 'OK'}
 
 
+    def delete_files(self, entry, paths, conn=None):
+        """Delete the files with multi-object delete requests (up to
+        1000 keys each) on one connection."""
+        bucket_name, keys = self._keys(entry, paths)
+        if not keys:
+            return [], {}
+        if conn is None:
+            conn = self.connect(entry)
+        bucket = connection.Bucket(conn, bucket_name)
+        try:
+            result = bucket.delete_keys(keys.keys())
+        except boto.exception.BotoServerError as ex:
+            raise IOError(
+                    ("Failed to delete %d files from S3 Cloud Storage " + \
+                    "bucket '%s'. %s: %s") % \
+                    (len(keys), bucket_name, ex.reason, ex.message))
+        deleted = [keys[obj.key] for obj in result.deleted \
+                                 if obj.key in keys]
+        errors = {}
+        for error in result.errors:
+            if error.key in keys:
+                errors[keys[error.key]] = \
+                    ("Failed to delete '%s' from S3 Cloud Storage " + \
+                     "bucket '%s'. %s: %s") % \
+                     (error.key, bucket_name, error.code, error.message)
+        return deleted, errors
+
+
 class GCS(CloudInstance):
 
     EXE = 'pgcs'
@@ -504,3 +587,40 @@ class GCS(CloudInstance):
                     "bucket '%s': %s") % \
                     (filename, bucket_name, str(ex)))
         return {'status': 'OK'}
+
+    def connect(self, entry):
+        return boto.connect_gs(entry.access_key, entry.secret_key)
+
+    def delete_files(self, entry, paths, conn=None):
+        """GCS has no multi-object delete (in boto): the objects are
+        deleted one after the other, but over the same connection."""
+        bucket_name, keys = self._keys(entry, paths)
+        if not keys:
+            return [], {}
+
+        if conn is None:
+            conn = self.connect(entry)
+        try:
+            bucket = conn.get_bucket(bucket_name)
+        except boto.exception.GSResponseError as ex:
+            raise IOError(
+                    ("Failed to delete %d files on Google Cloud Storage " + \
+                    "bucket '%s': %s") % \
+                    (len(keys), bucket_name, str(ex)))
+
+        deleted = []
+        errors = {}
+        for filename, path in keys.iteritems():
+            s3key = boto.s3.key.Key(bucket)
+            s3key.key = filename
+            try:
+                s3key.delete()
+            except boto.exception.BotoServerError as ex:
+                if ex.status != 404:
+                    errors[path] = \
+                        ("Failed to delete '%s' from Google Cloud Storage " + \
+                         "bucket '%s': %s") % \
+                         (filename, bucket_name, str(ex))
+                    continue
+            deleted.append(path)
+        return deleted, errors
@@ -0,0 +1,320 @@
+""" Parallel multipart upload of files on an agent to S3. """
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+import Queue
+from cStringIO import StringIO
+
+import boto
+from boto.s3.multipart import MultiPartUpload
+
+from cloud import CloudManager, move_bucket_subdirs_to_path
+from util import failed
+
+logger = logging.getLogger()
+
+class MultipartUpload(object):
+    """Uploads a file on an agent to S3 with the multipart API instead of
+       running 'ps3 PUT' on the agent after the file is complete.
+
+       The file is read from the agent in 'cloud_part_size' ranges which
+       a pool of 'cloud_upload_workers' threads upload in parallel, each
+       with its MD5 so a corrupted part is rejected.  A part that fails is
+       retried 'cloud_part_retries' times.  Before the upload is completed
+       the parts S3 has are listed and any part that is missing or
+       doesn't match is sent again, so a failure only costs the parts
+       involved, not the whole file.
+
+       After start(), parts are uploaded while the file is still being
+       written: a part is sent once the file has grown a full part past
+       it.  finish() is called when the writer is done.  The parts sent
+       early are checked (by MD5 on the agent) against the final file and
+       sent again if they changed, then the rest of the file is uploaded.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    MIN_PART_SIZE = 5 * 1024 * 1024     # the S3 minimum
+
+    def __init__(self, server, agent, entry, path, bucket_subdir=None):
+        # pylint: disable=too-many-arguments
+        self.server = server
+        self.agent = agent
+        self.entry = entry
+        self.path = path
+        self.s3 = server.cloud.s3
+
+        cloud_path = agent.path.basename(path)
+        if bucket_subdir:
+            cloud_path = os.path.join(bucket_subdir, cloud_path)
+        self.bucket_name, self.key_name = \
+                move_bucket_subdirs_to_path(entry.bucket, cloud_path)
+
+        config = server.config
+        self.part_size = max(config.getint('controller', 'cloud_part_size',
+                                           default=16) * 1024 * 1024,
+                             self.MIN_PART_SIZE)
+        self.workers = max(config.getint('controller',
+                                         'cloud_upload_workers',
+                                         default=4), 1)
+        self.retries = config.getint('controller', 'cloud_part_retries',
+                                     default=3)
+        self.interval = config.getint('controller', 'cloud_follow_interval',
+                                      default=10)
+
+        self.upload_id = None
+        # partnum -> (offset, length, md5 hexdigest) of the uploaded parts.
+        self.parts = {}
+        self.errors = []
+        self.lock = threading.Lock()
+        # Up to 'workers' parts wait here while the workers each hold
+        # one and the next one is read: about (2 * workers + 1) parts
+        # in memory, 144MB with the defaults.
+        self.queue = Queue.Queue(maxsize=self.workers)
+        self.threads = []
+        self.next_offset = 0
+        self.early_parts = 0
+        self.stopped = threading.Event()
+        self.follower = None
+
+    @classmethod
+    def enabled(cls, server, entry):
+        if entry.cloud_type != CloudManager.CLOUD_TYPE_S3:
+            # boto has no multipart support for GCS: pgcs is used.
+            return False
+        return server.config.getboolean('controller', 'cloud_multipart',
+                                        default=False)
+
+    def _bucket(self):
+        conn = self.s3.connect(self.entry)
+        return conn.get_bucket(self.bucket_name, validate=False)
+
+    def _multipart(self):
+        """A handle on the upload with its own connection so the
+           workers don't share one."""
+        mp = MultiPartUpload(self._bucket())
+        mp.key_name = self.key_name
+        mp.id = self.upload_id
+        return mp
+
+    def start(self, follow=True):
+        """Initiate the upload and start the workers (and, with 'follow',
+           uploading the file as it grows).  Raises IOError."""
+        try:
+            mp = self._bucket().initiate_multipart_upload(self.key_name)
+        except (boto.exception.BotoServerError,
+                boto.exception.BotoClientError, EnvironmentError) as ex:
+            raise IOError("Failed to start the upload of '%s' to " \
+                          "bucket '%s': %s" % \
+                          (self.key_name, self.bucket_name, str(ex)))
+        self.upload_id = mp.id
+        logger.debug("multipart upload of '%s' to '%s:%s' started, id %s",
+                     self.path, self.bucket_name, self.key_name,
+                     self.upload_id)
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        if follow:
+            self.follower = threading.Thread(target=self._follow)
+            self.follower.daemon = True
+            self.follower.start()
+
+    def _follow(self):
+        """Upload the complete parts of the file while it is written.
+           The last part_size bytes are left alone as they may not have
+           been written yet."""
+        while not self.stopped.wait(self.interval):
+            try:
+                body = self.agent.filemanager.filesize(self.path)
+                if failed(body):
+                    continue
+                self._read_parts(body['size'] - self.part_size)
+            except IOError as ex:
+                logger.debug("multipart upload follow '%s': %s",
+                             self.path, str(ex))
+
+    def _read_parts(self, end, final=False):
+        """Queue the parts from next_offset up to 'end'.  Only full parts
+           are queued unless 'final'."""
+        while not self.errors:
+            offset = self.next_offset
+            remaining = end - offset
+            if remaining <= 0 or (remaining < self.part_size and not final):
+                break
+            if self.stopped.is_set() and not final:
+                break
+            partnum = offset // self.part_size + 1
+            if partnum in self.parts:
+                # Sent while the file was written and unchanged since.
+                self.next_offset = offset + self.part_size
+                continue
+            data = self.agent.filemanager.read(self.path, offset,
+                                               self.part_size)
+            if not data:
+                break
+            self.queue.put((partnum, offset, data))
+            self.next_offset = offset + len(data)
+
+    def _upload_part(self, mp, partnum, offset, data):
+        md5 = hashlib.md5(data)
+        digest = (md5.hexdigest(), base64.b64encode(md5.digest()))
+        attempt = 0
+        while True:
+            try:
+                mp.upload_part_from_file(StringIO(data), partnum,
+                                         md5=digest, size=len(data))
+                break
+            except (boto.exception.BotoServerError,
+                    boto.exception.BotoClientError, EnvironmentError) as ex:
+                if attempt >= self.retries:
+                    raise IOError("part %d: %s" % (partnum, str(ex)))
+                logger.info("multipart upload '%s' part %d failed, " \
+                            "retrying: %s", self.key_name, partnum, str(ex))
+                attempt += 1
+                time.sleep(2 ** attempt)
+        with self.lock:
+            self.parts[partnum] = (offset, len(data), digest[0])
+
+    def _worker(self):
+        mp = None
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                if self.errors:
+                    continue
+                if mp is None:
+                    mp = self._multipart()
+                self._upload_part(mp, *item)
+            except IOError as ex:
+                logger.error("multipart upload of '%s' failed: %s",
+                             self.key_name, str(ex))
+                with self.lock:
+                    self.errors.append(str(ex))
+            finally:
+                self.queue.task_done()
+
+    def _stop(self):
+        self.stopped.set()
+        if self.follower:
+            self.follower.join()
+            self.follower = None
+
+    def _join(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _verify_early_parts(self, size):
+        """Drop the uploaded parts that don't match the final file."""
+        nparts = (size + self.part_size - 1) // self.part_size
+        for partnum in [x for x in self.parts if x > nparts]:
+            del self.parts[partnum]
+        if not self.parts:
+            return
+
+        partnums = sorted(self.parts)
+        ranges = [list(self.parts[x][:2]) for x in partnums]
+        body = self.agent.filemanager.checksums(self.path, ranges)
+        if failed(body):
+            raise IOError(body['error'])
+        for partnum, checksum in zip(partnums, body['checksums']):
+            if checksum != self.parts[partnum][2]:
+                logger.debug("multipart upload '%s': part %d changed",
+                             self.key_name, partnum)
+                del self.parts[partnum]
+
+    def _resume(self, mp, nparts):
+        """Upload again the parts S3 doesn't have or has wrong."""
+        stored = {}
+        for part in mp:
+            stored[part.part_number] = part.etag.strip('"')
+        for partnum in range(1, nparts + 1):
+            if partnum in self.parts and \
+                    stored.get(partnum) == self.parts[partnum][2]:
+                continue
+            offset = (partnum - 1) * self.part_size
+            logger.info("multipart upload '%s': resending part %d",
+                        self.key_name, partnum)
+            data = self.agent.filemanager.read(self.path, offset,
+                                               self.part_size)
+            self._upload_part(mp, partnum, offset, data)
+
+    def _complete(self, mp, nparts):
+        xml = '<CompleteMultipartUpload>'
+        for partnum in range(1, nparts + 1):
+            xml += '<Part><PartNumber>%d</PartNumber>' \
+                   '<ETag>"%s"</ETag></Part>' % \
+                   (partnum, self.parts[partnum][2])
+        xml += '</CompleteMultipartUpload>'
+        mp.bucket.complete_multipart_upload(self.key_name, self.upload_id,
+                                            xml)
+
+    def finish(self):
+        """Upload the rest of the (now complete) file and complete the
+           upload.  Returns a body like CloudInstance.put()."""
+        self._stop()
+        try:
+            body = self.agent.filemanager.filesize(self.path)
+            if failed(body):
+                raise IOError(body['error'])
+            size = body['size']
+            if not size:
+                raise IOError("'%s' is empty" % self.path)
+
+            # Wait for the parts already queued.
+            self.queue.join()
+            self._verify_early_parts(size)
+            self.early_parts = len(self.parts)
+            self.next_offset = 0
+            self._read_parts(size, final=True)
+            self._join()
+            if self.errors:
+                raise IOError(self.errors[0])
+
+            nparts = (size + self.part_size - 1) // self.part_size
+            mp = self._multipart()
+            self._resume(mp, nparts)
+            self._complete(mp, nparts)
+            # Complete: there is nothing left for cancel() to abort.
+            self.upload_id = None
+        except (boto.exception.BotoServerError,
+                boto.exception.BotoClientError, EnvironmentError) as ex:
+            self.cancel()
+            return {'error': "Multipart upload of '%s' to bucket '%s' " \
+                             "failed: %s" % \
+                             (self.key_name, self.bucket_name, str(ex))}
+
+        logger.info("multipart upload of '%s' to '%s:%s' done: " \
+                    "%d bytes, %d parts (%d sent during the write)",
+                    self.path, self.bucket_name, self.key_name,
+                    size, nparts, self.early_parts)
+        return {'status': 'OK',
+                'size': size,
+                'parts': nparts,
+                'early-parts': self.early_parts}
+
+    def cancel(self):
+        """Abort the upload, e.g. when the file couldn't be written."""
+        self._stop()
+        with self.lock:
+            self.errors.append('cancelled')
+        self._join()
+        if self.upload_id is None:
+            return
+        try:
+            self._multipart().cancel_upload()
+        except (boto.exception.BotoServerError,
+                boto.exception.BotoClientError, EnvironmentError) as ex:
+            logger.error("Failed to abort multipart upload %s of '%s': %s",
+                         self.upload_id, self.key_name, str(ex))
+        self.upload_id = None
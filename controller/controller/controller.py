@@ -26,7 +26,9 @@ from agentmanager import AgentManager
 from agent import Agent, AgentVolumesEntry
 from alert_email import AlertEmail
 from alert_setting import AlertSetting
+from archive_queue import ArchiveQueue
 from auth import AuthManager
+from cache import FingerprintCache
 from cli_cmd import CliCmd
 from cloud import CloudEntry
 from config import Config
@@ -70,6 +72,8 @@ from data_connections import DataConnection
 from place_file import PlaceFile
 from get_file import GetFile
 from cloud import CloudManager
+from cloud_upload import MultipartUpload
+from dedup_store import DedupManager
 
 from clihandler import CliHandler
 
@@ -151,35 +155,58 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         cmd = 'tabadmin backup \\\"%s\\\"' % backup_full_path
 
-        backup_start_time = time.time()
-        body = self.cli_cmd(cmd, agent, timeout=self.TIMEOUT_BACKUP)
-        backup_elapsed_time = time.time() - backup_start_time
-
-        if body.has_key('error'):
-            body['info'] = 'Backup command elapsed time before failure: %s' % \
-                            self.seconds_to_str(backup_elapsed_time)
-            return body
+        # With multipart uploads, the backup is sent to S3 while it is
+        # being written instead of afterwards.
+        upload = None
+        if dcheck.target_type == FileManager.STORAGE_TYPE_CLOUD and \
+                MultipartUpload.enabled(self, dcheck.target_entry):
+            upload = MultipartUpload(self, agent, dcheck.target_entry,
+                                     backup_full_path,
+                                     bucket_subdir=dcheck.parent_dir)
+            try:
+                upload.start()
+            except IOError as ex:
+                logger.error("backup_cmd: %s", str(ex))
+                upload = None
 
-        backup_size = 0
+        # Until PlaceFile has finished it, the upload is aborted however
+        # the backup fails, or S3 keeps (and charges for) its parts.
+        placed = False
         try:
-            backup_size_body = agent.filemanager.filesize(backup_full_path)
-        except IOError as ex:
-            logger.error("filemanager.filesize('%s') failed: %s",
-                         backup_full_path, str(ex))
-        else:
-            if not success(backup_size_body):
-                logger.error("Failed to get size of backup file '%s': %s",
-                             backup_full_path, backup_size_body['error'])
-            else:
-                backup_size = backup_size_body['size']
+            backup_start_time = time.time()
+            body = self.cli_cmd(cmd, agent, timeout=self.TIMEOUT_BACKUP)
+            backup_elapsed_time = time.time() - backup_start_time
+
+            if body.has_key('error'):
+                body['info'] = \
+                    'Backup command elapsed time before failure: %s' % \
+                    self.seconds_to_str(backup_elapsed_time)
+                return body
 
-        # If the target is not on the primary agent, then after the
-        # backup, it will be copied to either:
-        #   1) another agent
-        # or
-        #   2) cloud storage
-        place = PlaceFile(self, agent, dcheck, backup_full_path, backup_size,
-                          auto)
+            backup_size = 0
+            try:
+                backup_size_body = agent.filemanager.filesize(backup_full_path)
+            except IOError as ex:
+                logger.error("filemanager.filesize('%s') failed: %s",
+                             backup_full_path, str(ex))
+            else:
+                if not success(backup_size_body):
+                    logger.error("Failed to get size of backup file '%s': %s",
+                                 backup_full_path, backup_size_body['error'])
+                else:
+                    backup_size = backup_size_body['size']
+
+            # If the target is not on the primary agent, then after the
+            # backup, it will be copied to either:
+            #   1) another agent
+            # or
+            #   2) cloud storage
+            place = PlaceFile(self, agent, dcheck, backup_full_path,
+                              backup_size, auto, upload=upload)
+            placed = True
+        finally:
+            if upload and not placed:
+                upload.cancel()
 
         body['info'] = place.info
         if place.copy_failed:
@@ -289,7 +316,13 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
             logger.debug(info)
 
+        # Cloud files are deleted in batches per bucket, see
+        # FileManager.delfiles_cloud().
+        cloud_rows = []
         for entry in rows[:remove_count]:
+            if entry.storage_type == FileManager.STORAGE_TYPE_CLOUD:
+                cloud_rows.append(entry)
+                continue
             logger.debug("file_rotate: deleting %s file type " +
                          "%s name %s fileid %d", find_name, file_type,
                          entry.name, entry.fileid)
@@ -299,17 +332,24 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
             elif 'stderr' in body and len(body['stderr']):
                 info += '\n' + body['stderr']
             else:
-                if entry.storage_type == FileManager.STORAGE_TYPE_VOL:
-                    info += "\nRemoved %s" % entry.name
-                else:
-                    cloud_entry = self.cloud.get_by_cloudid(entry.storageid)
-                    if not cloud_entry:
-                        info += "\nfile_rotate: cloudid not found: %d" % \
-                                 entry.storageid
-                    else:
-                        info += "\nRemoved from %s bucket %s: %s" % \
-                                (cloud_entry.cloud_type, cloud_entry.bucket,
-                                 entry.name)
+                info += "\nRemoved %s" % entry.name
+
+        for result in self.files.delfiles_cloud(cloud_rows):
+            cloud_entry = result['cloud']
+            if not cloud_entry:
+                info += "\nfile_rotate: cloudid not found: %d" % \
+                        result['cloudid']
+                continue
+            for name in result['removed']:
+                info += "\nRemoved from %s bucket %s: %s" % \
+                        (cloud_entry.cloud_type, cloud_entry.bucket, name)
+            for error in result['errors']:
+                info += '\n' + error
+            info += ("\nRemoved %d %s file(s) from %s bucket %s " + \
+                     "in %.1f seconds.") % \
+                    (len(result['removed']), file_type,
+                     cloud_entry.cloud_type, cloud_entry.bucket,
+                     result['seconds'])
         return info
 
     def seconds_to_str(self, seconds):
@@ -819,12 +859,14 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         error_msg = ""
         sync_dict = {}
+        timing = []
 
         body = Site.sync(agent)
         if 'error' in body:
             error_msg += "Site sync failure: " + body['error']
         else:
             sync_dict['sites'] = body['count']
+            timing.append(body['sync'])
 
         body = Project.sync(agent)
         if 'error' in body:
@@ -833,6 +875,7 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
             error_msg += "Project sync failure: " + body['error']
         else:
             sync_dict['projects'] = body['count']
+            timing.append(body['sync'])
 
         body = DataConnection.sync(agent)
         if 'error' in body:
@@ -841,9 +884,11 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
             error_msg += "DataConnection sync failure: " + body['error']
         else:
             sync_dict['data-connections'] = body['count']
+            timing.append(body['sync'])
 
         if error_msg:
             sync_dict['error'] = error_msg
+        sync_dict['timing'] = timing
 
         if not 'status' in sync_dict:
             if 'error' in sync_dict:
@@ -1084,9 +1129,10 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def ping(self, agent):
         return self.send_immediate(agent, "POST", "/ping",
                                    {'cpu-monitored-processes': AlertSetting.get_monitored(AlertSetting.CPU),
-                            'memory-monitored-processes': AlertSetting.get_monitored(AlertSetting.MEMORY)})
+                            'memory-monitored-processes': AlertSetting.get_monitored(AlertSetting.MEMORY)},
+                                   priority=True)
 
-    def send_immediate(self, agent, method, uri, send_body=""):
+    def send_immediate(self, agent, method, uri, send_body="", priority=False):
         """Sends the request specified by:
                 agent:      agent to send to.
                 method:     POST, PUT, GET, etc.
@@ -1095,6 +1141,8 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
                             Can be a dictionary or a string.
                             If it is a dictionary, it will be converted
                             to a string (json).
+                priority:   Get the connection before other waiting
+                            requests (used for pings).
             Returns the body result.
         """
 
@@ -1110,7 +1158,7 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
                      agent.displayname, aconn.conn_id, agent.agent_type,
                      method, uri, send_body)
 
-        aconn.lock()
+        aconn.lock(priority=priority)
         body = {}
         try:
             aconn.httpconn.request(method, uri, send_body, headers)
@@ -1416,9 +1464,7 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
         #        for a primary; better, however, would be to store the
         #        uuid of the status with the status and riff off uuid.
         if not manager.agent_conn_by_type(AgentManager.AGENT_TYPE_PRIMARY):
-            session = meta.Session()
             self.statusmon.remove_all_status()
-            session.commit()
 
     def upgrade_version(self):
         """Make changes to the database, etc. as required for upgrading
@@ -1534,6 +1580,10 @@ def main():
 
     server.cli_get_status_interval = \
       config.getint('controller', 'cli_get_status_interval', default=10)
+    server.cli_status_wait = \
+      config.getint('controller', 'cli_status_wait', default=2)
+    server.cli_keepalive_timeout = \
+      config.getint('controller', 'cli_keepalive_timeout', default=300)
     server.noping = args.noping
     server.event_debug = config.getboolean('default',
                                            'event_debug',
@@ -1580,6 +1630,7 @@ def main():
 
     # Must be set before EventControlManager
     server.yml = YmlManager(server)
+    server.fingerprints = FingerprintCache()
 
     EventControl.populate_upgrade(server.previous_version, server.version)
     server.event_control = EventControlManager(server)
@@ -1593,12 +1644,20 @@ def main():
     server.datasources = DataSourceManager(server)
     server.files = FileManager(server)
     server.cloud = CloudManager(server)
+    server.dedup = DedupManager(server)
     server.firewall_manager = FirewallManager(server)
     server.license_manager = LicenseManager(server)
     server.state_manager = StateManager(server)
     server.package = Package()
     server.notifications = NotificationManager(server)
     server.metrics = MetricManager(server)
+    server.metrics.start()
+
+    server.archive_queue = ArchiveQueue(server)
+    server.archive_queue.register(WorkbookManager.NAME, server.workbooks)
+    server.archive_queue.register(DataSourceManager.NAME, server.datasources)
+    for kind in ExtractRefreshManager.KINDS:
+        server.archive_queue.register(kind, server.extract_archive)
 
     server.ports = PortManager(server)
     server.ports.populate()
@@ -1616,6 +1675,9 @@ def main():
     logger.debug("Starting agent listener.")
     manager.start()
 
+    # The archive workers need the agent manager for the primary agent.
+    server.archive_queue.start()
+
     # Need to instantiate to initialize state and status tables,
     # even if we don't run the status thread.
     statusmon = TableauStatusMonitor(server, manager)
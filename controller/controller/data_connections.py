@@ -1,5 +1,5 @@
 from sqlalchemy import Column, String, DateTime, Boolean, Integer, BigInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -40,6 +40,12 @@ class DataConnection(meta.Base, BaseMixin):
 
     @classmethod
     def sync(cls, agent):
+        # Skip the pull if the table hasn't changed since the last sync.
+        fingerprint = agent.odbc.fingerprint('data_connections')
+        if agent.server.fingerprints.unchanged(fingerprint):
+            return {u'status': 'OK', u'count': fingerprint.count,
+                    u'sync': fingerprint.todict()}
+
         stmt = 'SELECT * FROM data_connections'
 
         data = agent.odbc.execute(stmt)
@@ -49,26 +55,13 @@ class DataConnection(meta.Base, BaseMixin):
             data['error'] = "Missing '' key in query response."
             return data
 
-        ids = []
-
         envid = agent.server.environment.envid
 
-        session = meta.Session()
-        for odbcdata in ODBC.load(data):
-            tid = odbcdata.data['id']
-            entry = DataConnection.get(envid, tid, default=None)
-            if not entry:
-                entry = DataConnection(envid=envid)
-                session.add(entry)
-            entry.envid = envid
-            odbcdata.copyto(entry)
-            ids.append(entry.dcid)
-
-        session.query(DataConnection).\
-            filter(not_(DataConnection.dcid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
+        rows = [odbcdata.data for odbcdata in ODBC.load(data)]
+        sync = cls.bulk_sync(envid, ['id'], rows, delete=True)
+        meta.Session.commit()
+        agent.server.fingerprints.save(fingerprint)
 
-        d = {u'status': 'OK', u'count': len(data[''])}
+        d = {u'status': 'OK', u'count': len(data['']),
+             u'sync': sync.todict()}
         return d
@@ -9,13 +9,13 @@ from sqlalchemy import func, or_
 
 import akiri.framework.sqlalchemy as meta
 
-from odbc import ODBC
 
 from archive_mixin import ArchiveUpdateMixin, ArchiveException, ArchiveError
 from mixin import BaseMixin, BaseDictMixin
 from cache import TableauCacheManager #FIXME
 from manager import synchronized
 from util import failed
+from revision_store import RevisionStore
 from .system import SystemKeys
 
 from diskcheck import DiskCheck, DiskException
@@ -123,7 +123,11 @@ class DataSourceUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     system_user_id = Column(Integer)
     url = Column(String)  # FIXME: make this unique.
     note = Column(String)
-    tds = deferred(Column(Text))    # the contents of the .tds file
+    # The contents of the .tds file for revisions archived before the
+    # revision store: see DataSourceManager.migrate_tds().
+    tds = deferred(Column(Text))
+
+    store = RevisionStore('datasource', 'datasource_updates', 'dsuid')
 
     # NOTE: system_user_id is not a foreign key to avoid load dependencies.
 
@@ -147,6 +151,13 @@ class DataSourceUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     def get_by_url(cls, url, **kwargs):
         return cls.get_unique_by_keys({'url': url}, **kwargs)
 
+    def get_tds(self):
+        """Returns the contents of the .tds file or None."""
+        contents = self.store.get(self.dsuid)
+        if contents is None:
+            contents = self.tds
+        return contents
+
 class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
     NAME = 'datasource'
     PCMD = 'ptdsx'
@@ -181,20 +192,18 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
         if last_updated_at:
             stmt += " WHERE t1.updated_at > '" + last_updated_at + "'"
 
-        data = agent.odbc.execute(stmt)
+        cursor = agent.odbc.cursor(stmt)
 
         updates = []
 
-        if 'error' in data or '' not in data:
-            logger.debug("datasources load: bad data: %s", str(data))
-            return data
-
-        logger.debug(data)
+        if cursor.error:
+            logger.debug("datasources load: bad data: %s", cursor.error)
+            return {u'error': cursor.error}
 
         # Get users only if needed
         users = None
 
-        for odbcdata in ODBC.load(data):
+        for odbcdata in cursor:
             name = odbcdata.data['name']
             revision = odbcdata.data['revision']
             site_id = odbcdata.data['site_id']
@@ -216,8 +225,8 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
             system_user_id = users.get(dse.site_id, dse.owner_id)
             dse.system_user_id = system_user_id
 
-            # must commit here so that update foreign keys work.
-            session.commit()
+            # flush here so that update foreign keys work.
+            session.flush()
 
             dsu = DataSourceUpdateEntry.get(dse.dsid,
                                           revision,
@@ -230,11 +239,17 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                                           timestamp=dse.updated_at,
                                           url='')
                 session.add(dsu)
-                updates.append(dsu)
+                session.flush()
+                updates.append(dsu.dsuid)
 
             logger.debug("datasource update '%s', revision %s",
                             name, revision)
 
+        # Nothing is committed unless every page was read: the most recent
+        # 'updated_at' is where the next load starts.
+        if cursor.error:
+            session.rollback()
+            return {u'error': cursor.error}
         session.commit()
 
         prune_count = self._prune_missed_revisions()
@@ -246,10 +261,10 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
             result = {u'error':
                       'Can not load datasources: missing credentials.'}
         else:
-            # Second pass - build the archive files.
-            result = self._archive_updates(agent, updates)
+            # Second pass - the archive workers build the archive files.
+            result = self._queue_updates(updates)
 
-        result[u'schema'] = self.schema(data)
+        result[u'schema'] = self.schema(cursor.schema_data)
         result[u'updates-new'] = len(updates)
         result[u'updates-missed'] = prune_count
 
@@ -316,6 +331,7 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                     all()
 
             for row in rows:
+                DataSourceUpdateEntry.store.remove([row.dsuid])
                 # We have to remove the DataSourceUpdateEntry first
                 # due to the foreign key constraint in files pointing to it.
                 session.query(DataSourceUpdateEntry).\
@@ -330,10 +346,24 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                 # Fixme: We could increment only if it successfully deleted.
                 removed_count += 1
 
+        # Contents of datasources that were deleted altogether.
+        DataSourceUpdateEntry.store.prune()
+
         return removed_count
 
+    @synchronized('datasource.migrate')
+    def migrate_tds(self):
+        """Convert the .tds contents stored in datasource_updates.tds
+           to the compressed revision store."""
+        count = DataSourceUpdateEntry.store.migrate(DataSourceUpdateEntry,
+                                                    'dsid', 'tds')
+        result = DataSourceUpdateEntry.store.stats()
+        result[u'migrated'] = count
+        return result
+
     @synchronized('datasource.fixup')
     def fixup(self, agent):
+        # pylint: disable=unused-argument
         if not self.system[SystemKeys.DATASOURCE_RETAIN_COUNT]:
             logger.debug("Datasource archives are disabled. Fixup not done.")
             return {u'disabled':
@@ -342,73 +372,61 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
         session = meta.Session()
 
         # potentially serveral thousand?
-        updates = session.query(DataSourceUpdateEntry).\
-                  filter(or_(DataSourceUpdateEntry.url == "",
-                         DataSourceUpdateEntry.url == None)).\
-                         all()
-
-        return self._archive_updates(agent, updates)
-
-    def _archive_updates(self, agent, updates):
-        """Attempt to archive datasources from DataSourceUpdate rows."""
-
-        session = meta.Session()
-
-        count = 0
+        rows = session.query(DataSourceUpdateEntry.dsuid).\
+               filter(or_(DataSourceUpdateEntry.url == "",
+                      DataSourceUpdateEntry.url == None)).\
+                      all()
+
+        return self._queue_updates([row[0] for row in rows])
+
+    def _queue_updates(self, dsuids):
+        """Queue DataSourceUpdate rows for the archive workers."""
+        count = self.server.archive_queue.add(self.NAME, dsuids)
+        logger.debug("Datasource Archive update count: %d, newly queued: %d",
+                     len(dsuids), count)
+        return {u'status': 'OK',
+                u'updates-queued': count}
 
-        logger.debug("Datasource Archive update count: %d", len(updates))
+    def archive_enabled(self, kind):
+        # pylint: disable=unused-argument
+        """Called by the ArchiveQueue before starting an update."""
+        if not self.system[SystemKeys.DATASOURCE_RETAIN_COUNT]:
+            return False
+        return bool(self.cred_check())
 
-        for update in updates:
-            if not self.system[SystemKeys.DATASOURCE_RETAIN_COUNT]:
-                logger.info(
-                          "Datasource Archive disabled during fixup." + \
-                          "  Exiting for now.")
-                break
+    def archive_item(self, agent, job):
+        """Archive one DataSourceUpdate row for the ArchiveQueue.
+           Returns True when the update is archived or no longer exists,
+           False if it should be tried again and None if it can't be
+           tried yet."""
+        # If the ptdsx.exe doens't exist, hold off until it's there.
+        if not self._have_pcmd(agent):
+            return None
 
-            if not self.server.odbc_ok():
-                logger.info("Datasource Archive Fixup: Archive build " + \
-                          "stopping due to current state")
-                break
+        update = DataSourceUpdateEntry.get_by_id(job.itemid, default=None)
+        if update is None or update.url:
+            return True
 
-            logger.debug("Datasource Archive update refresh dsid %d",
-                           update.dsid)
+        logger.debug("Datasource Archive update dsid %d", update.dsid)
+        self._archive_ds(agent, update, job)
 
-            session.refresh(update)
-            try:
-                self._archive_ds(agent, update)
-            except ArchiveException as ex:
-                if ex.value == ArchiveError.BAD_CREDENTIALS:
-                    msg = "datasource _archive_updates: tabcmd failed due " + \
-                          "to bad credentials. " + \
-                          "Skipping any remaining datasource updates now."
-                    logger.info(msg)
-                    break
-                else:
-                    raise   # should never happen
-            count += 1
-
-        # Retain only configured number of versions
-        if count:
-            retain_removed_count = self._retain_some()
-        else:
-            retain_removed_count = 0
+        # The row is removed if the datasource was deleted from Tableau.
+        update = DataSourceUpdateEntry.get_by_id(job.itemid, default=None)
+        return update is None or bool(update.url)
 
-        return {u'status': 'OK',
-                u'updates-archived': count,
-                u'retain-removed-count': retain_removed_count}
+    def archive_retain(self, kind):
+        # pylint: disable=unused-argument
+        """Retain only configured number of versions."""
+        return self._retain_some()
 
     # Archive the data source, set the url, etc.
-    def _archive_ds(self, agent, update):
-        # If the ptdsx.exe doens't exist, hold off until it's there.
-        if not self._have_pcmd(agent):
-            return None
-
+    def _archive_ds(self, agent, update, job):
         # Cache these as they may no longer be available if _build_tds
         # fails.
         repository_url = update.datasource.repository_url
         revision = update.revision
 
-        filename = self._build_tds(agent, update)
+        filename = self._build_tds(agent, update, job)
         if not filename:
             # Generates an event on error.
             logger.error('Failed to retrieve tdsx: %s %s', repository_url,
@@ -434,7 +452,8 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
         return True
 
     # returns the filename *on the agent* or None on error.
-    def _build_tds(self, agent, update):
+    # job.stage is updated as each step starts.
+    def _build_tds(self, agent, update, job):
         # pylint: disable=too-many-return-statements
         # pylint: disable=too-many-branches
         try:
@@ -446,6 +465,7 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
             return None
 
         tmpdir = dcheck.primary_dir
+        job.stage = 'download'
         dst = self._tabcmd_get(agent, update, tmpdir)
         if dst is None:
             # _tabcmd_get generates an event on failure.
@@ -457,6 +477,7 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
             self._eventgen(update, error=str(ex))
             return None
 
+        job.stage = 'extract'
         if file_type == 'zip':
             dst_tds = self._extract_tds_from_tdsx(agent, update, dst)
             if not dst_tds:
@@ -474,9 +495,11 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
         # Pull the tds file contents over to the controller before sending the
         # file away (and deleting it on the primary if it will reside
         # elsewhere).
+        job.stage = 'ingest'
         if not self._copy_tds_to_controller(agent, update, dst_tds):
             return None
 
+        job.stage = 'place'
         place = self.archive_file(agent, dcheck, dst_tds)
         update.fileid_tds = place.placed_file_entry.fileid
 
@@ -585,7 +608,7 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                                                                 str(ex))
             return None
 
-        update.tds = contents
+        DataSourceUpdateEntry.store.put(update.dsuid, update.dsid, contents)
         return True
 
     # Generate an event in case of a failure.
@@ -0,0 +1,401 @@
+""" Deduplicating, content-addressed storage of backups on archive agents. """
+import hashlib
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, func
+from sqlalchemy.schema import ForeignKey
+
+import akiri.framework.sqlalchemy as meta
+
+from agent import AgentVolumesEntry
+from files import FileManager
+from manager import Manager
+from util import failed, sizestr
+
+logger = logging.getLogger()
+
+class DedupChunkEntry(meta.Base):
+    """A unique chunk stored on an archive volume and the number of
+       stored backups that reference it."""
+    # pylint: disable=no-init
+    __tablename__ = 'dedup_chunks'
+
+    volid = Column(Integer, primary_key=True)
+    hash = Column(String, primary_key=True)     # sha256 of the contents
+    size = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    creation_time = Column(DateTime, server_default=func.now())
+
+
+class DedupFileEntry(meta.Base):
+    """A backup kept in the chunk store of a volume instead of as a file.
+       Its files row has the name the backup would have on the volume."""
+    # pylint: disable=no-init
+    __tablename__ = 'dedup_files'
+
+    fileid = Column(Integer, ForeignKey("files.fileid"), primary_key=True)
+    volid = Column(Integer, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    sha256 = Column(String, nullable=False)     # of the whole file
+    # The size of the chunks this backup added to the volume.
+    stored_size = Column(BigInteger, nullable=False)
+    chunks = Column(Integer, nullable=False)
+    creation_time = Column(DateTime, server_default=func.now())
+
+
+class DedupFileChunkEntry(meta.Base):
+    """The chunks of a stored backup, in order."""
+    # pylint: disable=no-init
+    __tablename__ = 'dedup_file_chunks'
+
+    fileid = Column(Integer, primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    hash = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+
+
+class DedupManager(Manager):
+    """Stores backups copied to an archive agent as content-defined chunks
+       (computed by the primary agent) named by their sha256.  A chunk
+       already on the volume is not sent again: consecutive backups share
+       most of their chunks, so only the changed parts are transferred
+       and stored.  Chunks are reference counted and deleted from the
+       volume when the last backup using them is removed.
+
+       Enabled with 'backup_dedup' in the [controller] section; backups
+       stored this way are still restored and removed when it is off.
+    """
+
+    CHUNK_DIR = 'backup-chunks'
+    BATCH_SIZE = 1000
+
+    def __init__(self, server):
+        super(DedupManager, self).__init__(server)
+        config = server.config
+        self.enabled = config.getboolean('controller', 'backup_dedup',
+                                         default=False)
+        self.avg_size = config.getint('controller', 'dedup_chunk_size',
+                                      default=1024) * 1024
+
+    @classmethod
+    def chunk_path(cls, agent, vol_entry, digest):
+        # fixme: agent.path... (see DiskCheck)
+        chunk_dir = vol_entry.full_path() + "\\" + cls.CHUNK_DIR
+        return agent.path.join(chunk_dir, digest[:2], digest)
+
+    def _connected(self, agentid):
+        agent = self.server.agentmanager.agent_by_id(agentid)
+        if not agent:
+            raise IOError("Agentid %d not connected." % agentid)
+        return agent
+
+    def get(self, fileid):
+        return meta.Session.query(DedupFileEntry).\
+            filter(DedupFileEntry.fileid == fileid).\
+            first()
+
+    def _existing(self, volid, digests):
+        """The subset of 'digests' already stored on the volume."""
+        digests = list(digests)
+        found = set()
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            rows = meta.Session.query(DedupChunkEntry.hash).\
+                filter(DedupChunkEntry.volid == volid).\
+                filter(DedupChunkEntry.hash.in_(\
+                                        digests[i:i + self.BATCH_SIZE])).\
+                all()
+            found.update(row[0] for row in rows)
+        return found
+
+    def _addref(self, volid, digests, delta):
+        digests = list(digests)
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            meta.Session.query(DedupChunkEntry).\
+                filter(DedupChunkEntry.volid == volid).\
+                filter(DedupChunkEntry.hash.in_(\
+                                        digests[i:i + self.BATCH_SIZE])).\
+                update({DedupChunkEntry.refcount: \
+                            DedupChunkEntry.refcount + delta},
+                       synchronize_session=False)
+
+    def _send_chunks(self, agent, full_path, target, vol_entry, chunks,
+                     sent):
+        """Copy the given chunks {digest: (offset, length)} of the file
+           on the primary to the volume.  The digest of each chunk copied
+           is appended to 'sent'."""
+        # pylint: disable=too-many-arguments
+        dirs = set()
+        for digest, (offset, length) in chunks.iteritems():
+            data = agent.filemanager.read(full_path, offset, length)
+            if len(data) != length or \
+                    hashlib.sha256(data).hexdigest() != digest:
+                raise IOError("'%s' changed while it was stored." % \
+                              full_path)
+            path = self.chunk_path(target, vol_entry, digest)
+            dirname = target.path.dirname(path)
+            if dirname not in dirs:
+                body = target.filemanager.mkdirs(dirname)
+                if failed(body):
+                    raise IOError(body['error'])
+                dirs.add(dirname)
+            body = target.filemanager.put(path, data)
+            if failed(body):
+                raise IOError(body['error'])
+            sent.append(digest)
+
+    def _discard(self, target, vol_entry, digests):
+        """Delete chunks that were sent for a file that wasn't stored:
+           nothing references them."""
+        for digest in digests:
+            path = self.chunk_path(target, vol_entry, digest)
+            try:
+                target.filemanager.delete(path)
+            except IOError as ex:
+                logger.info("dedup: delete '%s' on '%s' failed: %s",
+                            path, target.displayname, str(ex))
+
+    def store(self, agent, full_path, vol_entry, name, file_type, auto):
+        """Store the file 'full_path' on the primary 'agent' in the chunk
+           store of 'vol_entry' and add it to the files table as 'name'.
+           Returns a body with the new 'file-entry' and the 'chunks',
+           'new-chunks', 'size' and 'stored-size', or an 'error'."""
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-locals
+        self.lock()
+        try:
+            sent = []
+            try:
+                body = agent.filemanager.chunks(full_path,
+                                                avg_size=self.avg_size)
+                if failed(body):
+                    raise IOError(body['error'])
+                chunks = body['chunks']
+                size = body['size']
+                sha256 = body['sha256']
+
+                existing = self._existing(vol_entry.volid,
+                                          set(c[2] for c in chunks))
+                new = OrderedDict()
+                for offset, length, digest in chunks:
+                    if digest not in existing and digest not in new:
+                        new[digest] = (offset, length)
+
+                target = self._connected(vol_entry.agentid)
+                self._send_chunks(agent, full_path, target, vol_entry, new,
+                                  sent)
+            except IOError as ex:
+                if sent:
+                    self._discard(target, vol_entry, sent)
+                return {'error': "Deduplicated copy of '%s' failed: %s" % \
+                                 (full_path, str(ex))}
+
+            stored_size = sum(length for _, length in new.itervalues())
+
+            # The files row and the dedup rows are one transaction: a
+            # failure leaves neither, and the chunks just sent are removed.
+            session = meta.Session()
+            committed = False
+            try:
+                file_entry = self.server.files.add(
+                    name, file_type, FileManager.STORAGE_TYPE_VOL,
+                    vol_entry.volid, size=size, auto=auto, commit=False)
+                fileid = file_entry.fileid
+
+                if new:
+                    session.execute(DedupChunkEntry.__table__.insert(),
+                                    [{'volid': vol_entry.volid,
+                                      'hash': digest, 'size': length,
+                                      'refcount': 0} \
+                                     for digest, (_, length) \
+                                     in new.iteritems()])
+                if chunks:
+                    session.execute(DedupFileChunkEntry.__table__.insert(),
+                                    [{'fileid': fileid, 'seq': seq,
+                                      'hash': digest, 'size': length} \
+                                     for seq, (_, length, digest) \
+                                     in enumerate(chunks)])
+                session.add(DedupFileEntry(fileid=fileid,
+                                           volid=vol_entry.volid,
+                                           size=size, sha256=sha256,
+                                           stored_size=stored_size,
+                                           chunks=len(chunks)))
+                self._addref(vol_entry.volid, set(c[2] for c in chunks), 1)
+                session.commit()
+                committed = True
+            finally:
+                if not committed:
+                    session.rollback()
+                    self._discard(target, vol_entry, sent)
+        finally:
+            self.unlock()
+
+        logger.info("dedup: stored '%s' as '%s' on volid %d: " + \
+                    "%d chunks, %d new, %s of %s stored",
+                    full_path, name, vol_entry.volid, len(chunks), len(new),
+                    sizestr(stored_size), sizestr(size))
+        return {'file-entry': file_entry,
+                'chunks': len(chunks),
+                'new-chunks': len(new),
+                'size': size,
+                'stored-size': stored_size}
+
+    def restore(self, file_entry, agent, path):
+        """Rebuild a stored backup as 'path' on 'agent' and check that
+           its size and sha256 are the ones of the original.
+           Raises IOError."""
+        dedup_entry = self.get(file_entry.fileid)
+        if not dedup_entry:
+            raise IOError("fileid %d is not in the dedup store" % \
+                          file_entry.fileid)
+        vol_entry = AgentVolumesEntry.get_vol_entry_by_volid(\
+                                                        dedup_entry.volid)
+        if not vol_entry:
+            raise IOError("volid not found: %d" % dedup_entry.volid)
+        source = self._connected(vol_entry.agentid)
+
+        rows = meta.Session.query(DedupFileChunkEntry.hash,
+                                  DedupFileChunkEntry.size).\
+            filter(DedupFileChunkEntry.fileid == file_entry.fileid).\
+            order_by(DedupFileChunkEntry.seq).\
+            all()
+
+        offset = 0
+        for digest, size in rows:
+            chunk_path = self.chunk_path(source, vol_entry, digest)
+            data = source.filemanager.read(chunk_path, 0, size)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise IOError("chunk %s of '%s' on agent '%s' is damaged" % \
+                              (digest, file_entry.name, source.displayname))
+            # The first chunk replaces any previous copy.
+            body = agent.filemanager.put(path, data, offset=offset or None)
+            if failed(body):
+                raise IOError(body['error'])
+            offset += size
+
+        body = agent.filemanager.filesize(path)
+        if failed(body):
+            raise IOError(body['error'])
+        if body['size'] != dedup_entry.size:
+            raise IOError("'%s' rebuilt with %d bytes instead of %d" % \
+                          (file_entry.name, body['size'], dedup_entry.size))
+        body = agent.filemanager.sha256(path)
+        if failed(body):
+            raise IOError(body['error'])
+        if body['hash'] != dedup_entry.sha256:
+            raise IOError("'%s' rebuilt with sha256 %s instead of %s" % \
+                          (file_entry.name, body['hash'],
+                           dedup_entry.sha256))
+        logger.debug("dedup: rebuilt '%s' as '%s' on '%s' from %d chunks",
+                     file_entry.name, path, agent.displayname, len(rows))
+
+    def remove(self, file_entry):
+        """Remove a stored backup.  Its chunks lose a reference and the
+           ones no backup uses anymore are deleted from the volume.
+           The files row is left to the caller."""
+        self.lock()
+        try:
+            dedup_entry = self.get(file_entry.fileid)
+            if not dedup_entry:
+                return {}
+            volid = dedup_entry.volid
+
+            session = meta.Session()
+            rows = session.query(DedupFileChunkEntry.hash).\
+                filter(DedupFileChunkEntry.fileid == file_entry.fileid).\
+                distinct().\
+                all()
+            self._addref(volid, [row[0] for row in rows], -1)
+            session.query(DedupFileChunkEntry).\
+                filter(DedupFileChunkEntry.fileid == file_entry.fileid).\
+                delete(synchronize_session=False)
+            session.delete(dedup_entry)
+            session.commit()
+            return self._collect(volid)
+        finally:
+            self.unlock()
+
+    def _collect(self, volid):
+        """Delete the chunks of the volume that are no longer referenced.
+           If the agent isn't connected, they are kept until the next
+           time."""
+        rows = meta.Session.query(DedupChunkEntry.hash).\
+            filter(DedupChunkEntry.volid == volid).\
+            filter(DedupChunkEntry.refcount <= 0).\
+            all()
+        if not rows:
+            return {}
+        vol_entry = AgentVolumesEntry.get_vol_entry_by_volid(volid)
+        if not vol_entry:
+            return {}
+        try:
+            agent = self._connected(vol_entry.agentid)
+        except IOError as ex:
+            logger.info("dedup: %d unused chunks on volid %d kept: %s",
+                        len(rows), volid, str(ex))
+            return {}
+
+        digests = [row[0] for row in rows]
+        for digest in digests:
+            path = self.chunk_path(agent, vol_entry, digest)
+            try:
+                agent.filemanager.delete(path)
+            except IOError as ex:
+                # Most likely already gone.
+                logger.info("dedup: delete '%s' on '%s' failed: %s",
+                            path, agent.displayname, str(ex))
+
+        session = meta.Session()
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            session.query(DedupChunkEntry).\
+                filter(DedupChunkEntry.volid == volid).\
+                filter(DedupChunkEntry.hash.in_(\
+                                        digests[i:i + self.BATCH_SIZE])).\
+                filter(DedupChunkEntry.refcount <= 0).\
+                delete(synchronize_session=False)
+        session.commit()
+        logger.debug("dedup: removed %d chunks from volid %d",
+                     len(digests), volid)
+        return {'removed-chunks': len(digests)}
+
+    def expected_growth(self, volid, count=3):
+        """The most one of the last 'count' backups added to the volume,
+           i.e. about what the next one will need, or None if there
+           are none."""
+        rows = meta.Session.query(DedupFileEntry.stored_size).\
+            filter(DedupFileEntry.volid == volid).\
+            order_by(DedupFileEntry.creation_time.desc()).\
+            limit(count).\
+            all()
+        if not rows:
+            return None
+        return max(row[0] for row in rows)
+
+    def stats(self):
+        """The size of the stored backups and of their chunks per volume."""
+        session = meta.Session()
+        volumes = {}
+        for volid, count, size in \
+                session.query(DedupFileEntry.volid, func.count(),
+                              func.sum(DedupFileEntry.size)).\
+                group_by(DedupFileEntry.volid):
+            volumes[volid] = {'volid': volid, 'backups': count,
+                              'size': int(size or 0), 'chunks': 0,
+                              'stored-size': 0}
+        for volid, count, size in \
+                session.query(DedupChunkEntry.volid, func.count(),
+                              func.sum(DedupChunkEntry.size)).\
+                group_by(DedupChunkEntry.volid):
+            data = volumes.setdefault(volid, {'volid': volid, 'backups': 0,
+                                              'size': 0})
+            data['chunks'] = count
+            data['stored-size'] = int(size or 0)
+
+        for data in volumes.itervalues():
+            if data['stored-size']:
+                data['ratio'] = '%.1f' % \
+                                (float(data['size']) / data['stored-size'])
+            data['size'] = sizestr(data['size'])
+            data['stored-size'] = sizestr(data['stored-size'])
+        return {'enabled': self.enabled,
+                'volumes': [volumes[x] for x in sorted(volumes)]}
@@ -149,28 +149,37 @@ class DiskCheck(object):
                                 "agent '%s': agent is disabled.") % \
                                 target_agent.displayname)
 
+        # A deduplicated backup only adds its new chunks to the volume:
+        # expect about as much as the last few did.
+        needed = self.min_disk_needed
+        if self.file_type == FileManager.FILE_TYPE_BACKUP and \
+                self.server.dedup.enabled and \
+                target_agent.agentid != self.agent.agentid:
+            needed = max(needed,
+                         self.server.dedup.expected_growth(entry.volid) or 0)
+
         # Check to see if this volume has enough available disk space.
-        if entry.available_space < self.min_disk_needed:
+        if entry.available_space < needed:
             raise DiskException(
                 ("Not enough available space on '%s' volume '%s' volid %d: " + \
                  "Available space: " +
                 "%s, needed: %s") % \
                         (target_agent.displayname,
                         entry.name, entry.volid, sizestr(entry.available_space),
-                        sizestr(self.min_disk_needed)))
+                        sizestr(needed)))
 
         # Check if the backup/ziplog would use more disk space than is allowed
         # by the "archive_limit" in the volume entry.
-        if entry.size - entry.available_space + self.min_disk_needed > \
+        if entry.size - entry.available_space + needed > \
                                                     entry.archive_limit:
             raise DiskException(
                 ("Minimum space needed greater than archive limit." + \
                 "volid: %d. Need: %s. Size: %s. With vol would have: %s. " + \
                 "Allowed/archive limit: %s. Volume name: %s. " + \
                 "Volume label: %s. Volume available: %s") % \
-                (entry.volid, sizestr(self.min_disk_needed),
+                (entry.volid, sizestr(needed),
                 sizestr(entry.size), sizestr(entry.size - \
-                    entry.available_space + self.min_disk_needed),
+                    entry.available_space + needed),
                 sizestr(entry.archive_limit), entry.name,
                 entry.label, sizestr(entry.available_space)))
 
@@ -199,7 +208,7 @@ class DiskCheck(object):
                      "archive limit %s",
                      self.target_agent.displayname, entry.volid,
                      self.target_dir, self.primary_dir,
-                     sizestr(self.min_disk_needed),
+                     sizestr(needed),
                      sizestr(entry.available_space),
                      sizestr(entry.size), sizestr(entry.archive_limit))
 
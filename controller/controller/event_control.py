@@ -3,6 +3,8 @@ import sys
 import traceback
 import datetime
 import re
+import threading
+import Queue
 
 from mako.template import Template
 from mako import exceptions
@@ -287,6 +289,17 @@ class EventControl(meta.Base, BaseMixin, BaseDictMixin):
 
 
 class EventControlManager(Manager):
+    """Events are queued by gen() and written, rendered and emailed by a
+       small pool of worker threads so the callers (ping, status checks,
+       loaders) don't wait for the database or for SMTP."""
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_QUEUE_SIZE = 10000
+
+    # Generated synchronously: the controller exits right after these.
+    SYNC_KEYS = [EventControl.SYSTEM_EXCEPTION]
+
+    EVENTID_STMT = "SELECT nextval('events_eventid_seq')"
 
     def __init__(self, server):
         super(EventControlManager, self).__init__(server)
@@ -294,6 +307,40 @@ class EventControlManager(Manager):
         self.indented = self.alert_email.indented
         self.envid = server.environment.envid
 
+        # (key, event_description) -> compiled mako Template
+        self.templates = {}
+
+        size = server.config.getint('controller', 'event_queue_size',
+                                    default=self.DEFAULT_QUEUE_SIZE)
+        self.queue = Queue.Queue(maxsize=size)
+        workers = server.config.getint('controller', 'event_workers',
+                                       default=self.DEFAULT_WORKERS)
+        for _ in xrange(max(workers, 1)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            args = self.queue.get()
+            try:
+                self._gen(*args)
+            except StandardError:
+                logger.exception("event: generate failed for '%s', "
+                                 "data: %s", args[0], str(args[1]))
+            finally:
+                meta.Session.remove()
+
+    def template(self, key, event_description):
+        """Return the compiled template, compiling it only once per
+           event key (and description, which can be edited)."""
+        cache_key = (key, event_description)
+        mako_template = self.templates.get(cache_key)
+        if mako_template is None:
+            mako_template = Template(event_description, default_filters=['h'])
+            self.templates[cache_key] = mako_template
+        return mako_template
+
     def get_event_control_entry(self, key):
         try:
             entry = meta.DBSession.query(EventControl).\
@@ -305,9 +352,6 @@ class EventControlManager(Manager):
 
     def gen(self, key, data=None, userid=None, site_id=None, timestamp=None):
         # pylint: disable=too-many-arguments
-        # pylint: disable=too-many-locals
-        # pylint: disable=too-many-statements
-        # pylint: disable=too-many-branches
 
         """Generate an event.
             Arguments:
@@ -336,6 +380,8 @@ class EventControlManager(Manager):
                                     version
                                     listen-port
                                     install-dir
+
+            The event is queued and generated by a worker thread.
         """
 
         if data == None:
@@ -346,6 +392,22 @@ class EventControlManager(Manager):
                          "generated.  key: %s, data: %s", key, data)
             return
 
+        # FIXME: remove when browser-aware timezone support is available.
+        if timestamp is None:
+            timestamp = datetime.datetime.now(tz=tz.tzlocal())
+
+        # The caller may change 'data' after we return.
+        args = (key, dict(data), userid, site_id, timestamp)
+        if key in self.SYNC_KEYS:
+            self._gen(*args, sync=True)
+        else:
+            self.queue.put(args)
+
+    def _gen(self, key, data, userid, site_id, timestamp, sync=False):
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-locals
+        # pylint: disable=too-many-statements
+        # pylint: disable=too-many-branches
         event_entry = self.get_event_control_entry(key)
         if event_entry:
             subject = event_entry.subject
@@ -364,10 +426,7 @@ class EventControlManager(Manager):
             data['exit_status'] = data['exit-status']
             del data['exit-status']
 
-        # FIXME: remove when browser-aware timezone support is available.
-        if timestamp is None:
-            timestamp = datetime.datetime.now(tz=tz.tzlocal())
-            logger.debug(key + " timestamp : " + timestamp.strftime(DATEFMT))
+        logger.debug(key + " timestamp : " + timestamp.strftime(DATEFMT))
         data['timestamp'] = timestamp.strftime(DATEFMT)
 
         # The userid for other events is the Palette "userid".
@@ -415,16 +474,12 @@ class EventControlManager(Manager):
             if not project is None:
                 data['project'] = project
 
-        # Create the row to get the eventid before doing subject/description
-        # substitution.
-        session = meta.DBSession()
-        entry = EventEntry(complete=False, key='incomplete')
-        # set the timestamp here in case it has tzinfo.
-        entry.timestamp = timestamp
-        session.add(entry)
-        session.commit()
+        # Get the eventid before doing subject/description substitution
+        # so the row can be inserted once, complete.
+        session = meta.Session()
+        eventid = session.execute(self.EVENTID_STMT).scalar()
 
-        data['eventid'] = entry.eventid
+        data['eventid'] = eventid
 
         # Use the data dict for template substitution.
         try:
@@ -436,8 +491,7 @@ class EventControlManager(Manager):
 
         if event_description:
             try:
-                mako_template = Template(event_description,
-                                         default_filters=['h'])
+                mako_template = self.template(key, event_description)
                 event_description = mako_template.render(**data)
             except MakoException:
                 event_description = \
@@ -469,6 +523,9 @@ class EventControlManager(Manager):
             summary = timestamp.strftime(DATEFMT)
 
         # Log the event to the database
+        entry = EventEntry(eventid=eventid)
+        # set the timestamp here in case it has tzinfo.
+        entry.timestamp = timestamp
         entry.complete = True
         entry.key = key
         entry.envid = self.envid
@@ -481,16 +538,16 @@ class EventControlManager(Manager):
         entry.summary = summary
         entry.userid = userid
         entry.site_id = site_id
-        #entry.timestamp = timestamp
 
-        session.merge(entry)
+        session.add(entry)
         session.commit()
 
         if not event_entry.send_email:
             return
 
         try:
-            self.alert_email.send(event_entry, data, eventid=entry.eventid)
+            self.alert_email.send(event_entry, data, eventid=eventid,
+                                  sync=sync)
         except StandardError:
             exc_traceback = sys.exc_info()[2]
             tback = ''.join(traceback.format_tb(exc_traceback))
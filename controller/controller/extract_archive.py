@@ -92,6 +92,12 @@ class DataSourceExtractEntry(meta.Base, BaseMixin, BaseDictMixin):
 class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
     NAME = 'archive extract refresh'
 
+    # ArchiveQueue kinds handled by this manager.
+    WORKBOOK_KIND = 'workbook-extract'
+    DATASOURCE_KIND = 'datasource-extract'
+    KINDS = {WORKBOOK_KIND: WorkbookExtractEntry,
+             DATASOURCE_KIND: DataSourceExtractEntry}
+
     def add(self, item_entry, extract_entry):
         """Add a workbook or datasource entry row.
             Called with either a WorkbookEntry or DataSourceEntry row.
@@ -114,6 +120,7 @@ class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
 
     @synchronized('refresh')
     def refresh(self, agent, check_odbc_state=True):
+        # pylint: disable=unused-argument
         """Archive extract refreshes."""
 
         wb_retain_count = \
@@ -133,67 +140,69 @@ class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
                      self.server.state_manager.get_state()}
 
         self._prune_all_missed_extracts()
-        return self._archive_all(agent)
+        return self._queue_all()
 
-    def _archive_all(self, agent):
-        """Archive all extracts: Workbooks and Data Sources."""
-        workbook_count = self._archive(agent, WorkbookExtractEntry)
-        datasource_count = self._archive(agent, DataSourceExtractEntry)
+    def _queue_all(self):
+        """Queue all extracts for the archive workers:
+           Workbooks and Data Sources."""
+        workbook_count = self._queue(self.WORKBOOK_KIND)
+        datasource_count = self._queue(self.DATASOURCE_KIND)
 
         return {u'status': 'OK',
-                u'workbook-extracts-archived': workbook_count,
-                u'datasource-extracts-archive': datasource_count}
-
-    def _archive(self, agent, obj_class):
-        """Archive extracts for the object type."""
+                u'workbook-extracts-queued': workbook_count,
+                u'datasource-extracts-queued': datasource_count}
 
-        session = meta.Session()
+    def _queue(self, kind):
+        """Queue the unarchived extracts for the object type."""
+        obj_class = self.KINDS[kind]
 
-        updates = session.query(obj_class).\
+        rows = meta.Session.query(obj_class.sid).\
             filter(obj_class.fileid == None).\
                        all()
 
-        count = 0
-        for update in updates:
-            # fixme: When a system table entry is added for extract
-            # refresh data source, check which one is being archived and
-            # if it is still enabled, etc.
-            if not self.system[SystemKeys.EXTRACT_REFRESH_WB_RETAIN_COUNT]:
-                logger.info("Extract Archiving disabled during archiving."
-                            "  Exiting for now.")
-                break
-            name = update.parent.name    # cache in case it fails and is removed
-            try:
-                filename = self._build_extract(agent, update)
-            except ArchiveException as ex:
-                if ex.value == ArchiveError.BAD_CREDENTIALS:
-                    msg = "extract archive: tabcmd failed due to " + \
-                          "bad credentials. " + \
-                          "Skipping any remaining extract archives now."
-                    logger.info(msg)
-                    break
-                else:
-                    raise # should never happen
-
-            if not filename:
-                logger.error(
-                    "Failed to retrieve extract refresh: from %s: %d - %s",
-                        update.__tablename__,
-                        update.parentid,
-                        name)
-                continue
-
-            # retrieval is a long process, so commit after each.
-            meta.Session.commit()
-            count += 1
-
-        if count:
-            self._retain_some()
-
-        return count
-
-    def _build_extract(self, agent, update):
-        """Retrieve the extract refresh.
+        return self.server.archive_queue.add(kind, [row[0] for row in rows])
+
+    def archive_enabled(self, kind):
+        # pylint: disable=unused-argument
+        """Called by the ArchiveQueue before starting an extract."""
+        # fixme: When a system table entry is added for extract
+        # refresh data source, check which one is being archived and
+        # if it is still enabled, etc.
+        return bool(self.system[SystemKeys.EXTRACT_REFRESH_WB_RETAIN_COUNT])
+
+    def archive_item(self, agent, job):
+        """Archive one extract refresh for the ArchiveQueue.
+           Returns True when the extract is archived or no longer exists
+           and False if it should be tried again."""
+        obj_class = self.KINDS[job.kind]
+        update = obj_class.get_unique_by_keys({'sid': job.itemid},
+                                              default=None)
+        if update is None or update.fileid:
+            return True
+
+        # cache in case it fails and is removed
+        name = update.parent.name
+        parentid = update.parentid
+        filename = self._build_extract(agent, update, job)
+        if not filename:
+            logger.error(
+                "Failed to retrieve extract refresh: from %s: %d - %s",
+                    obj_class.__tablename__, parentid, name)
+            # The row is removed if the extract was deleted from Tableau.
+            return obj_class.get_unique_by_keys({'sid': job.itemid},
+                                                default=None) is None
+
+        # retrieval is a long process, so commit after each.
+        meta.Session.commit()
+        return True
+
+    def archive_retain(self, kind):
+        # pylint: disable=unused-argument
+        """Retain only the configured number of extract refreshes."""
+        return self._retain_some()
+
+    def _build_extract(self, agent, update, job):
+        """Retrieve the extract refresh, updating job.stage.
            Returns:
                 Success: The filename *on the agent*
                 Failure: None
@@ -228,6 +237,7 @@ class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
 
         dst = agent.path.join(dcheck.primary_dir, dst)
 
+        job.stage = 'download'
         body = self.tabcmd_run(agent, url, dst, site_id)
 
         if failed(body):
@@ -252,6 +262,7 @@ class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
             # _tabcmd_get generates an event on failure
             return None
 
+        job.stage = 'place'
         place = self.archive_file(agent, dcheck, dst)
         update.fileid = place.placed_file_entry.fileid
 
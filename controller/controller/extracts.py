@@ -13,7 +13,6 @@ from event_control import EventControl
 from profile import UserProfile
 from mixin import BaseMixin, BaseDictMixin
 from manager import synchronized, Manager
-from odbc import ODBC
 from util import timedelta_total_seconds, utc2local, to_hhmmss
 from .system import SystemKeys
 from datasources import DataSourceEntry
@@ -150,16 +149,19 @@ class ExtractManager(Manager):
                     "        OR job_name = 'Increment Extracts')" +\
                     ")"
         else:
+            # '>=': a load that failed part way may have stopped between
+            # two rows with the same 'updated_at'.
             stmt += "WHERE (job_name = 'Refresh Extracts' "+\
                     "       OR job_name = 'Increment Extracts') "+\
-                    " AND updated_at > '"+\
+                    " AND updated_at >= '"+\
                     last_updated_at + "'"
-        stmt += " ORDER BY id ASC"
 
-        datadict = agent.odbc.execute(stmt)
-
-        if 'error' in datadict or '' not in datadict:
-            return datadict
+        # Each row is committed (and its events sent) as it is processed,
+        # so rows are read in 'updated_at' order: whatever was committed
+        # is then always older than what wasn't.
+        cursor = agent.odbc.cursor(stmt, key=('updated_at', 'id'))
+        if cursor.error:
+            return {u'error': cursor.error}
 
         # Get the tableau system's idea of time which may be different
         # than ours (maybe somebody isn't running ntp or equivalent).
@@ -169,9 +171,13 @@ class ExtractManager(Manager):
 
         # Get the latest rows and row updates here
         session = meta.Session()
-        for odbcdata in ODBC.load(datadict):
+        for odbcdata in cursor:
             exid = odbcdata.data['id']
             entry = ExtractEntry.get(envid, exid, default=None)
+            if entry is not None and \
+                    entry.updated_at == odbcdata.data['updated_at']:
+                # Already processed.
+                continue
 
             if entry is None:
                 entry = ExtractEntry(envid=envid)
@@ -182,9 +188,12 @@ class ExtractManager(Manager):
             self._process(data, db_now_utc, entry)
             session.commit()    # can move this after proven reliable
 
+        if cursor.error:
+            return {u'error': cursor.error, u'count': cursor.count}
+
         self._check_existing_unfinished(agent, extract_thresholds)
 
-        return {u'status': 'OK', u'count': len(datadict[''])}
+        return {u'status': 'OK', u'count': cursor.count}
 
     def _check_existing_unfinished(self, agent, extract_thresholds):
         """Go through our unfinished extracts db to see if any have exceeded
@@ -1,14 +1,37 @@
 import logging
 import os
+import time
 import urllib
 import json
 import exc
 import httplib
+from cStringIO import StringIO
 
 logger = logging.getLogger()
 
+class ProgressReader(object):
+    """File wrapper that reports the number of bytes read so far.
+       httplib sends a body with a read() method in blocks."""
+
+    def __init__(self, fileobj, size, progress=None):
+        self.fileobj = fileobj
+        self.size = size
+        self.progress = progress
+        self.done = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.done += len(data)
+        if self.progress:
+            self.progress(self.done, self.size)
+        return data
+
+
 class FileManager(object):
 
+    # Seconds between the requests for the result of a CHUNKS job.
+    CHUNKS_POLL_INTERVAL = 2
+
     def __init__(self, agent):
         self.server = agent.server
         self.agent = agent
@@ -30,8 +53,12 @@ class FileManager(object):
                 EnvironmentError) as ex:
             raise IOError("filemanager.get failed: %s" % str(ex))
 
-    def save(self, path, target='.'):
-        """Retrieves a remote file and saves it locally."""
+    def save(self, path, target='.', progress=None, resume=False):
+        """Retrieves a remote file and saves it locally.
+           The file is streamed to disk in chunks; 'progress' is called
+           as progress(bytes_done, bytes_total).  With 'resume', a partial
+           local copy left by an earlier failed transfer is completed
+           instead of being downloaded again."""
         target = os.path.abspath(os.path.expanduser(target))
         self.checkpath(path)
 
@@ -39,28 +66,66 @@ class FileManager(object):
             target = os.path.join(target, self.agent.path.basename(path))
 
         try:
-            with open(target, "w") as f:
-                data = self.get(path)
-                f.write(data)
+            offset = 0
+            if resume and os.path.isfile(target):
+                offset = os.path.getsize(target)
+                body = self.filesize(path)
+                if 'size' not in body:
+                    raise IOError(body.get('error', 'no size'))
+                if offset == body['size']:
+                    logger.debug("FileManager save: '%s' already complete.",
+                                 target)
+                    return {'target': target, 'path': path, 'size': offset}
+                if offset > body['size']:
+                    offset = 0
+
+            uri = self.uri(path)
+            logger.debug("FileManager GET %s, offset %d", uri, offset)
+            with open(target, offset and "ab" or "wb") as f:
+                size = self.agent.connection.http_get_file(uri, f,
+                                                           offset=offset,
+                                                           progress=progress)
             return {
                 'target': target,
                 'path': path,
-                'size': len(data)
+                'size': size
                 }
         except (exc.HTTPException, httplib.HTTPException,
                 EnvironmentError) as ex:
             raise IOError("filemanager.save failed: %s" % str(ex))
 
-    def put(self, path, data):
+    def read(self, path, offset, length):
+        """Returns 'length' bytes of a remote file starting at 'offset'
+           (fewer at the end of the file)."""
+        self.checkpath(path)
+        uri = self.uri(path)
+        logger.debug("FileManager GET %s, range %d+%d", uri, offset, length)
+        buf = StringIO()
+        try:
+            self.agent.connection.http_get_file(uri, buf, offset=offset,
+                                                length=length)
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError) as ex:
+            raise IOError("filemanager.read failed: %s" % str(ex))
+        return buf.getvalue()
+
+    def put(self, path, data, offset=None):
+        """Writes 'data' to a remote file.  With 'offset', the data is
+           written at that offset of the existing file instead."""
         self.checkpath(path)
+        logger.debug("FileManager PUT %s: %d", self.uri(path), len(data))
+        return self._put(path, data, len(data), offset=offset)
+
+    def _put(self, path, body, size, offset=None):
         uri = self.uri(path)
-        headers = {}
-        if not data:
-            # http://bugs.python.org/issue14721
-            headers['content-length'] = 0
-        logger.debug("FileManager PUT %s: %d", uri, len(data))
+        # Always set: http://bugs.python.org/issue14721 and
+        # httplib can't compute it for a file wrapper.
+        headers = {'content-length': size}
+        if offset is not None:
+            headers['content-range'] = \
+                'bytes %d-%d/*' % (offset, offset + size - 1)
         try:
-            body = self.agent.connection.http_send('PUT', uri, data,
+            body = self.agent.connection.http_send('PUT', uri, body,
                                                    headers=headers)
             if body:
                 return json.loads(body)
@@ -79,6 +144,51 @@ class FileManager(object):
                 EnvironmentError, ValueError) as ex:
             raise IOError("filemanager.sha256 failed: %s" % str(ex))
 
+    def manifest(self, paths):
+        """Returns the sha256 and size of several files in one request.
+           'paths' is either a list of files or a directory, in which
+           case every file under it is included."""
+        if isinstance(paths, basestring):
+            data = {'action':'MANIFEST', 'path':paths}
+        else:
+            data = {'action':'MANIFEST', 'paths':paths}
+        try:
+            body = self.agent.connection.http_send_json('/file', data)
+            return json.loads(body)
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError, ValueError) as ex:
+            raise IOError("filemanager.manifest failed: %s" % str(ex))
+
+    def chunks(self, path, avg_size=None):
+        """Returns the content-defined chunks of a file as a list of
+           [offset, length, sha256] with the 'size' and 'sha256' of the
+           file.  The agent splits the file in the background: the
+           request is repeated until it is done so that the connection
+           is free for other requests meanwhile."""
+        data = {'action':'CHUNKS', 'path':path}
+        if avg_size:
+            data['avg-size'] = avg_size
+        try:
+            while True:
+                body = self.agent.connection.http_send_json('/file', data)
+                body = json.loads(body)
+                if body.get('status') != 'RUNNING':
+                    return body
+                time.sleep(self.CHUNKS_POLL_INTERVAL)
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError, ValueError) as ex:
+            raise IOError("filemanager.chunks failed: %s" % str(ex))
+
+    def checksums(self, path, ranges):
+        """Returns the md5 of each [offset, length] range of a file."""
+        data = {'action':'CHECKSUMS', 'path':path, 'ranges':ranges}
+        try:
+            body = self.agent.connection.http_send_json('/file', data)
+            return json.loads(body)
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError, ValueError) as ex:
+            raise IOError("filemanager.checksums failed: %s" % str(ex))
+
     def move(self, src, dst):
         data = {'action':'MOVE', 'source':src, 'destination':dst}
         try:
@@ -125,16 +235,19 @@ class FileManager(object):
                 EnvironmentError, ValueError) as ex:
             raise IOError("filemanager.filetype failed: %s" % str(ex))
 
-    def sendfile(self, path, source):
+    def sendfile(self, path, source, progress=None):
+        """Sends a local file to the agent.  The file is read and sent in
+           blocks rather than all at once."""
+        self.checkpath(path)
         source = os.path.abspath(os.path.expanduser(source))
+        size = os.path.getsize(source)
         with open(source, "rb") as f:
-            data = f.read()
-            body = self.put(path, data)
+            body = self._put(path, ProgressReader(f, size, progress), size)
         logger.debug("sendfile source '%s' path '%s' size %d.",
-                     source, path, len(data))
+                     source, path, size)
         body['source'] = source
         body['path'] = path
-        body['size'] = len(data)
+        body['size'] = size
         return body
 
     def delete(self, path):
@@ -1,4 +1,5 @@
 import logging
+import time
 import urllib
 from collections import OrderedDict
 
@@ -92,9 +93,14 @@ class FileManager(Manager):
     FILE_TYPE_WORKBOOK = "workbook"
     FILE_TYPE_DATASOURCE = "datasource"
 
+    # The most keys one S3 multi-object delete request may have.
+    DELETE_BATCH_SIZE = 1000
+
     # FIXME: replace this with kwargs variant.
     def add(self, name, file_type, storage_type, storageid,
-            size=0, auto=True, encrypted=False, username=None):
+            size=0, auto=True, encrypted=False, username=None, commit=True):
+        """Add a row to the files table.  With commit=False it is only
+           flushed (so 'fileid' is set) and the caller commits."""
         # pylint: disable=too-many-arguments
         session = meta.Session()
         entry = FileEntry(envid=self.envid, name=name, file_type=file_type,
@@ -102,7 +108,10 @@ class FileManager(Manager):
                           storageid=storageid, size=size, auto=auto,
                           encrypted=encrypted)
         session.add(entry)
-        session.commit()
+        if commit:
+            session.commit()
+        else:
+            session.flush()
         return entry
 
     def remove(self, fileid):
@@ -114,6 +123,17 @@ class FileManager(Manager):
             delete()
         session.commit()
 
+    def remove_many(self, fileids):
+        """Remove several rows from the files table in one transaction."""
+        if not fileids:
+            return
+        session = meta.Session()
+        session.query(FileEntry).\
+            filter(FileEntry.envid == self.envid).\
+            filter(FileEntry.fileid.in_(fileids)).\
+            delete(synchronize_session=False)
+        session.commit()
+
     def remove_file_by_id(self, fileid):
         """Removes the file from disk or cloud.
            When done, removes the row from the files table.
@@ -151,6 +171,13 @@ class FileManager(Manager):
                         file_entry.storageid))}
             return {}
 
+        # Delete a backup kept in the deduplicating chunk store.
+        if self.server.dedup.get(file_entry.fileid):
+            fileid = file_entry.fileid
+            body = self.server.dedup.remove(file_entry)
+            self.remove(fileid)
+            return body
+
         # Delete a file from an agent.
         vol_entry = AgentVolumesEntry.get_vol_entry_by_volid(
                                                     file_entry.storageid)
@@ -194,6 +221,61 @@ class FileManager(Manager):
                         target_agent.displayname))}
         return body
 
+    def delfiles_cloud(self, file_entries):
+        """Delete many cloud files, e.g. the expired backups during
+           rotation.  The files are grouped by cloud (bucket); each group
+           reuses one connection and is deleted in batches of
+           DELETE_BATCH_SIZE, with one multi-object delete request and
+           one files table transaction per batch.
+           Returns a list with a dict per cloud:
+                cloudid, cloud (the CloudEntry or None), removed (names),
+                errors (messages) and seconds."""
+        groups = OrderedDict()
+        for entry in file_entries:
+            # Read now: each batch commit expires the loaded entries.
+            groups.setdefault(entry.storageid, []).\
+                append((entry.name, entry.fileid))
+
+        results = []
+        for cloudid, entries in groups.iteritems():
+            start_time = time.time()
+            cloud_entry = self.server.cloud.get_by_cloudid(cloudid)
+            result = {'cloudid': cloudid, 'cloud': cloud_entry,
+                      'removed': [], 'errors': []}
+            results.append(result)
+            if not cloud_entry:
+                result['errors'].append("cloudid not found: %d" % cloudid)
+                result['seconds'] = time.time() - start_time
+                continue
+
+            try:
+                conn = self.server.cloud.connect(cloud_entry)
+            except IOError as ex:
+                result['errors'].append(str(ex))
+                result['seconds'] = time.time() - start_time
+                continue
+            for i in range(0, len(entries), self.DELETE_BATCH_SIZE):
+                batch = entries[i:i + self.DELETE_BATCH_SIZE]
+                fileids = dict(batch)
+                try:
+                    deleted, errors = self.server.cloud.delete_cloud_files(
+                                                cloud_entry, fileids.keys(),
+                                                conn=conn)
+                except IOError as ex:
+                    result['errors'].append(str(ex))
+                    continue
+                self.remove_many([fileids[name] for name in deleted])
+                result['removed'].extend(deleted)
+                result['errors'].extend(errors.values())
+
+            result['seconds'] = time.time() - start_time
+            logger.info("delfiles_cloud: %s bucket '%s': removed %d, " + \
+                        "failed %d in %.1f seconds",
+                        cloud_entry.cloud_type, cloud_entry.bucket,
+                        len(result['removed']), len(result['errors']),
+                        result['seconds'])
+        return results
+
     def delete_vol_file(self, agent, source_fullpathname):
         """Delete a file, check the error, and return the body result.
            Note: Does not remove the entry from the files table.
@@ -23,6 +23,8 @@ class GetFile(object):
         self.full_path = full_path  # incoming
 
         self.file_entry = None
+        # Set if the file is kept in the deduplicating chunk store.
+        self.dedup_entry = None
 
         self.source_type = None
         self.source_entry = None
@@ -60,7 +62,10 @@ class GetFile(object):
 
         self._mkdir()
 
-        if self.source_type == FileManager.STORAGE_TYPE_CLOUD:
+        if self.dedup_entry:
+            self._get_dedup_file()
+
+        elif self.source_type == FileManager.STORAGE_TYPE_CLOUD:
             self._get_cloud_file()
 
         elif self.source_type == FileManager.STORAGE_TYPE_VOL and \
@@ -81,6 +86,7 @@ class GetFile(object):
         """The case where the file is not on the primary.
            Find a place to stage the file."""
         if self.source_type == FileManager.STORAGE_TYPE_CLOUD or \
+            self.dedup_entry or \
             ((self.source_type == FileManager.STORAGE_TYPE_VOL) and \
                     (self.source_agent.agentid != self.agent.agentid)):
             try:
@@ -133,6 +139,7 @@ class GetFile(object):
                                "'%s': agent is disabled.") % \
                                (self.file_entry.name,
                                self.source_agent.displayname))
+            self.dedup_entry = self.server.dedup.get(self.file_entry.fileid)
         else:
             raise IOError(("_get_file: Unknown file storage type " + \
                               "'%s' for file '%s'") % \
@@ -178,6 +185,29 @@ class GetFile(object):
 
         self.copied = True
 
+    def _get_dedup_file(self):
+        """The file is in the deduplicating chunk store of an agent
+           volume (possibly on the primary).  Rebuild it in the
+           staging area."""
+        self.primary_full_path = self.agent.path.join(
+                self.primary_dir,
+                self.agent.path.basename(self.full_path))
+
+        logger.debug("get_file: rebuilding '%s' from chunks on " + \
+                     "agent '%s' as '%s'",
+                     self.full_path, self.source_agent.displayname,
+                     self.primary_full_path)
+        try:
+            self.server.dedup.restore(self.file_entry, self.agent,
+                                      self.primary_full_path)
+        except IOError as ex:
+            text = "get_file: rebuilding '%s' from agent '%s' failed: %s" % \
+                   (self.full_path, self.source_agent.displayname, str(ex))
+            logger.debug(text)
+            raise IOError(text)
+
+        self.copied = True
+
     def _get_agent_file(self):
         # The file isn't on the Primary agent or cloud storage.
         # We need to copy the file to the Primary.
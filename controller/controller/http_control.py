@@ -1,4 +1,5 @@
 import re
+import threading
 
 from sqlalchemy import Column, String, Integer, BigInteger, DateTime
 from sqlalchemy import func
@@ -23,6 +24,56 @@ def match_re(patterns, arg):
 
     return False
 
+# Backreferences are numbered/named per pattern so they can't be combined.
+BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+# Neither can inline flags such as (?i): they apply to the whole pattern.
+FLAGS_RE = re.compile(r'\(\?[iLmsux]+\)')
+# The most groups a compiled pattern can have.
+MAX_GROUPS = 99
+
+class PatternList(object):
+    """The patterns of a list_re() argument, compiled into as few
+       alternations as possible so a url is matched with one call."""
+
+    def __init__(self, arg):
+        tokens = [token for token in arg.replace(',', ' ').split(' ') if token]
+        self.patterns = [re.compile(token) for token in tokens]
+        self.combined = []
+        self.separate = []
+
+        batch = []
+        groups = 0
+        for token, pattern in zip(tokens, self.patterns):
+            if BACKREF_RE.search(token) or FLAGS_RE.search(token):
+                self.separate.append(pattern)
+                continue
+            if groups + pattern.groups > MAX_GROUPS:
+                self._combine(batch)
+                batch = []
+                groups = 0
+            batch.append((token, pattern))
+            groups += pattern.groups
+        self._combine(batch)
+
+    def _combine(self, batch):
+        if len(batch) > 1:
+            try:
+                self.combined.append(re.compile(
+                    '|'.join(['(?:' + token + ')' for token, _ in batch])))
+                return
+            except (re.error, AssertionError):
+                pass
+        self.separate.extend([pattern for _, pattern in batch])
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, arg):
+        for pattern in self.combined:
+            if pattern.match(arg) is not None:
+                return True
+        return match_re(self.separate, arg)
+
 class HttpControl(meta.Base, BaseMixin):
     __tablename__ = "http_control"
 
@@ -48,27 +99,60 @@ class HttpControl(meta.Base, BaseMixin):
             all()
 
 class HttpControlData(object):
+    """The exclusions and thresholds used by one http_requests load.
+       The compiled exclusions are cached across loads and rebuilt only
+       when the exclusion text in the http_control table or HTTP_LOAD_RE
+       changes.  The thresholds are read once per load."""
+
+    # The table is a few rows: the text itself is the cache key, so even
+    # changes that don't touch modification_time are noticed.
+    ROWS_STMT = "SELECT status, excludes FROM http_control " + \
+                "WHERE level > 0 ORDER BY status"
+
+    lock = threading.Lock()
+    cached = None       # (version, status_excludes, load_excludes)
 
     def __init__(self, server):
         self.server = server
 
-        self.status_excludes = {}
-        for entry in HttpControl.all():
-            if entry.excludes:
-                excludes = list_re(entry.excludes)
+        self.status_excludes, self.load_excludes = self._excludes()
+
+        self.load_error = server.system[SystemKeys.HTTP_LOAD_ERROR]
+        self.load_warn = server.system[SystemKeys.HTTP_LOAD_WARN]
+
+    def _version(self):
+        connection = meta.get_connection()
+        try:
+            rows = connection.execute(self.ROWS_STMT).fetchall()
+        finally:
+            connection.close()
+        return (tuple((row[0], row[1]) for row in rows),
+                self.server.system[SystemKeys.HTTP_LOAD_RE])
+
+    def _excludes(self):
+        version = self._version()
+        with self.lock:
+            cached = HttpControlData.cached
+            if cached is not None and cached[0] == version:
+                return cached[1], cached[2]
+
+        status_excludes = {}
+        for status, text in version[0]:
+            if text:
+                excludes = PatternList(text)
                 if excludes:
-                    self.status_excludes[entry.status] = excludes
+                    status_excludes[status] = excludes
+
+        load_excludes = PatternList(version[1] or '')
 
-        self.load_excludes = []
-        arg = server.system[SystemKeys.HTTP_LOAD_RE]
-        if arg:
-            self.load_excludes = list_re(arg)
+        with self.lock:
+            HttpControlData.cached = (version, status_excludes, load_excludes)
+        return status_excludes, load_excludes
 
     def status_exclude(self, status, url):
         if status not in self.status_excludes:
             return False
-        excludes = self.status_excludes[status]
-        return match_re(excludes, url)
+        return self.status_excludes[status].match(url)
 
     def load_exclude(self, url):
-        return match_re(self.load_excludes, url)
+        return self.load_excludes.match(url)
@@ -4,7 +4,7 @@ from urllib import unquote
 from urlparse import urlparse
 
 from sqlalchemy import Column, String, DateTime, Integer, BigInteger
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm.exc import MultipleResultsFound
 
@@ -19,8 +19,6 @@ from util import timedelta_total_seconds, utc2local
 from sites import Site
 from workbooks import WorkbookEntry
 from profile import UserProfile
-from odbc import ODBC, ODBCData
-from system import SystemKeys
 
 logger = logging.getLogger()
 
@@ -77,6 +75,36 @@ class HttpRequestEntry(meta.Base, BaseMixin, BaseDictMixin):
     def maxid(cls, envid):
         return cls.max('id', filters={'envid':envid})
 
+# Backs the get_by_vizql_action() fallback.
+Index('http_requests_envid_vizql_session_action_created_at_idx', \
+          HttpRequestEntry.envid, HttpRequestEntry.vizql_session, \
+          HttpRequestEntry.action, HttpRequestEntry.created_at)
+
+class VizqlIndex(object):
+    """Lookup of the imported rows by (vizql_session, action).
+       The index covers the current batch and the previous one so a
+       'show' row in the previous batch is still found without going to
+       the database."""
+
+    def __init__(self):
+        self.current = {}
+        self.previous = {}
+
+    def add(self, entry):
+        # The first row in the batch wins, as with the old linear scan.
+        self.current.setdefault((entry.vizql_session, entry.action), entry)
+
+    def rotate(self):
+        """Start a new batch."""
+        self.previous = self.current
+        self.current = {}
+
+    def get(self, vizql_session, action):
+        key = (vizql_session, action)
+        if key in self.current:
+            return self.current[key]
+        return self.previous.get(key)
+
 class HttpRequestManager(TableauCacheManager):
 
     def get_maxid_statement(self, maxid):
@@ -100,44 +128,37 @@ class HttpRequestManager(TableauCacheManager):
         userdata = self.load_users(agent)
 
         maxid = HttpRequestEntry.maxid(envid)
-        datadict = agent.odbc.execute(self.get_maxid_statement(maxid))
-        if 'error' in datadict:
-            return datadict
-        if '' not in datadict:
-            datadict['error'] = "Missing '' key in query response."
-            return datadict
+        cursor = agent.odbc.cursor(self.get_maxid_statement(maxid))
+        if cursor.error:
+            return {u'error': cursor.error}
 
         rows = []
-        schema = ODBC.schema(datadict)
-        counter = 0
-        session = None
-        for row in datadict['']:
-            if counter % 1000 == 0:
-                if session != None:
-                    session.commit()
-                    # Our table was empty so don't test for alerts on the one
-                    # placeholder row we brought in.
-                    if maxid is not None:
-                        for entry in rows:
-#                           print "entry: id", entry.id, "action", entry.action,
-#                           print "vizal_session", entry.vizql_session
-                            self._test_for_alerts(rows,
-                                entry, agent, controldata)
-                session = meta.Session()
-                rows = []
-            counter += 1
-            odbcdata = ODBCData(schema, row)
-            entry = HttpRequestEntry()
-            entry.envid = envid
-            odbcdata.copyto(entry)
-            system_user_id = userdata.get(entry.site_id, entry.user_id)
-            entry.system_user_id = system_user_id
-            session.add(entry)
-            rows.append(entry)
-
-        if session != None:
+        index = VizqlIndex()
+        session = meta.Session()
+        # Each page is committed before the next one is requested so
+        # memory use is bounded by the page size, not the import size.
+        for page in cursor.pages():
+            # Our table was empty so don't test for alerts on the one
+            # placeholder row we brought in.
+            if maxid is not None:
+                for entry in rows:
+                    self._test_for_alerts(index, entry, agent, controldata)
+            rows = []
+            index.rotate()
+            for odbcdata in page:
+                entry = HttpRequestEntry()
+                entry.envid = envid
+                odbcdata.copyto(entry)
+                system_user_id = userdata.get(entry.site_id, entry.user_id)
+                entry.system_user_id = system_user_id
+                session.add(entry)
+                rows.append(entry)
+                index.add(entry)
             session.commit()
-        return {u'status': 'OK', u'count': len(datadict[''])}
+
+        if cursor.error:
+            return {u'error': cursor.error, u'count': cursor.count}
+        return {u'status': 'OK', u'count': cursor.count}
 
     def _parseuri(self, uri, body):
         # Keep body['uri'] to be the whole uri, even if it includes a
@@ -172,7 +193,7 @@ class HttpRequestManager(TableauCacheManager):
                 body['repository_url'] = tokens[2]
                 body['view'] = tokens[4]
 
-    def _test_for_alerts(self, rows, entry, agent, controldata):
+    def _test_for_alerts(self, index, entry, agent, controldata):
         if entry.http_request_uri.startswith('/admin'):
             return
 
@@ -188,16 +209,16 @@ class HttpRequestManager(TableauCacheManager):
                                 'get_customized_views'):
             if controldata.load_exclude(body['uri']):
                 return
-            self._test_for_load_alerts(rows, entry, agent, body)
+            self._test_for_load_alerts(index, entry, agent, controldata, body)
 
-    def _test_for_load_alerts(self, rows, entry, agent, body):
+    def _test_for_load_alerts(self, index, entry, agent, controldata, body):
     # pylint: disable=too-many-return-statements
     # pylint: disable=too-many-branches
     # Different event types are described in PD-5352.
 #        print "action = ", entry.action, "body = ", body
 
-        errorlevel = self.system[SystemKeys.HTTP_LOAD_ERROR]
-        warnlevel = self.system[SystemKeys.HTTP_LOAD_WARN]
+        errorlevel = controldata.load_error
+        warnlevel = controldata.load_warn
 
         if not errorlevel and not warnlevel:
             # alerts for http-requests aren't enabled
@@ -232,7 +253,7 @@ class HttpRequestManager(TableauCacheManager):
                                       entry.completed_at, entry.created_at))
                 body['view_compute_duration'] = seconds_compute
 
-                show_entry = self._find_vizql_entry(rows, entry, 'show')
+                show_entry = self._find_vizql_entry(index, entry, 'show')
 
                 if not show_entry:
                     logger.error("http load test Type 1: http_requests "
@@ -260,7 +281,7 @@ class HttpRequestManager(TableauCacheManager):
                 self._parseuri(entry.http_request_uri, body)
             elif entry.vizql_session and entry.status == 500:
                 # Type 3: Failed Initial View Generation
-                show_entry = self._find_vizql_entry(rows, entry, 'show')
+                show_entry = self._find_vizql_entry(index, entry, 'show')
 
                 if not show_entry:
                     logger.error("http load test Type 3: "
@@ -309,29 +330,16 @@ class HttpRequestManager(TableauCacheManager):
             self._eventgen(EventControl.HTTP_LOAD_WARN,
                            agent, entry, body=body)
 
-    def _find_vizql_entry(self, rows, entry, action):
-#        rows = []  # for debugging to remove the cache and force db search
-        for row in rows:
-            if row.vizql_session == entry.vizql_session and \
-                                        row.action == action:
-#                print "found it in the cache:", row.reqid
-                return row
-#            print "not this one. looking for", entry.vizql_session,
-#            print "instead it is:", row.reqid, row.vizql_session
-
-        # fixme: search through db
-#        return None
-#   pylint: disable=unreachable
-        # We didn't find it in our latest odbc request so we'll dig through
+    def _find_vizql_entry(self, index, entry, action):
+        row = index.get(entry.vizql_session, action)
+        if row is not None:
+            return row
+
+        # We didn't find it in our latest odbc requests so we'll dig through
         # all of the http rows.
         envid = self.server.environment.envid
-        db_row = HttpRequestEntry.get_by_vizql_action(envid,
-                                                entry.vizql_session, action)
-#        if db_row == None:
-#            print "Didn't find it in the cache OR db", entry.reqid
-#        else:
-#            print "Didn't find it in the cache.  db find was:", db_row.reqid
-        return db_row
+        return HttpRequestEntry.get_by_vizql_action(envid,
+                                                    entry.vizql_session, action)
 
     def _get_last_http_requests_id(self, agent):
         stmt = "SELECT MAX(id) FROM http_requests"
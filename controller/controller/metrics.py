@@ -1,11 +1,14 @@
+import atexit
 import datetime
 import logging
+import threading
 import time
 
 import akiri.framework.sqlalchemy as meta
 from event_control import EventControl
 from manager import Manager
 from sqlalchemy import Column, BigInteger, Float, String, DateTime, func
+from sqlalchemy import Integer, text
 from sqlalchemy.schema import ForeignKey
 from system import SystemKeys
 
@@ -29,14 +32,266 @@ class MetricEntry(meta.Base):
     creation_time = Column(DateTime, server_default=func.now())
 
 
+class MetricRollupEntry(meta.Base):
+    """Per-minute aggregates of the metrics table for each agent and
+       process, maintained as samples are written.  Threshold checks
+       average over these rows instead of the raw samples."""
+    # pylint: disable=no-init
+    __tablename__ = "metric_rollups"
+
+    agentid = Column(BigInteger,
+                     ForeignKey("agent.agentid", ondelete='CASCADE'),
+                     primary_key=True)
+    process_name = Column(String, primary_key=True)
+    minute = Column(DateTime, primary_key=True, index=True)
+
+    cpu_sum = Column(Float, nullable=False, default=0)
+    cpu_count = Column(Integer, nullable=False, default=0)
+    cpu_min = Column(Float)
+    cpu_max = Column(Float)
+    memory_sum = Column(Float, nullable=False, default=0)
+    memory_count = Column(Integer, nullable=False, default=0)
+    memory_min = Column(Float)
+    memory_max = Column(Float)
+
+
+# Aggregates the rows of 'samples' (agentid, process_name, creation_time,
+# cpu, memory) into metric_rollups, adding to existing minutes.
+# Written as UPDATE + INSERT WHERE NOT EXISTS instead of
+# INSERT ... ON CONFLICT to support PostgreSQL 9.3.
+ROLLUP_CTE = """
+    agg AS (
+        SELECT agentid, process_name,
+               date_trunc('minute', creation_time) AS minute,
+               COALESCE(SUM(cpu), 0) AS cpu_sum, COUNT(cpu) AS cpu_count,
+               MIN(cpu) AS cpu_min, MAX(cpu) AS cpu_max,
+               COALESCE(SUM(memory), 0) AS memory_sum,
+               COUNT(memory) AS memory_count,
+               MIN(memory) AS memory_min, MAX(memory) AS memory_max
+        FROM samples
+        WHERE process_name IS NOT NULL
+        GROUP BY agentid, process_name, date_trunc('minute', creation_time)
+    ),
+    upd AS (
+        UPDATE metric_rollups r SET
+            cpu_sum = r.cpu_sum + agg.cpu_sum,
+            cpu_count = r.cpu_count + agg.cpu_count,
+            cpu_min = LEAST(r.cpu_min, agg.cpu_min),
+            cpu_max = GREATEST(r.cpu_max, agg.cpu_max),
+            memory_sum = r.memory_sum + agg.memory_sum,
+            memory_count = r.memory_count + agg.memory_count,
+            memory_min = LEAST(r.memory_min, agg.memory_min),
+            memory_max = GREATEST(r.memory_max, agg.memory_max)
+        FROM agg
+        WHERE r.agentid = agg.agentid
+            AND r.process_name = agg.process_name
+            AND r.minute = agg.minute
+        RETURNING r.agentid, r.process_name, r.minute
+    )
+    INSERT INTO metric_rollups
+        (agentid, process_name, minute, cpu_sum, cpu_count, cpu_min, cpu_max,
+         memory_sum, memory_count, memory_min, memory_max)
+    SELECT agg.* FROM agg
+    WHERE NOT EXISTS (
+        SELECT 1 FROM upd
+        WHERE upd.agentid = agg.agentid
+            AND upd.process_name = agg.process_name
+            AND upd.minute = agg.minute)
+"""
+
+
+class MetricBuffer(threading.Thread):
+    """Buffers metric samples in memory and writes them to the metrics
+       table from a background thread with one multi-row INSERT per batch,
+       so the ping threads never wait on a database commit.
+
+       A batch is written when 'flush_size' samples are pending or
+       'flush_interval' seconds have passed.  When 'max_pending' samples
+       are queued, add() waits up to 'flush_interval' seconds for the
+       flusher to catch up and then drops the sample.
+    """
+
+    def __init__(self, flush_size, flush_interval, max_pending):
+        super(MetricBuffer, self).__init__()
+        self.daemon = True
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = []
+        self.cond = threading.Condition()
+        self.stopped = False
+
+        self.added = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def add(self, agentid, process_name, cpu, memory):
+        """Queue one sample. Returns False if the sample was dropped."""
+        # The sample time is kept so the creation_time is correct
+        # even though the row is written later.
+        sample = (agentid, process_name, cpu, memory, time.time())
+        with self.cond:
+            if len(self.pending) >= self.max_pending and not self.stopped:
+                self.cond.notify_all()
+                self.cond.wait(self.flush_interval)
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending.append(sample)
+            self.added += 1
+            if len(self.pending) >= self.flush_size:
+                self.cond.notify_all()
+        return True
+
+    def _take(self):
+        """Wait for a full batch or the flush interval and return the
+           samples to write."""
+        with self.cond:
+            deadline = time.time() + self.flush_interval
+            while not self.stopped and len(self.pending) < self.flush_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = self.pending[:self.flush_size]
+            self.pending = self.pending[self.flush_size:]
+            # Wake up any producers waiting for room.
+            self.cond.notify_all()
+            return batch
+
+    def _write(self, batch):
+        """Insert all samples in 'batch' with a single statement."""
+        if not batch:
+            return
+        now = time.time()
+        values = []
+        params = {}
+        for i, sample in enumerate(batch):
+            agentid, process_name, cpu, memory, sample_time = sample
+            values.append(("(:agentid%d, :process_name%d, :cpu%d, " + \
+                           ":memory%d, NOW() - :age%d * INTERVAL '1 second')") \
+                           % (i, i, i, i, i))
+            params['agentid%d' % i] = agentid
+            params['process_name%d' % i] = process_name
+            params['cpu%d' % i] = cpu
+            params['memory%d' % i] = memory
+            params['age%d' % i] = max(now - sample_time, 0)
+
+        # Insert the raw samples and fold them into the per-minute
+        # rollups in the same statement.
+        stmt = text("WITH samples AS (" + \
+                    "INSERT INTO metrics " + \
+                    "(agentid, process_name, cpu, memory, creation_time) " + \
+                    "VALUES " + ", ".join(values) + " " + \
+                    "RETURNING agentid, process_name, creation_time, " + \
+                    "cpu, memory), " + ROLLUP_CTE)
+
+        # A 'WITH' statement isn't autocommitted, so commit explicitly.
+        connection = meta.get_connection()
+        try:
+            with connection.begin():
+                connection.execute(stmt, **params)
+        finally:
+            connection.close()
+        self.written += len(batch)
+        self.flushes += 1
+
+    def flush(self):
+        """Write everything that is pending (called on shutdown)."""
+        while True:
+            with self.cond:
+                batch = self.pending[:self.flush_size]
+                self.pending = self.pending[self.flush_size:]
+            if not batch:
+                break
+            self._write(batch)
+
+    def run(self):
+        while not self.stopped:
+            batch = self._take()
+            try:
+                self._write(batch)
+            except StandardError:
+                logger.exception("metrics: failed to write %d samples",
+                                 len(batch))
+                with self.cond:
+                    self.dropped += len(batch)
+
+    def stop(self):
+        """Stop the flusher and write any remaining samples."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        try:
+            self.flush()
+        except StandardError:
+            logger.exception("metrics: final flush failed")
+
+    def stats(self):
+        with self.cond:
+            return {'pending': len(self.pending),
+                    'added': self.added,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'flushes': self.flushes}
+
+
 class MetricManager(Manager):
+
+    DEFAULT_FLUSH_SIZE = 500
+    DEFAULT_FLUSH_INTERVAL = 5 # seconds
+    DEFAULT_MAX_PENDING = 50000
+
+    def __init__(self, server):
+        super(MetricManager, self).__init__(server)
+        config = server.config
+        self.buffer = MetricBuffer(
+            config.getint('controller', 'metrics_flush_size',
+                          default=self.DEFAULT_FLUSH_SIZE),
+            config.getint('controller', 'metrics_flush_interval',
+                          default=self.DEFAULT_FLUSH_INTERVAL),
+            config.getint('controller', 'metrics_max_pending',
+                          default=self.DEFAULT_MAX_PENDING))
+
+    def start(self):
+        """Start the background flusher; pending samples are written
+           when the process exits."""
+        self.backfill()
+        self.buffer.start()
+        atexit.register(self.buffer.stop)
+
+    def backfill(self, hours=24):
+        """Build the rollups for the last 'hours' of raw samples if the
+           rollup table is empty, i.e. on the first start after upgrade."""
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM metric_rollups)")
+            if result.scalar():
+                return
+            stmt = ("WITH samples AS (" + \
+                    "SELECT agentid, process_name, creation_time, " + \
+                    "cpu, memory FROM metrics " + \
+                    "WHERE creation_time >= NOW() - INTERVAL '%d HOURS'), " + \
+                    ROLLUP_CTE) % (hours,)
+            with connection.begin():
+                result = connection.execute(stmt)
+            logger.debug("metrics: backfilled %d rollup rows",
+                         result.rowcount)
+        finally:
+            connection.close()
+
     def add(self, agent, process_name, cpu, memory):
-        session = meta.Session()
+        """Queue a sample to be written by the flusher thread."""
+        if not self.buffer.add(agent.agentid, process_name, cpu, memory):
+            logger.debug("metrics: buffer full, dropped sample for '%s'",
+                         agent.displayname)
 
-        entry = MetricEntry(agentid=agent.agentid, process_name=process_name,
-                            cpu=cpu, memory=memory)
-        session.add(entry)
-        session.commit()
+    def stats(self):
+        return self.buffer.stats()
 
     def prune(self):
         """Prune/remove old rows from the metrics table."""
@@ -50,10 +305,18 @@ class MetricManager(Manager):
 
         connection = meta.get_connection()
         result = connection.execute(stmt)
+
+        # metric_rollups is keyed (and indexed) by minute.
+        stmt = ("DELETE FROM metric_rollups " + \
+                "WHERE minute < NOW() - INTERVAL '%d DAYS'") % \
+               (metric_save_days,)
+        rollup_result = connection.execute(stmt)
         connection.close()
 
-        logger.debug("metrics: pruned %d rows", result.rowcount)
-        return {'status': "OK", 'pruned': result.rowcount}
+        logger.debug("metrics: pruned %d rows, %d rollup rows",
+                     result.rowcount, rollup_result.rowcount)
+        return {'status': "OK", 'pruned': result.rowcount,
+                'pruned-rollups': rollup_result.rowcount}
 
     def check(self, metric='cpu'):
         # pylint: disable=too-many-locals
@@ -162,7 +425,7 @@ class MetricManager(Manager):
                                             threshold,
                                             period,
                                             level,
-                                            avg(value) as average_value
+                                            sum(value_sum) / nullif(sum(value_count), 0) as average_value
                                     FROM (
                                             SELECT
                                                     '%(metric_type)s_' || config.process_name AS name,
@@ -170,8 +433,9 @@ class MetricManager(Manager):
                                                     config.threshold,
                                                     config.period,
                                                     config.level,
-                                                    creation_time,
-                                                    %(metric_type)s as value
+                                                    minute,
+                                                    %(metric_type)s_sum as value_sum,
+                                                    %(metric_type)s_count as value_count
                                             FROM
                                                     (SELECT
                                                              process_name,
@@ -195,9 +459,9 @@ class MetricManager(Manager):
                                                              AND period_error > 0
                                                              AND alert_type = '%(metric_type)s'
                                                     ) config
-                                                    LEFT JOIN metrics m
+                                                    LEFT JOIN metric_rollups m
                                                             ON m.process_name = config.process_name
-                                                            AND m.creation_time >= NOW() - (config.period * '1 minutes' :: INTERVAL)
+                                                            AND m.minute >= date_trunc('minute', NOW() - (config.period * '1 minutes' :: INTERVAL))
                                                             AND m.agentid = %(agentid)d
                                     ) details
                                              GROUP BY
@@ -332,10 +596,12 @@ class MetricManager(Manager):
                          time.time() - last_connection_time)
             return {"above": "unknown"}
 
-        stmt = ("SELECT AVG(cpu) FROM metrics WHERE " + \
+        stmt = ("SELECT SUM(cpu_sum) / NULLIF(SUM(cpu_count), 0) " + \
+                "FROM metric_rollups WHERE " + \
                 "agentid = %d AND " + \
                 "process_name = '_Total' AND " + \
-                "creation_time >= NOW() - INTERVAL '%d seconds'") % \
+                "minute >= date_trunc('minute', " + \
+                "NOW() - INTERVAL '%d seconds')") % \
                (agent.agentid, period)
 
         report_value = -1
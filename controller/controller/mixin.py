@@ -1,10 +1,11 @@
 from collections import OrderedDict
-from sqlalchemy import DateTime, func
+import time
+from sqlalchemy import DateTime, func, text
 from sqlalchemy.orm.exc import NoResultFound
 
 import akiri.framework.sqlalchemy as meta
 
-from util import DATEFMT, utc2local
+from util import DATEFMT, utc2local, odbc2dt
 
 import os
 import json
@@ -194,6 +195,232 @@ class BaseMixin(object):
         objs = [(tokey(obj), obj) for obj in cls.all(envid)]
         return OrderedDict(objs)
 
+    @classmethod
+    def bulk_sync(cls, envid, keys, rows, defaults=None, delete=False):
+        """Synchronize the rows for envid with 'rows' (a list of dicts)
+           using set-based statements.  See BulkSync."""
+        sync = BulkSync(cls, envid, keys)
+        sync.run(rows, defaults=defaults, delete=delete)
+        return sync
+
+class BulkSync(object):
+    """Set-based synchronization of a table with rows imported from the
+       Tableau repository.
+
+       The natural keys (and current values) for the environment are loaded
+       with one query and diffed against the incoming rows.  New rows are
+       added with multi-row INSERTs, changed rows are staged in a temporary
+       table and applied with a single UPDATE ... FROM, and unchanged rows
+       aren't written at all.  The statements run in the current session
+       transaction; the caller commits.
+
+       Timestamps in the incoming rows may be strings, as in the raw
+       rows of an ODBC query: they are converted with odbc2dt() so that
+       they compare equal to the datetimes loaded from the database.
+
+       Afterwards 'pks' maps each incoming key to its primary key."""
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, cls, envid, keys):
+        self.table = cls.__table__
+        self.envid = envid
+        self.keys = list(keys)
+        # The surrogate key: the first column of the primary key.
+        self.pkey = list(self.table.primary_key.columns)[0].name
+        self.datetimes = set([c.name for c in self.table.columns \
+                                  if isinstance(c.type, DateTime)])
+
+        self.pks = {}
+        self.existing = None
+        self.count = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.seconds = 0.0
+
+    def key(self, row):
+        return tuple([row[name] for name in self.keys])
+
+    def _load(self, columns):
+        names = [self.pkey] + self.keys + \
+                [name for name in columns if not name in self.keys]
+        stmt = "SELECT " + ", ".join(names) + " " + \
+               "FROM " + self.table.name + " WHERE envid = :envid"
+        existing = {}
+        for row in meta.Session().execute(text(stmt), {'envid': self.envid}):
+            values = dict(zip(names, row))
+            existing[self.key(values)] = values
+        return existing
+
+    def _values(self, columns, rows, params, chunk):
+        """Build the VALUES list for 'rows' with numbered parameters."""
+        values = []
+        for i, row in enumerate(rows):
+            names = []
+            for j, name in enumerate(columns):
+                param = 'v%d_%d_%d' % (chunk, i, j)
+                params[param] = row.get(name)
+                names.append(':' + param)
+            values.append('(' + ', '.join(names) + ')')
+        return ', '.join(values)
+
+    def _chunks(self, rows):
+        for i in range(0, len(rows), self.CHUNK_SIZE):
+            yield i, rows[i:i + self.CHUNK_SIZE]
+
+    def _insert(self, rows, defaults):
+        if not rows:
+            return
+        # Python-side scalar column defaults aren't applied by raw SQL.
+        for column in self.table.columns:
+            if not getattr(column.default, 'is_scalar', False):
+                continue
+            defaults.setdefault(column.name, column.default.arg)
+
+        columns = set()
+        for row in rows:
+            for name, value in defaults.items():
+                row.setdefault(name, value)
+            columns.update(row.keys())
+        columns = [c.name for c in self.table.columns if c.name in columns]
+
+        session = meta.Session()
+        for chunk, batch in self._chunks(rows):
+            params = {}
+            stmt = "INSERT INTO " + self.table.name + " " + \
+                   "(" + ", ".join(columns) + ") " + \
+                   "VALUES " + self._values(columns, batch, params, chunk) + \
+                   " RETURNING " + ", ".join([self.pkey] + self.keys)
+            for row in session.execute(text(stmt), params):
+                self.pks[tuple(row[1:])] = row[0]
+        self.inserted += len(rows)
+
+    def _update(self, rows, columns):
+        if not rows:
+            return
+        staging = '_sync_' + self.table.name
+        names = [self.pkey] + columns
+        assignments = ["%s = s.%s" % (name, name) for name in columns]
+        for column in self.table.columns:
+            if column.name in columns:
+                continue
+            if getattr(column.onupdate, 'is_clause_element', False):
+                assignments.append("%s = %s" % \
+                        (column.name, column.onupdate.arg.compile()))
+
+        session = meta.Session()
+        session.execute(text("DROP TABLE IF EXISTS " + staging))
+        # The staging table gets the column types of the real table.
+        session.execute(text("CREATE TEMP TABLE " + staging + " " + \
+                             "ON COMMIT DROP AS SELECT " + ", ".join(names) + \
+                             " FROM " + self.table.name + " WITH NO DATA"))
+        for chunk, batch in self._chunks(rows):
+            params = {}
+            stmt = "INSERT INTO " + staging + \
+                   " (" + ", ".join(names) + ") " + \
+                   "VALUES " + self._values(names, batch, params, chunk)
+            session.execute(text(stmt), params)
+        session.execute(text("UPDATE " + self.table.name + " " + \
+                             "SET " + ", ".join(assignments) + " " + \
+                             "FROM " + staging + " s " + \
+                             "WHERE " + self.table.name + "." + self.pkey + \
+                             " = s." + self.pkey))
+        session.execute(text("DROP TABLE " + staging))
+        self.updated += len(rows)
+
+    def _delete(self, pks):
+        session = meta.Session()
+        for chunk, batch in self._chunks(pks):
+            params = {}
+            for i, pk in enumerate(batch):
+                params['pk%d_%d' % (chunk, i)] = pk
+            stmt = "DELETE FROM " + self.table.name + " " + \
+                   "WHERE " + self.pkey + " IN (" + \
+                   ", ".join([':' + name for name in params]) + ")"
+            session.execute(text(stmt), params)
+        self.deleted += len(pks)
+
+    def run(self, rows, defaults=None, delete=False):
+        """Insert and update 'rows' (dicts of column values; unknown names
+           are ignored).  'defaults' are column values used only when a
+           row is inserted.  If 'delete' is True, rows of the environment
+           not found in 'rows' are deleted."""
+        start = time.time()
+        if defaults is None:
+            defaults = {}
+        known = set(self.table.columns.keys())
+
+        incoming = OrderedDict()
+        columns = set()
+        for row in rows:
+            row = dict([(name, value) for name, value in row.items() \
+                            if name in known and name != self.pkey])
+            for name in self.datetimes:
+                if isinstance(row.get(name), basestring):
+                    row[name] = odbc2dt(row[name])
+            row['envid'] = self.envid
+            columns.update(row.keys())
+            # The last row for a key wins.
+            incoming[self.key(row)] = row
+        columns = [c.name for c in self.table.columns \
+                        if c.name in columns and not c.name in self.keys]
+
+        # The current rows are loaded once; later runs (e.g. one per page
+        # of an import) reuse them.
+        if self.existing is None:
+            self.existing = self._load(columns)
+        existing = self.existing
+
+        inserts = []
+        updates = []
+        for key, row in incoming.items():
+            if not key in existing:
+                inserts.append(row)
+                continue
+            current = existing[key]
+            self.pks[key] = current[self.pkey]
+            changed = False
+            for name in columns:
+                if name in row:
+                    if row[name] != current[name]:
+                        changed = True
+                else:
+                    # Columns missing from this row keep their value.
+                    row[name] = current[name]
+            if changed:
+                row[self.pkey] = current[self.pkey]
+                updates.append(row)
+            else:
+                self.unchanged += 1
+
+        self._insert(inserts, dict(defaults))
+        self._update(updates, columns)
+
+        for row in inserts:
+            row[self.pkey] = self.pks[self.key(row)]
+            existing[self.key(row)] = row
+        for row in updates:
+            existing[self.key(row)] = row
+
+        if delete:
+            missing = [key for key in existing if not key in incoming]
+            self._delete([existing.pop(key)[self.pkey] for key in missing])
+
+        self.count += len(incoming)
+        self.seconds += time.time() - start
+
+    def todict(self):
+        """Per-table counts and timing (used in the CLI results)."""
+        return {u'table': self.table.name,
+                u'count': self.count,
+                u'inserted': self.inserted,
+                u'updated': self.updated,
+                u'unchanged': self.unchanged,
+                u'deleted': self.deleted,
+                u'seconds': round(self.seconds, 3)}
+
 class OnlineMixin(object):
 
     @classmethod
@@ -6,6 +6,7 @@ from collections import OrderedDict
 
 from util import odbc2dt
 from mixin import CredentialMixin
+from system import SystemKeys
 
 logger = logging.getLogger()
 
@@ -27,6 +28,8 @@ class ODBC(CredentialMixin):
         self.server = agent.server
         if self.server is None:
             raise RuntimeError("agent.server is None")
+        # (yml generation, connection string or RuntimeError)
+        self._cached_connection = None
 
     def host(self):
         # worker id points to the 'hot' database IP.
@@ -51,6 +54,22 @@ class ODBC(CredentialMixin):
         self.DRIVER = '{PostgreSQL Unicode(x64)}'
 
     def _connection(self):
+        """Return the connection string, which is only recomputed from the
+           yml when the yml has been synced since it was last built."""
+        generation = self.server.yml.generation
+        cached = self._cached_connection
+        if cached is None or cached[0] != generation:
+            try:
+                value = self._build_connection()
+            except RuntimeError as ex:
+                value = ex
+            cached = (generation, value)
+            self._cached_connection = cached
+        if isinstance(cached[1], RuntimeError):
+            raise cached[1]
+        return cached[1]
+
+    def _build_connection(self):
         # worker id points to the 'hot' database IP.
         worker_id = self.server.yml.get('pgsql.worker_id', default=None)
         if not worker_id is None:
@@ -92,6 +111,28 @@ class ODBC(CredentialMixin):
 
         return self.server.send_immediate(self.agent, 'POST', self.URI, data)
 
+    def fingerprint(self, table, columns=None, key='id'):
+        """Returns a TableFingerprint of 'columns' (or of whole rows) of
+           the Tableau table: the row count and an md5 computed
+           server-side, so only one row comes back."""
+        if columns:
+            value = 'ROW(' + ', '.join(['t.' + c for c in columns]) + ')'
+        else:
+            value = 't'
+        stmt = TableFingerprint.STMT % (value, key, table)
+        return TableFingerprint(table, columns, self.execute(stmt))
+
+    def cursor(self, stmt, key='id', page_size=None):
+        """Returns an ODBCCursor that streams the results of 'stmt' in
+           pages of at most 'page_size' rows, ordered by the integer
+           column (or tuple of columns) 'key'.  The first page is
+           fetched immediately so the caller can check cursor.error
+           before iterating.
+        """
+        if page_size is None:
+            page_size = self.server.system[SystemKeys.ODBC_PAGE_SIZE]
+        return ODBCCursor(self, stmt, key, page_size)
+
     def get_db_now_utc(self):
         """
             Get the tableau postgres database's idea of the current
@@ -138,6 +179,132 @@ class ODBC(CredentialMixin):
         return [ODBCData(schema, row) for row in data['']]
 
 
+class ODBCCursor(object):
+    """Iterates over the rows of a (possibly very large) query result
+    as ODBCData instances.  The statement is wrapped in a keyset-paginated
+    query and each page is a separate /sql request, so only one page is
+    in memory at a time and the agent connection lock is released between
+    pages.  The last 'key' value seen is the continuation token.  'key' is
+    a column or a tuple of columns (integer or DateTime), compared as a
+    row value.
+    """
+
+    PAGE_FMT = 'SELECT * FROM (%s) AS odbc_page%s ORDER BY %s LIMIT %d'
+
+    def __init__(self, odbc, stmt, key, page_size):
+        # pylint: disable=too-many-arguments
+        self.odbc = odbc
+        self.stmt = stmt.strip().rstrip(';')
+        if isinstance(key, basestring):
+            key = (key,)
+        self.key = tuple(key)
+        self.page_size = page_size
+
+        self.error = None
+        self.count = 0
+        self.schema = None
+        # Only the '$schema' entry of the first page, for reporting.
+        self.schema_data = None
+
+        self._last = None
+        self._done = False
+        self._rows = []
+        self._fetch()
+
+    def _statement(self):
+        columns = ', '.join(['odbc_page.' + column for column in self.key])
+        if self._last is None:
+            where = ''
+        else:
+            where = ' WHERE (%s) > (%s)' % (columns, ', '.join(self._last))
+        return self.PAGE_FMT % (self.stmt, where, columns, self.page_size)
+
+    def _literal(self, column, value):
+        if self.schema[column] == 'DateTime':
+            return "'" + str(value) + "'"
+        return str(int(value))
+
+    def _fetch(self):
+        """Fetch the next page into self._rows."""
+        data = self.odbc.execute(self._statement())
+        if 'error' in data:
+            self.error = data['error']
+            self._done = True
+            self._rows = []
+            return
+        if '' not in data or '$schema' not in data:
+            self.error = "Missing '' key in query response."
+            self._done = True
+            self._rows = []
+            return
+
+        if self.schema is None:
+            self.schema = ODBC.schema(data)
+            self.schema_data = {'$schema': data['$schema']}
+            for column in self.key:
+                if not column in self.schema:
+                    self.error = "Missing key column '%s' in query." % column
+                    self._done = True
+                    self._rows = []
+                    return
+
+        self._rows = data['']
+        if len(self._rows) < self.page_size:
+            self._done = True
+
+    def pages(self):
+        """Generator that yields one list of ODBCData per page."""
+        while self._rows:
+            page = [ODBCData(self.schema, row) for row in self._rows]
+            self._rows = []
+            self.count += len(page)
+            yield page
+
+            if self._done:
+                break
+            last = page[-1].data
+            self._last = [self._literal(column, last[column])
+                          for column in self.key]
+            self._fetch()
+
+    def __iter__(self):
+        for page in self.pages():
+            for odbcdata in page:
+                yield odbcdata
+
+
+class TableFingerprint(object):
+    """The result of ODBC.fingerprint().  As with ODBCCursor, 'error' is
+       set if the query failed."""
+
+    STMT = "SELECT COUNT(*), " + \
+           "MD5(COALESCE(STRING_AGG(CAST(%s AS TEXT), ',' ORDER BY t.%s), " + \
+           "'')) FROM %s t"
+
+    def __init__(self, table, columns, data):
+        self.table = table
+        # Different column lists of the same table are cached separately.
+        self.key = table + ':' + ','.join(columns or ['*'])
+        self.data = data
+        self.error = None
+        self.count = None
+        self.value = None
+
+        if 'error' in data:
+            self.error = data['error']
+        elif not data.get(''):
+            self.error = "Missing '' key in query response."
+        else:
+            row = data[''][0]
+            self.count = int(row[0])
+            self.value = row[1]
+
+    def todict(self):
+        return {u'table': self.table,
+                u'count': self.count,
+                u'unchanged': True}
+
+
 class ODBCData(object):
 
     def __init__(self, schema, row):
@@ -1,6 +1,7 @@
 import sys
 import argparse
 import socket
+import threading
 import json
 import hashlib
 import ntpath
@@ -19,9 +20,27 @@ class CommException(StandardError):
         self.errnum = errnum
         self.message = message
 
+def _local_property(name, default=None):
+    """A property whose value is per-thread, so one CommBase instance can
+       be shared by the threads of the webapp."""
+    def fget(self):
+        return getattr(self.local, name, default)
+    def fset(self, value):
+        setattr(self.local, name, value)
+    return property(fget, fset)
+
 class CommBase(object):
     # pylint: disable=too-many-instance-attributes
+
+    connected = _local_property('connected', False)
+    sock = _local_property('sock')
+    conn = _local_property('conn')
+    command = _local_property('command', "")
+    result = _local_property('result', "")
+    response = _local_property('response', "")
+
     def __init__(self):
+        self.local = threading.local()
         self.args = None
 
         self.hostname = None
@@ -54,6 +73,12 @@ class CommBase(object):
         self.sock = self.conn.makefile('w+', 1)
         self.connected = True
 
+    def _send_line(self, line):
+        """Send a command line and return the acknowledgment line."""
+        self.sock.write(line +'\n')
+        self.sock.flush()
+        return self.sock.readline().strip()
+
     # pylint: disable=too-many-branches
     def send_cmd(self, cmd, req=None, read_response=True,
                  skip_on_wrong_state=False):
@@ -74,41 +99,45 @@ class CommBase(object):
             preamble += " /userid=%d" % userid
 
         full_command = preamble + ' ' + cmd
-        self.sock.write(full_command +'\n')
-        self.sock.flush()
-        ack = self.sock.readline().strip()
-        if self.verbose > 1:
-            print "Acknowledgment response:", ack
-        if ack != 'OK':
-            parts = ack.split()
-            if len(parts) < 2 or not parts[1].isdigit():
+        # Whether all of the output of the command has been read.
+        complete = False
+        try:
+            ack = self._send_line(full_command)
+            if self.verbose > 1:
+                print "Acknowledgment response:", ack
+            if ack != 'OK':
+                parts = ack.split()
+                if len(parts) < 2 or not parts[1].isdigit():
+                    raise CommException(CommError.COMMAND_FAILED_TO_RUN,
+                                        "Command '%s' failed: %s" % \
+                                            (self.command, ack))
+                complete = True
+                errnum = int(parts[1])
+                # Skip on BUSY or WRONG_STATE if requested
+                if skip_on_wrong_state and errnum in \
+                                (clierror.ERROR_AGENT_NOT_FOUND,
+                                 clierror.ERROR_AGENT_NOT_CONNECTED,
+                                 clierror.ERROR_BUSY,
+                                 clierror.ERROR_WRONG_STATE,
+                                 clierror.ERROR_AGENT_NOT_FOUND):
+                    print >> sys.stderr, \
+                        "Skipping command due to wrong state: '%s': %s" % \
+                                                                (cmd, ack)
+                    return
+
                 raise CommException(CommError.COMMAND_FAILED_TO_RUN,
-                                    "Command '%s' failed: %s" % \
+                                    "Command '%s' failed. Error: %s" % \
                                         (self.command, ack))
-            errnum = int(parts[1])
-            # Skip on BUSY or WRONG_STATE if requested
-            if skip_on_wrong_state and errnum in \
-                            (clierror.ERROR_AGENT_NOT_FOUND,
-                             clierror.ERROR_AGENT_NOT_CONNECTED,
-                             clierror.ERROR_BUSY,
-                             clierror.ERROR_WRONG_STATE,
-                             clierror.ERROR_AGENT_NOT_FOUND):
-                print >> sys.stderr, \
-                    "Skipping command due to wrong state: '%s': %s" % \
-                                                                    (cmd, ack)
-                return
-
-            raise CommException(CommError.COMMAND_FAILED_TO_RUN,
-                                "Command '%s' failed. Error: %s" % \
-                                    (self.command, ack))
 
-        if not read_response:
-            self._close()
-            return
+            if not read_response:
+                return
 
-        if self.verbose > 1:
-            print "Reading command response."
-        self.response = self.sock.readline()
+            if self.verbose > 1:
+                print "Reading command response."
+            self.response = self.sock.readline()
+            complete = bool(self.response)
+        finally:
+            self._release(complete)
 
         try:
             self.result = json.loads(self.response)
@@ -116,8 +145,6 @@ class CommBase(object):
             raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                 ("Can't decode json from command '%s' from " + \
                 "response: '%s': %s") % (self.command, self.response, str(ex)))
-        finally:
-            self._close()
 
         if self.verbose > 1:
             print 'Response:', self.response
@@ -139,6 +166,11 @@ class CommBase(object):
                   'response: %s') % \
                             (full_command, self.result['status']))
 
+    def _release(self, complete):
+        """Done with the connection after a command.  'complete' is True
+           if all of the output of the command was read."""
+        # pylint: disable=unused-argument
+        self._close()
 
     def _close(self):
         self.connected = False
@@ -214,13 +246,130 @@ class CommBase(object):
                                         (self.spec_str, self.spec_val))
 
 
+class CommPool(object):
+    """Thread-safe pool of keep-alive connections to the controller CLI.
+       One pool is shared by everything connecting to the same host and
+       port (see get())."""
+
+    # Must match CliHandler.END_MARKER
+    END_MARKER = '.'
+    SIZE = 8
+
+    pools = {}
+    pools_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, hostname, port):
+        with cls.pools_lock:
+            key = (hostname, port)
+            if not key in cls.pools:
+                cls.pools[key] = cls(hostname, port)
+            return cls.pools[key]
+
+    def __init__(self, hostname, port, size=SIZE):
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Open a new connection and switch it to keep-alive mode.
+           Returns (conn, sock)."""
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            conn.connect((self.hostname, self.port))
+            sock = conn.makefile('w+', 1)
+            sock.write('keepalive\n')
+            sock.flush()
+            ack = sock.readline().strip()
+            end = sock.readline().strip()
+        except socket.error, ex:
+            conn.close()
+            raise CommException(CommError.COULD_NOT_CONNECT_TO_HOST,
+                ("Could not connect to host '%s', port '%d': %s") %
+                                (self.hostname, self.port, ex))
+        if ack != 'OK' or end != self.END_MARKER:
+            self.close(conn, sock)
+            raise CommException(CommError.COMMAND_FAILED_TO_RUN,
+                                "Command 'keepalive' failed: %s" % ack)
+        return conn, sock
+
+    def acquire(self):
+        """Returns (conn, sock, reused): an idle connection if there is
+           one, otherwise a new connection."""
+        with self.lock:
+            if self.idle:
+                conn, sock = self.idle.pop()
+                return conn, sock, True
+        conn, sock = self.connect()
+        return conn, sock, False
+
+    def release(self, conn, sock, reuse):
+        """Return the connection to the pool or close it if it can't be
+           reused (or there are already enough idle connections)."""
+        if reuse:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((conn, sock))
+                    return
+        self.close(conn, sock)
+
+    def close(self, conn, sock):
+        try:
+            sock.close()
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        except socket.error:
+            pass
+
+
 class CommHandlerApp(CommBase):
+    """Used by the webapp: commands are sent over pooled keep-alive
+       connections instead of a new connection per command."""
+
+    reused = _local_property('reused', False)
+
     def __init__(self, app, hostname='localhost', port=9000):
         super(CommHandlerApp, self).__init__()
 
         self.app = app
         self.hostname = hostname
         self.port = port
+        self.pool = CommPool.get(hostname, port)
+
+    def connect(self):
+        self.conn, self.sock, self.reused = self.pool.acquire()
+        self.connected = True
+
+    def _send_line(self, line):
+        try:
+            ack = super(CommHandlerApp, self)._send_line(line)
+        except socket.error:
+            if not self.reused:
+                raise
+            ack = ''
+        if ack or not self.reused:
+            return ack
+
+        # The controller closed the idle connection: retry once on a
+        # new connection.
+        self.pool.close(self.conn, self.sock)
+        self.conn, self.sock = self.pool.connect()
+        self.reused = False
+        return super(CommHandlerApp, self)._send_line(line)
+
+    def _release(self, complete):
+        reuse = False
+        if complete:
+            try:
+                reuse = self.sock.readline().strip() == self.pool.END_MARKER
+            except socket.error:
+                pass
+        self.pool.release(self.conn, self.sock, reuse)
+        self.connected = False
+        self.conn = None
+        self.sock = None
 
 
 class CommHandlerArgs(CommBase):
@@ -5,6 +5,7 @@ import time
 from cloud import CloudManager
 from files import FileManager
 from agent import AgentVolumesEntry
+from util import sizestr
 
 logger = logging.getLogger()
 
@@ -16,9 +17,11 @@ class PlaceFile(object):
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self, server, agent, dcheck, full_path, size, auto,
-                 enable_delete=True):
+                 enable_delete=True, upload=None):
         # pylint: disable=too-many-arguments
         self.server = server
+        # A started MultipartUpload of full_path to the cloud target.
+        self.upload = upload
 
         self.copy_elapsed_time = 0
 
@@ -83,7 +86,11 @@ class PlaceFile(object):
         elif self.dcheck.target_entry.cloud_type == CloudManager.CLOUD_TYPE_GCS:
             cloud_instance = self.server.cloud.gcs
 
-        storage_body = cloud_instance.put(self.agent, self.dcheck.target_entry,
+        if self.upload:
+            storage_body = self.upload.finish()
+        else:
+            storage_body = cloud_instance.put(self.agent,
+                                          self.dcheck.target_entry,
                                           self.full_path,
                                           bucket_subdir=self.dcheck.parent_dir)
 
@@ -115,6 +122,10 @@ class PlaceFile(object):
                 (self.dcheck.target_entry.cloud_type,
                  self.dcheck.target_entry.bucket,
                  filename)
+            if 'parts' in storage_body:
+                self.info += \
+                    " Multipart upload: %d parts, %d sent during the backup." \
+                    % (storage_body['parts'], storage_body['early-parts'])
             logger.debug(self.info)
             name = os.path.join(self.dcheck.parent_dir, self.name_only)
             # Backup was copied to gcs or s3
@@ -130,6 +141,9 @@ class PlaceFile(object):
 
     def copy_to_agent(self):
         # Copy the file to a non-primary agent
+        if self.server.dedup.enabled and \
+                self.dcheck.file_type == FileManager.FILE_TYPE_BACKUP:
+            return self.copy_to_dedup()
         # Example:
         #   "Tableau Archive 202:D/palette-backups/20140127_162225.tsbak"
 
@@ -200,3 +214,44 @@ class PlaceFile(object):
             self.delete_local_backup = True
             self.copy_failed = False
             self.copied = True
+
+    def copy_to_dedup(self):
+        # Copy the backup into the deduplicating chunk store of the
+        # target volume: only the chunks it doesn't have yet are sent.
+        target_full_path = self.dcheck.target_agent.path.join(
+                                        self.dcheck.target_dir, self.name_only)
+        body = self.server.dedup.store(self.agent, self.full_path,
+                                       self.dcheck.target_entry,
+                                       target_full_path,
+                                       self.dcheck.file_type, self.auto)
+
+        if 'error' in body:
+            msg = (u"Copy of file '%s' to agent '%s:%s' failed. "+\
+                "Will leave the backup file on the primary agent. " + \
+                "Error was: %s") \
+                % (self.full_path, self.dcheck.target_agent.displayname,
+                                self.dcheck.target_dir, body['error'])
+            logger.info(msg)
+            self.info += msg
+            self.placed_file_entry = self.server.files.add(self.full_path,
+                        self.dcheck.file_type,
+                        FileManager.STORAGE_TYPE_VOL,
+                        self.dcheck.primary_entry.volid,
+                        size=self.size,
+                        auto=self.auto)
+            self.delete_local_backup = False
+            self.copied = False
+            self.copy_failed = True
+        else:
+            self.copy_elapsed_time = time.time() - self.copy_start_time
+            self.info += \
+                ("File stored (deduplicated) on agent '%s', " + \
+                 "directory: %s. %d of %d chunks were new: %s of %s.") % \
+                (self.dcheck.target_agent.displayname, self.dcheck.target_dir,
+                 body['new-chunks'], body['chunks'],
+                 sizestr(body['stored-size']), sizestr(body['size']))
+            logger.debug(self.info)
+            self.placed_file_entry = body['file-entry']
+            self.delete_local_backup = True
+            self.copy_failed = False
+            self.copied = True
@@ -0,0 +1,91 @@
+import threading
+import time
+
+class PriorityRLock(object):
+    """Reentrant lock with a priority lane.
+       When the lock is released, threads waiting with priority=True
+       (e.g. pings) are given the lock before the normal waiters.
+       Threads acquiring with polite=True (e.g. a status poll that
+       re-locks in a loop) only get the lock when nobody else waits.
+       Also records when the current owner acquired the lock so callers
+       can see how long the lock has been busy."""
+
+    def __init__(self):
+        self.owner = None
+        self.count = 0
+        self.acquired_time = None
+
+        self.priority_waiting = 0
+        self.waiting = 0
+        self.monitor = threading.Lock()
+        self.ready = threading.Condition(self.monitor)
+
+    def acquire(self, blocking=True, priority=False, polite=False):
+        """Acquire the lock.
+           Returns (for "blocking=False"):
+                True if acquired the lock
+                False if didn't acquire the lock.
+            """
+        me = threading.current_thread()
+        self.monitor.acquire()
+        try:
+            if self.owner is me:
+                self.count += 1
+                return True
+
+            if priority:
+                self.priority_waiting += 1
+            elif not polite:
+                self.waiting += 1
+            try:
+                while self.owner is not None or \
+                        (not priority and self.priority_waiting) or \
+                        (polite and self.waiting):
+                    if not blocking:
+                        return False
+                    self.ready.wait()
+            finally:
+                if priority:
+                    self.priority_waiting -= 1
+                elif not polite:
+                    self.waiting -= 1
+                    if not self.waiting and self.owner is None:
+                        # A non-blocking attempt gave up: wake up any
+                        # polite waiters it was holding back.
+                        self.ready.notifyAll()
+
+            self.owner = me
+            self.count = 1
+            self.acquired_time = time.time()
+            return True
+        finally:
+            self.monitor.release()
+
+    def release(self):
+        """Release the lock, waking up the waiters when it is free."""
+        self.monitor.acquire()
+        try:
+            if self.owner is not threading.current_thread():
+                raise RuntimeError("release: Attempt to release an " + \
+                                   "unacquired lock")
+            self.count -= 1
+            if self.count == 0:
+                self.owner = None
+                self.acquired_time = None
+                # Every waiter re-checks: priority waiters take the lock,
+                # the others wait again while a priority waiter exists.
+                self.ready.notifyAll()
+        finally:
+            self.monitor.release()
+
+    def busy(self):
+        """Returns the number of seconds another thread has held the lock
+           or None if the lock is free or held by the current thread."""
+        self.monitor.acquire()
+        try:
+            if self.owner is None or \
+                    self.owner is threading.current_thread():
+                return None
+            return time.time() - self.acquired_time
+        finally:
+            self.monitor.release()
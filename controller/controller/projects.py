@@ -1,5 +1,5 @@
 from sqlalchemy import Column, String, DateTime, Integer, BigInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -49,10 +49,16 @@ class Project(meta.Base, BaseMixin):
     @classmethod
     def sync(cls, agent):
         envid = agent.server.environment.envid
-        stmt = \
-            'SELECT id, name, owner_id, created_at, updated_at, ' +\
-            'state, description, site_id, special ' +\
-            'FROM projects'
+        names = ['id', 'name', 'owner_id', 'created_at', 'updated_at',
+                 'state', 'description', 'site_id', 'special']
+
+        # Skip the pull if the table hasn't changed since the last sync.
+        fingerprint = agent.odbc.fingerprint('projects', names)
+        if agent.server.fingerprints.unchanged(fingerprint):
+            return {u'status': 'OK', u'count': fingerprint.count,
+                    u'sync': fingerprint.todict()}
+
+        stmt = 'SELECT ' + ', '.join(names) + ' FROM projects'
 
         data = agent.odbc.execute(stmt)
         if 'error' in data:
@@ -60,32 +66,15 @@ class Project(meta.Base, BaseMixin):
         if '' not in data:
             data['error'] = "Missing '' key in query response."
 
-        ids = []
-
-        session = meta.Session()
-        for row in data['']:
-            entry = Project.get(envid, row[0], default=None)
-            if not entry:
-                entry = Project(envid=envid, id=row[0])
-                session.add(entry)
-            entry.name = row[1]
-            entry.owner_id = row[2]
-            entry.created_at = row[3]
-            entry.updated_at = row[4]
-            entry.state = row[5]
-            entry.description = row[6]
-            entry.site_id = row[7]
-            entry.special = row[8]
-            ids.append(entry.projectid)
+        rows = [dict(zip(names, row)) for row in data['']]
 
         # FIXME: don't delete - mark inactive.
-        session.query(Project).\
-            filter(not_(Project.projectid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
+        sync = cls.bulk_sync(envid, ['id'], rows, delete=True)
+        meta.Session.commit()
+        agent.server.fingerprints.save(fingerprint)
 
-        d = {u'status': 'OK', u'count': len(data[''])}
+        d = {u'status': 'OK', u'count': len(data['']),
+             u'sync': sync.todict()}
         return d
 
     @classmethod
@@ -0,0 +1,334 @@
+""" Compressed, delta encoded storage of archived twb/tds contents. """
+import difflib
+import json
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime
+from sqlalchemy import LargeBinary, Index, func, text, event
+from sqlalchemy.orm import deferred
+
+import akiri.framework.sqlalchemy as meta
+
+logger = logging.getLogger()
+
+class RevisionContentEntry(meta.Base):
+    """The contents of one archived workbook or datasource revision.
+       'data' is either the zlib compressed text (a keyframe, base is
+       None) or the zlib compressed delta against the revision 'base'."""
+    # pylint: disable=no-init
+    __tablename__ = 'revision_contents'
+
+    kind = Column(String, primary_key=True)      # 'workbook', 'datasource'
+    updateid = Column(BigInteger, primary_key=True)  # wuid or dsuid
+    parentid = Column(BigInteger, nullable=False)    # workbookid or dsid
+    base = Column(BigInteger)
+    # Number of deltas applied to get to this revision from a keyframe.
+    depth = Column(Integer, nullable=False, default=0)
+    size = Column(BigInteger)   # uncompressed size (in characters)
+    stored_size = Column(BigInteger)
+    data = deferred(Column(LargeBinary, nullable=False))
+    creation_time = Column(DateTime, server_default=func.now())
+
+Index('revision_contents_kind_parentid_updateid_idx', \
+          RevisionContentEntry.kind, RevisionContentEntry.parentid, \
+          RevisionContentEntry.updateid)
+
+
+class RevisionCache(object):
+    """LRU cache of reconstructed contents, bounded by their total size."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                # Move to the most recently used end.
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, value = self.entries.popitem(last=False)
+                self.size -= len(value)
+
+    def remove(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+
+
+class RevisionStore(object):
+    """Stores the text of each revision as a line delta against the
+       previous archived revision of the same workbook/datasource, with a
+       full keyframe every KEYFRAME_INTERVAL revisions (or whenever the
+       delta isn't smaller).  Reading a revision applies at most
+       KEYFRAME_INTERVAL - 1 deltas; the results are kept in an LRU cache
+       shared by all threads of the process.
+
+       Writes are added to meta.Session and committed by the caller.
+       Until then the written contents are only seen by the writing
+       thread: they are added to the cache when the session commits and
+       dropped if it doesn't.
+    """
+
+    KEYFRAME_INTERVAL = 10
+    CACHE_SIZE = 64 * 1024 * 1024   # characters
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, kind, table, key):
+        self.kind = kind
+        # The update table and its primary key, e.g. workbook_updates.wuid
+        self.table = table
+        self.key = key
+        self.cache = RevisionCache(self.CACHE_SIZE)
+        # updateid -> contents written by this thread, not committed yet.
+        # (meta.Session is per thread.)
+        self.local = threading.local()
+        event.listen(meta.Session, 'after_commit', self._after_commit)
+        # Also called after a commit, and when the session is closed or
+        # removed without one.
+        event.listen(meta.Session, 'after_transaction_end',
+                     self._after_transaction_end)
+
+    def _pending(self):
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = {}
+        return self.local.pending
+
+    def _after_commit(self, session):
+        # pylint: disable=unused-argument
+        pending = self._pending()
+        for updateid, contents in pending.iteritems():
+            self.cache.put(updateid, contents)
+        pending.clear()
+
+    def _after_transaction_end(self, session, transaction):
+        # pylint: disable=unused-argument
+        if transaction.parent is None:
+            self._pending().clear()
+
+    @classmethod
+    def _text(cls, contents):
+        if isinstance(contents, unicode):
+            return contents
+        return contents.decode('utf-8', 'replace')
+
+    @classmethod
+    def _delta(cls, base, contents):
+        """Returns a list of operations that turn 'base' into 'contents':
+           [start, end] copies those lines of base and a string is
+           inserted as is."""
+        base_lines = base.splitlines(True)
+        lines = contents.splitlines(True)
+        matcher = difflib.SequenceMatcher(None, base_lines, lines)
+        ops = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                ops.append([i1, i2])
+            elif j2 > j1:
+                ops.append(u''.join(lines[j1:j2]))
+        return ops
+
+    @classmethod
+    def _apply(cls, base, ops):
+        base_lines = base.splitlines(True)
+        parts = []
+        for op in ops:
+            if isinstance(op, list):
+                parts.extend(base_lines[op[0]:op[1]])
+            else:
+                parts.append(op)
+        return u''.join(parts)
+
+    def put(self, updateid, parentid, contents):
+        """Store the contents of a revision (replacing any previous)."""
+        contents = self._text(contents)
+        data = zlib.compress(contents.encode('utf-8'), self.COMPRESS_LEVEL)
+        base = None
+        depth = 0
+
+        # The closest earlier revision that was archived.
+        prev = meta.Session.query(RevisionContentEntry.updateid,
+                                  RevisionContentEntry.depth).\
+            filter(RevisionContentEntry.kind == self.kind).\
+            filter(RevisionContentEntry.parentid == parentid).\
+            filter(RevisionContentEntry.updateid < updateid).\
+            order_by(RevisionContentEntry.updateid.desc()).\
+            first()
+
+        if prev and prev[1] + 1 < self.KEYFRAME_INTERVAL:
+            base_contents = self.get(prev[0])
+            if base_contents is not None:
+                ops = self._delta(base_contents, contents)
+                delta = zlib.compress(json.dumps(ops, separators=(',', ':')),
+                                      self.COMPRESS_LEVEL)
+                if len(delta) < len(data):
+                    data = delta
+                    base = prev[0]
+                    depth = prev[1] + 1
+
+        entry = RevisionContentEntry(kind=self.kind, updateid=updateid,
+                                     parentid=parentid, base=base,
+                                     depth=depth, size=len(contents),
+                                     stored_size=len(data), data=data)
+        meta.Session.merge(entry)
+        self.cache.remove(updateid)
+        self._pending()[updateid] = contents
+        logger.debug("revision store: %s %d: %d -> %d bytes (%s)",
+                     self.kind, updateid, len(contents), len(data),
+                     base is None and 'keyframe' or 'delta')
+
+    def get(self, updateid):
+        """Returns the contents of a revision or None if not stored."""
+        pending = self._pending()
+        if updateid in pending:
+            return pending[updateid]
+        contents = self.cache.get(updateid)
+        if contents is not None:
+            return contents
+
+        # Walk back to a keyframe or a cached revision.
+        chain = []
+        key = updateid
+        while True:
+            row = meta.Session.query(RevisionContentEntry.base,
+                                     RevisionContentEntry.data).\
+                filter(RevisionContentEntry.kind == self.kind).\
+                filter(RevisionContentEntry.updateid == key).\
+                first()
+            if row is None:
+                if chain:
+                    logger.error("revision store: %s %d: missing base %d",
+                                 self.kind, updateid, key)
+                return None
+            base, data = row
+            if base is None:
+                contents = zlib.decompress(data).decode('utf-8')
+                break
+            chain.append(json.loads(zlib.decompress(data)))
+            key = base
+            contents = pending.get(key)
+            if contents is not None:
+                break
+            contents = self.cache.get(key)
+            if contents is not None:
+                break
+
+        for ops in reversed(chain):
+            contents = self._apply(contents, ops)
+        if not key in pending:
+            self.cache.put(updateid, contents)
+        return contents
+
+    def remove(self, updateids):
+        """Remove the stored contents of the given revisions.
+           Revisions stored as a delta against one of them are rewritten
+           as keyframes first."""
+        updateids = set(updateids)
+        if not updateids:
+            return
+        dependents = meta.Session.query(RevisionContentEntry).\
+            filter(RevisionContentEntry.kind == self.kind).\
+            filter(RevisionContentEntry.base.in_(updateids)).\
+            all()
+        for entry in dependents:
+            if entry.updateid in updateids:
+                continue
+            contents = self.get(entry.updateid)
+            if contents is None:
+                # Its chain was already broken: it can't be rebuilt.
+                logger.error("revision store: %s %d can't be read, " + \
+                             "removing it", self.kind, entry.updateid)
+                updateids.add(entry.updateid)
+                continue
+            entry.data = zlib.compress(contents.encode('utf-8'),
+                                       self.COMPRESS_LEVEL)
+            entry.stored_size = len(entry.data)
+            entry.base = None
+            entry.depth = 0
+
+        meta.Session.query(RevisionContentEntry).\
+            filter(RevisionContentEntry.kind == self.kind).\
+            filter(RevisionContentEntry.updateid.in_(updateids)).\
+            delete(synchronize_session=False)
+        pending = self._pending()
+        for updateid in updateids:
+            pending.pop(updateid, None)
+            self.cache.remove(updateid)
+
+    def prune(self):
+        """Remove the contents of revisions that no longer exist,
+           i.e. whose workbook/datasource was deleted."""
+        stmt = text(("DELETE FROM revision_contents c " + \
+                     "WHERE c.kind = :kind AND NOT EXISTS " + \
+                     "(SELECT 1 FROM %s u WHERE u.%s = c.updateid)") % \
+                    (self.table, self.key))
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(stmt, kind=self.kind)
+        finally:
+            connection.close()
+        return result.rowcount
+
+    def migrate(self, entry_class, parent_attr, text_attr, batch=50):
+        """Move the contents still held in the 'text_attr' column of the
+           update rows into the store, oldest first so the deltas chain,
+           and clear the column.  Returns the number of rows converted."""
+        key_column = getattr(entry_class, self.key)
+        parent_column = getattr(entry_class, parent_attr)
+        text_column = getattr(entry_class, text_attr)
+
+        session = meta.Session()
+        rows = session.query(key_column, parent_column).\
+            filter(text_column != None).\
+            order_by(parent_column, key_column).\
+            all()
+
+        count = 0
+        for updateid, parentid in rows:
+            entry = session.query(entry_class).\
+                filter(key_column == updateid).\
+                one()
+            self.put(updateid, parentid, getattr(entry, text_attr))
+            setattr(entry, text_attr, None)
+            count += 1
+            if count % batch == 0:
+                session.commit()
+        session.commit()
+        logger.info("revision store: migrated %d %s revisions",
+                    count, self.kind)
+        return count
+
+    def stats(self):
+        stmt = text("SELECT COUNT(*), COUNT(base), " + \
+                    "COALESCE(SUM(size), 0), " + \
+                    "COALESCE(SUM(stored_size), 0) " + \
+                    "FROM revision_contents WHERE kind = :kind")
+        connection = meta.get_connection()
+        try:
+            row = connection.execute(stmt, kind=self.kind).fetchone()
+        finally:
+            connection.close()
+        return {'revisions': row[0],
+                'deltas': row[1],
+                'size': row[2],
+                'stored-size': row[3],
+                'cached': len(self.cache.entries),
+                'cached-size': self.cache.size}
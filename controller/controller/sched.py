@@ -4,6 +4,7 @@ import time
 import subprocess
 import threading
 import re
+import Queue
 
 from datetime import datetime
 
@@ -15,9 +16,41 @@ import akiri.framework.sqlalchemy as meta
 from mixin import BaseDictMixin
 from event_control import EventControl
 from croniter import Croniter
+from clihandler import LocalCliHandler
 
 logger = logging.getLogger()
 
+class NativeJob(object):
+    """A job that runs its CLI commands inside the controller process
+       instead of forking the script of the same name in sched_dir.
+       The commands are the ones the script would have sent over telnet.
+       A 'background' job does not hold back the jobs of the next
+       priority (the scripts for these forked and returned at once)."""
+
+    def __init__(self, name, commands, background=False):
+        self.name = name
+        self.commands = commands
+        self.background = background
+
+    def lines(self, envid):
+        preamble = '/envid=%d /type=primary' % envid
+        return [preamble + ' ' + command for command in self.commands]
+
+NATIVE_JOBS = dict([(job.name, job) for job in [
+    NativeJob('sync', ['sync']),
+    NativeJob('auth_import', ['auth import']),
+    NativeJob('workbook',
+              ['workbook import', 'workbook fixup', 'http_request import'],
+              background=True),
+    NativeJob('datasource', ['datasource import', 'datasource fixup'],
+              background=True),
+    NativeJob('extract', ['extract import', 'extract archive'],
+              background=True),
+    NativeJob('cpu_load', ['metric']),
+    NativeJob('yml', ['yml']),
+    NativeJob('checkports', ['checkports'])
+]])
+
 class Sched(threading.Thread):
 
     def __init__(self, server):
@@ -38,6 +71,10 @@ class Sched(threading.Thread):
                                            "sched_dir",
                                            default="/var/palette/sched")
 
+        workers = server.config.getint("palette", "sched_workers",
+                                       default=JobRunner.DEFAULT_WORKERS)
+        self.runner = JobRunner(self.handler, workers)
+
         # Don't start until populate() is called and finishes or
         # the two threads (popualte and scheduler) can conflict with
         # the database
@@ -48,18 +85,18 @@ class Sched(threading.Thread):
             now = time.time()
             nexttime = 61 +  now - (now % 60) # start of the minute
 
+            batch = []
             for job in Crontab.get_ready_jobs():
                 logger.debug("JOB: %s, priority %s, enabled %s", job.name,
                                       str(job.priority), str(job.enabled))
                 if not job.enabled:
                     continue
-                try:
-                    self.handler(job.name)
-                except StandardError, ex:
-                    self.server.error("Job '%s':" + str(ex))
                 job.set_next_run_time()
+                batch.append((job.priority, job.name, job.next_run_time))
 
             meta.Session.commit()
+            if batch:
+                self.runner.dispatch(batch)
             time.sleep(nexttime - now)
 
     # pylint: disable=too-many-arguments
@@ -94,7 +131,8 @@ class Sched(threading.Thread):
         for job in jlist:
             if job['hour'].isdigit():
                 job['hour'] = (int(job['hour']) - self._utc_ahead()) % 24
-        return {'jobs': jlist}
+            job.update(self.runner.stats(job['name']))
+        return {'jobs': jlist, 'workers': self.runner.workers}
 
     def delete(self, names):
         body = {}
@@ -231,6 +269,136 @@ class Crontab(meta.Base, BaseDictMixin):
         meta.Session.commit()
 
 
+class JobStats(object):
+    """Run time statistics of one job (in-memory only)."""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.skips = 0
+        self.overruns = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def todict(self):
+        if self.runs:
+            average = round(self.total_duration / self.runs, 3)
+        else:
+            average = None
+        return {'runs': self.runs,
+                'failures': self.failures,
+                'skips': self.skips,
+                'overruns': self.overruns,
+                'last-duration': self.last_duration,
+                'max-duration': round(self.max_duration, 3),
+                'average-duration': average}
+
+
+class JobRunner(object):
+    """Runs the jobs that are ready on a bounded pool of worker threads.
+
+    The jobs of a batch are started in priority order: every job of one
+    priority runs concurrently and the next priority starts when the
+    non-background jobs of the previous one have finished.  A job that is
+    still running when it is ready again is skipped (counted in 'skips');
+    a job that finishes after its next run time counts as an overrun."""
+
+    DEFAULT_WORKERS = 8
+
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.running = {}   # name -> threading.Event set on completion
+        self.jobstats = {}  # name -> JobStats
+
+        for _ in xrange(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _stats(self, name):
+        if name not in self.jobstats:
+            self.jobstats[name] = JobStats()
+        return self.jobstats[name]
+
+    def stats(self, name):
+        with self.lock:
+            body = self._stats(name).todict()
+            body['running'] = name in self.running
+            return body
+
+    def dispatch(self, batch):
+        """Start a batch of (priority, name, next_run_time) tuples that are
+        already ordered by priority.  Returns immediately."""
+        thread = threading.Thread(target=self._dispatch, args=(batch,))
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self, batch):
+        levels = []
+        for priority, name, next_run_time in batch:
+            if not levels or levels[-1][0] != priority:
+                levels.append((priority, []))
+            levels[-1][1].append((name, next_run_time))
+
+        for _, jobs in levels:
+            waits = []
+            for name, next_run_time in jobs:
+                done = self.submit(name, next_run_time)
+                if done is None:
+                    continue
+                job = NATIVE_JOBS.get(name)
+                if job is None or not job.background:
+                    waits.append(done)
+            for done in waits:
+                done.wait()
+
+    def submit(self, name, next_run_time=None):
+        """Queue the job unless it is still running (or queued).
+        Returns an Event that is set when the job finishes or None if
+        the job was skipped."""
+        with self.lock:
+            if name in self.running:
+                self._stats(name).skips += 1
+                logger.info("sched job '%s' is still running: SKIPPED", name)
+                return None
+            done = threading.Event()
+            self.running[name] = done
+        self.queue.put((name, next_run_time))
+        return done
+
+    def _worker(self):
+        while True:
+            name, next_run_time = self.queue.get()
+            start = time.time()
+            failed = False
+            try:
+                self.handler(name)
+            except StandardError:
+                logger.exception("sched job '%s' failed", name)
+                failed = True
+            finally:
+                duration = time.time() - start
+                with self.lock:
+                    stats = self._stats(name)
+                    stats.runs += 1
+                    if failed:
+                        stats.failures += 1
+                    stats.last_duration = round(duration, 3)
+                    stats.total_duration += duration
+                    stats.max_duration = max(stats.max_duration, duration)
+                    if next_run_time is not None and \
+                                    datetime.utcnow() > next_run_time:
+                        stats.overruns += 1
+                        logger.info("sched job '%s' overran its next run "
+                                    "time: %.1f seconds", name, duration)
+                    done = self.running.pop(name)
+                done.set()
+
+
 class JobHandler(object):
 
     def __init__(self, scheduler):
@@ -245,6 +413,10 @@ class JobHandler(object):
             return
 
         logger.debug("sched command: %s", name)
+        if name in NATIVE_JOBS:
+            self.run_native(NATIVE_JOBS[name])
+            return
+
         path = os.path.join(self.scheduler.sched_dir, name)
 
         if not os.path.exists(path):
@@ -281,3 +453,14 @@ class JobHandler(object):
                               "stdout: '%s', stderr: '%s'",
                               path, process.returncode, stdout, stderr)
         return
+
+    def run_native(self, job):
+        envid = self.server.environment.envid
+        handler = LocalCliHandler(self.server, job.lines(envid))
+        for line in handler.run():
+            if line.startswith('ERROR'):
+                # e.g. wrong state or no agent: the same errors the
+                # scripts ignored with 'skip_on_wrong_state'.
+                logger.info("sched job '%s': %s", job.name, line)
+            else:
+                logger.debug("sched job '%s': %s", job.name, line)
@@ -1,6 +1,6 @@
 from sqlalchemy import Column, String, DateTime, Boolean
 from sqlalchemy import Integer, BigInteger, SmallInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -52,13 +52,19 @@ class Site(meta.Base, BaseMixin):
     @classmethod
     def sync(cls, agent):
         envid = agent.server.environment.envid
-        stmt = \
-            'SELECT id, name, status, created_at, updated_at, ' +\
-            'user_quota, content_admin_mode, storage_quota, metrics_level, '+\
-            'status_reason, subscriptions_enabled, ' +\
-            'custom_subscription_footer, custom_subscription_email, '+\
-            'luid, query_limit, url_namespace ' +\
-            'FROM sites'
+        names = ['id', 'name', 'status', 'created_at', 'updated_at',
+                 'user_quota', 'content_admin_mode', 'storage_quota',
+                 'metrics_level', 'status_reason', 'subscriptions_enabled',
+                 'custom_subscription_footer', 'custom_subscription_email',
+                 'luid', 'query_limit', 'url_namespace']
+
+        # Skip the pull if the table hasn't changed since the last sync.
+        fingerprint = agent.odbc.fingerprint('sites', names)
+        if agent.server.fingerprints.unchanged(fingerprint):
+            return {u'status': 'OK', u'count': fingerprint.count,
+                    u'sync': fingerprint.todict()}
+
+        stmt = 'SELECT ' + ', '.join(names) + ' FROM sites'
 
         data = agent.odbc.execute(stmt)
         if 'error' in data:
@@ -67,39 +73,15 @@ class Site(meta.Base, BaseMixin):
             data['error'] = "Missing '' key in query response."
             return data
 
-        ids = []
-
-        session = meta.Session()
-        for row in data['']:
-            entry = Site.get(envid, row[0], default=None)
-            if not entry:
-                entry = Site(envid=envid, id=row[0])
-                session.add(entry)
-            entry.name = row[1]
-            entry.status = row[2]
-            entry.created_at = row[3]
-            entry.updated_at = row[4]
-            entry.user_quota = row[5]
-            entry.content_admin_mode = row[6]
-            entry.storage_quota = row[7]
-            entry.metrics_level = row[8]
-            entry.status_reason = row[9]
-            entry.subscriptions_enabled = row[10]
-            entry.custom_subscription_footer = row[11]
-            entry.custom_subscription_email = row[12]
-            entry.luid = row[13]
-            entry.query_limit = row[14]
-            entry.url_namespace = row[15]
-            ids.append(entry.siteid)
+        rows = [dict(zip(names, row)) for row in data['']]
 
         # FIXME: don't delete
-        session.query(Site).\
-            filter(not_(Site.siteid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
+        sync = cls.bulk_sync(envid, ['id'], rows, delete=True)
+        meta.Session.commit()
+        agent.server.fingerprints.save(fingerprint)
 
-        d = {u'status': 'OK', u'count': len(data[''])}
+        d = {u'status': 'OK', u'count': len(data['']),
+             u'sync': sync.todict()}
         return d
 
     @classmethod
@@ -15,6 +15,7 @@ from ..util import str2bool, translate_key
 
 from .keys import SystemKeys
 from .defaults import DEFAULTS
+from .cache import SystemCache, MISSING
 
 def cast(key, value):
     """ Find the native type of key in DEFAULTS and return 'value'
@@ -72,22 +73,36 @@ class SystemMixin(object):
         meta.commit()
 
 class SystemManager(Manager, DictMixin, SystemMixin):
-    """ Non-caching manager for the system table.  It can behave like a dict
-    with get/set performaning the database operation.  """
+    """ Caching manager for the system table.  It can behave like a dict
+    with get/set performaning the database operation.  Reads are served
+    from a SystemCache which is updated on every write made through this
+    class and revalidated against the database every
+    'system_cache_interval' seconds to pick up writes from the webapp. """
+
+    DEFAULT_CACHE_INTERVAL = 5 # seconds
+
+    def __init__(self, server):
+        super(SystemManager, self).__init__(server)
+        interval = self.DEFAULT_CACHE_INTERVAL
+        if hasattr(server, 'config'):
+            interval = server.config.getint('controller',
+                                            'system_cache_interval',
+                                            default=interval)
+        self.cache = SystemCache(interval)
 
     def entry(self, key, **kwargs):
-        """ Return the SystemEntry for this key. """
+        """ Return the SystemEntry for this key (not cached). """
         try:
             return SystemEntry.get_by_key(self.envid, key, **kwargs)
         except ValueError:
             return None
 
     def __getitem__(self, key):
-        """ Returns the value of the system key from the database or the
+        """ Returns the value of the system key from the cache or the
         keys default if not overridden in the database."""
-        entry = self.entry(key)
-        if entry:
-            return cast(key, entry.value)
+        value = self.cache.get(self.envid, key, default=MISSING)
+        if value is not MISSING:
+            return cast(key, value)
         if key not in DEFAULTS:
             raise KeyError("Invalid system key : " + key)
         value = DEFAULTS[key]
@@ -104,10 +119,27 @@ class SystemManager(Manager, DictMixin, SystemMixin):
         session = meta.Session()
         entry = SystemEntry(envid=self.envid, key=key, value=str(value))
         session.merge(entry)
+        # Invalidating here would let another thread reload the old value
+        # before the caller commits.
+        self.cache.set(self.envid, key, str(value))
 
     def __delitem__(self, key):
         """ Delete a row from the system table. """
         SystemEntry.delete(filters={'envid':self.envid, 'key':key})
+        self.cache.set(self.envid, key, MISSING)
+
+    def save(self, key, value):
+        """ Update the database, commit and invalidate the cache. """
+        SystemMixin.save(self, key, value)
+        self.invalidate()
+
+    def invalidate(self):
+        """ Force the next lookup to reload the system table. """
+        self.cache.invalidate(self.envid)
+
+    def stats(self):
+        """ Return lookup and hit-rate counters for the cache. """
+        return self.cache.stats()
 
     def todict(self, pretty=False, include_defaults=False):
         """ Import the system table as a dict (used by event_control) """
@@ -115,9 +147,9 @@ class SystemManager(Manager, DictMixin, SystemMixin):
             data = DEFAULTS.todict(pretty=pretty)
         else:
             data = {}
-        for entry in SystemEntry.get_all(self.envid):
+        for key, value in self.cache.items(self.envid):
             try:
-                data[translate_key(entry.key, pretty=pretty)] = entry.typed()
+                data[translate_key(key, pretty=pretty)] = cast(key, value)
             except ValueError:
                 raise
         return data
@@ -0,0 +1,146 @@
+""" In-process cache of the 'system' table, shared by all controller threads.
+"""
+# pylint: enable=missing-docstring,relative-import
+import threading
+import time
+
+import akiri.framework.sqlalchemy as meta
+
+# Marker for a key that has no row in the system table.
+MISSING = object()
+
+class SystemCache(object):
+    """ Cache of the raw (string) values of the system table per envid.
+
+    The whole table for an environment is loaded at once.  Writes made
+    through the SystemManager are stored in the cache directly.  Writes
+    made by other processes (e.g. the webapp) are noticed by a cheap
+    version query - count(*) and max(modification_time) - which is run
+    at most once every 'interval' seconds.
+
+    The values are read through a separate connection so that only
+    committed data is loaded.  A value stored by a write that is not
+    committed yet is dropped by the next version check, which reloads
+    the table (see set()).
+    """
+
+    VERSION_STMT = "SELECT COUNT(*), MAX(modification_time) FROM system " + \
+                   "WHERE envid = %d"
+    LOAD_STMT = "SELECT key, value FROM system WHERE envid = %d"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.RLock()
+
+        self._data = {}         # envid -> {key: value}
+        self._versions = {}     # envid -> (count, max modification_time)
+        self._checked = {}      # envid -> time of the last version check
+
+        self.lookups = 0
+        self.hits = 0
+        self.loads = 0
+        self.version_checks = 0
+        self.invalidations = 0
+
+    def _version(self, envid):
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(self.VERSION_STMT % envid)
+            row = result.fetchone()
+        finally:
+            connection.close()
+        self.version_checks += 1
+        return (row[0], row[1])
+
+    def _load(self, envid):
+        version = self._version(envid)
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(self.LOAD_STMT % envid)
+            data = dict([(row[0], row[1]) for row in result])
+        finally:
+            connection.close()
+        self._data[envid] = data
+        self._versions[envid] = version
+        self._checked[envid] = time.time()
+        self.loads += 1
+        return data
+
+    def _current(self, envid):
+        """ Return the data for envid, reloading it if it is missing or
+        the version has changed.  The second value is True on a hit. """
+        if not envid in self._data:
+            return self._load(envid), False
+
+        now = time.time()
+        if now - self._checked[envid] < self.interval:
+            return self._data[envid], True
+
+        version = self._version(envid)
+        self._checked[envid] = now
+        if version != self._versions[envid]:
+            return self._load(envid), False
+        return self._data[envid], True
+
+    def get(self, envid, key, default=None):
+        """ Return the raw string value for key or 'default' if the key is
+        not in the table (i.e. the default value should be used). """
+        with self._lock:
+            self.lookups += 1
+            data, hit = self._current(envid)
+            if hit:
+                self.hits += 1
+            return data.get(key, default)
+
+    def items(self, envid):
+        """ Return a list of (key, raw value) tuples for all rows. """
+        with self._lock:
+            self.lookups += 1
+            data, hit = self._current(envid)
+            if hit:
+                self.hits += 1
+            return data.items()
+
+    def set(self, envid, key, value):
+        """ Store the value of a key written through the SystemManager,
+        or remove it if value is MISSING.  The write may not be committed
+        yet and a concurrent load may have cached the old row, so the
+        version is cleared: the next version check reloads the table.
+        Either way a wrong value is served for 'interval' seconds at most.
+        """
+        with self._lock:
+            if not envid in self._data:
+                self._load(envid)
+            if value is MISSING:
+                self._data[envid].pop(key, None)
+            else:
+                self._data[envid][key] = value
+            self._versions[envid] = None
+
+    def invalidate(self, envid=None):
+        """ Drop the cached data for envid or for all environments. """
+        with self._lock:
+            self.invalidations += 1
+            if envid is None:
+                self._data = {}
+                self._versions = {}
+                self._checked = {}
+            elif envid in self._data:
+                del self._data[envid]
+                del self._versions[envid]
+                del self._checked[envid]
+
+    def stats(self):
+        """ Return the cache counters as a dict (used by the CLI). """
+        with self._lock:
+            if self.lookups:
+                hit_rate = round(100.0 * self.hits / self.lookups, 2)
+            else:
+                hit_rate = 0.0
+            return {'lookups': self.lookups,
+                    'hits': self.hits,
+                    'hit-rate': hit_rate,
+                    'loads': self.loads,
+                    'version-checks': self.version_checks,
+                    'invalidations': self.invalidations,
+                    'interval': self.interval}
@@ -128,6 +128,8 @@ DEFAULTS = SystemDefaults({
 
     SystemKeys.TABCMD_TIMEOUT: 600,     # Seconds
 
+    SystemKeys.ODBC_PAGE_SIZE: 1000,    # Rows per /sql request
+
     SystemKeys.ALERTS_ENABLED: True,
     SystemKeys.ALERTS_ADMIN_ENABLED: False,
     SystemKeys.ALERTS_PUBLISHER_ENABLED: False,
@@ -114,6 +114,8 @@ class SystemKeys(object):
 
     TABCMD_TIMEOUT = 'tabcmd-timeout'
 
+    ODBC_PAGE_SIZE = 'odbc-page-size'
+
     PROXY_HTTPS = 'proxy-https'
     MAX_SILENCE_TIME = 'max-silence-time'
 
@@ -12,6 +12,7 @@ import exc
 import xml.etree.ElementTree as ET
 
 from sqlalchemy import Column, Integer, BigInteger, String, DateTime, func
+from sqlalchemy import text
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -25,7 +26,7 @@ from agent import Agent
 from event_control import EventControl
 from state_transitions import TRANSITIONS, START_DICT
 from system import SystemKeys
-from util import success
+from util import success, is_ip, hostname_only
 from yml import YmlEntry
 
 logger = logging.getLogger()
@@ -67,6 +68,64 @@ class TableauProcess(meta.Base):
     modification_time = Column(DateTime, server_default=func.now(),
                                server_onupdate=func.current_timestamp())
 
+class AgentHostMap(object):
+    """Maps the host names and IP addresses reported by Tableau to the
+       enabled agents of an environment, with the same matching rules as
+       Agent.get_agentid_from_host().  The map is rebuilt only when the
+       agent table changes: count(*) and max(modification_time)."""
+
+    def __init__(self, envid):
+        self.envid = envid
+        self.version = None
+        self.hosts = {}         # upper case hostname or ip -> agentid
+        self.displaynames = {}  # agentid -> displayname
+
+    def _version(self):
+        return meta.Session.query(func.count(Agent.agentid),
+                                  func.max(Agent.modification_time)).\
+            filter(Agent.envid == self.envid).\
+            one()
+
+    def refresh(self):
+        """Reload the map if the agent table changed (one query if not)."""
+        version = tuple(self._version())
+        if version == self.version:
+            return
+
+        hosts = {}
+        displaynames = {}
+        rows = meta.Session.query(Agent.agentid, Agent.hostname,
+                                  Agent.ip_address, Agent.displayname).\
+            filter(Agent.envid == self.envid).\
+            filter(Agent.enabled == True).\
+            all()
+        for agentid, hostname, ip_address, displayname in rows:
+            displaynames[agentid] = displayname
+            for key in (hostname and hostname.upper(), ip_address):
+                if not key:
+                    continue
+                if key in hosts and hosts[key] != agentid:
+                    # Ambiguous: get_agentid_from_host() finds nothing.
+                    hosts[key] = None
+                else:
+                    hosts[key] = agentid
+
+        self.hosts = hosts
+        self.displaynames = displaynames
+        self.version = version
+
+    def get_agentid(self, host):
+        """Returns the agentid for host or None if no (single) enabled
+           agent has that hostname or IP address."""
+        if is_ip(host):
+            return self.hosts.get(host)
+        return self.hosts.get(hostname_only(host).upper())
+
+    def get_displayname(self, agentid):
+        if agentid in self.displaynames:
+            return self.displaynames[agentid]
+        return "Unknown"
+
 class TableauStatusMonitor(threading.Thread):
     # pylint: disable=too-many-instance-attributes
 
@@ -108,21 +167,34 @@ class TableauStatusMonitor(threading.Thread):
         self.first_degraded_time = None
         self.sent_degraded_event = False
 
+        self.hostmap = AgentHostMap(self.envid)
+        # The committed contents of the status table:
+        #   {(agentid, name, pid): status} or None if it must be reloaded.
+        # The pid (the worker port for systeminfo) is part of the key as
+        # a service can run several instances on one machine.
+        self.processes = None
+        # What the current status check wrote (not yet committed).
+        self.pending_processes = None
+        # Incremented by remove_all_status(): a status check that started
+        # before doesn't set 'processes' (see _finish_status()).
+        self.generation = 0
+        self.pending_generation = None
+        self.status_lock = threading.Lock()
+
         logger.setLevel(self.system[SystemKeys.DEBUG_LEVEL])
 
         # Start fresh: status table
-        session = meta.Session()
         self.remove_all_status()
-        session.commit()
 
         self.stateman = StateManager(self.server)
 
     # Remove all entries to get ready for new status info.
     def remove_all_status(self):
         """
-            Note a session is passed.  When updating the status table,
-            we don't want everything to go away (commit) until we've added
-            the new entries.
+            Empty the status table and commit.  It may be called by
+            another thread while a status check is running: that check
+            won't remember what it wrote, so the next one reloads the
+            table.
         """
 
         # FIXME: Need to figure out how to do this in session.query:
@@ -141,25 +213,98 @@ class TableauStatusMonitor(threading.Thread):
         #   filter(TableauProcess.agentid,in_(subq)).\
         #   delete()
 
+        with self.status_lock:
+            self.generation += 1
+            self.processes = None
+            self.pending_processes = None
         meta.Session.query(TableauProcess).delete()
-
-        # Intentionally don't commit here.  We want the existing
-        # rows to be available until the new rows are inserted and
-        # committed.
-
-    def _add(self, agentid, name, pid, status):
-        """Note a session is passed.  When updating the status table, we
-        do remove_all_status, then slowly add in the new status before
-        doing the commit, so the table is not every empty/building if
-        somebody checks it.
+        meta.Session.commit()
+        # Again, for a status check that started before the commit.
+        with self.status_lock:
+            self.generation += 1
+            self.processes = None
+
+    def _load_processes(self):
+        """Read the current contents of the status table."""
+        rows = meta.Session.query(TableauProcess.agentid,
+                                  TableauProcess.name,
+                                  TableauProcess.pid,
+                                  TableauProcess.status).\
+            all()
+        return dict([((row[0], row[1], row[2]), row[3]) for row in rows])
+
+    def _write_status(self, processes):
+        """Make the status table match 'processes':
+                {(agentid, name, pid): status}
+           The new list is compared with the previous one and only the
+           rows that changed are written, with a single statement.
+           As before, nothing is committed here: see _finish_status().
         """
+        with self.status_lock:
+            prev = self.processes
+            # Until the commit in _finish_status() the table may or may not
+            # contain what is written here, so reload it if that never
+            # happens.
+            self.processes = None
+            self.pending_processes = processes
+            self.pending_generation = self.generation
+        if prev is None:
+            prev = self._load_processes()
+
+        changed = [(key, value) for key, value in processes.items() \
+                       if prev.get(key) != value]
+        removed = [key for key in prev if key not in processes]
+
+        if not changed and not removed:
+            return
 
-        session = meta.Session()
-        entry = TableauProcess(agentid=agentid, name=name,
-                               pid=pid, status=status)
-        # We merge instead of add since 'tabadmin status -v' sometimes
-        # returns duplicate lines.
-        session.merge(entry)
+        params = {}
+        ctes = []
+        if removed:
+            keys = []
+            for i, key in enumerate(removed):
+                keys.append("(:dagentid%d, :dname%d, :dpid%d)" % (i, i, i))
+                params['dagentid%d' % i] = key[0]
+                params['dname%d' % i] = key[1]
+                params['dpid%d' % i] = key[2]
+            delete = "DELETE FROM tableau_processes " + \
+                     "WHERE (agentid, name, pid) IN (" + \
+                     ", ".join(keys) + ")"
+            if not changed:
+                meta.Session.execute(text(delete), params)
+                return
+            ctes.append("removed AS (" + delete + ")")
+
+        values = []
+        for i, (key, value) in enumerate(changed):
+            values.append(("(CAST(:agentid%d AS BIGINT), :name%d, " + \
+                           "CAST(:pid%d AS INTEGER), :status%d)") % \
+                           (i, i, i, i))
+            params['agentid%d' % i] = key[0]
+            params['name%d' % i] = key[1]
+            params['pid%d' % i] = key[2]
+            params['status%d' % i] = value
+
+        ctes.insert(0, "changed (agentid, name, pid, status) AS " + \
+                    "(VALUES " + ", ".join(values) + ")")
+        ctes.append("updated AS (" + \
+                    "UPDATE tableau_processes t " + \
+                    "SET status = c.status, " + \
+                    "modification_time = NOW() " + \
+                    "FROM changed c " + \
+                    "WHERE t.agentid = c.agentid AND t.name = c.name " + \
+                    "AND t.pid = c.pid " + \
+                    "RETURNING t.agentid, t.name, t.pid)")
+        stmt = "WITH " + ", ".join(ctes) + " " + \
+               "INSERT INTO tableau_processes " + \
+               "(agentid, name, pid, status) " + \
+               "SELECT c.agentid, c.name, c.pid, c.status FROM changed c " + \
+               "WHERE NOT EXISTS (SELECT 1 FROM updated u " + \
+               "WHERE u.agentid = c.agentid AND u.name = c.name " + \
+               "AND u.pid = c.pid)"
+        meta.Session.execute(text(stmt), params)
+        logger.debug("status-check: wrote %d changed and %d removed " + \
+                     "status rows", len(changed), len(removed))
 
     def get_tableau_status(self):
         try:
@@ -378,10 +523,8 @@ class TableauStatusMonitor(threading.Thread):
 
         aconn = agent.connection
         if not aconn:
-            session = meta.Session()
             logger.debug("status-check: No primary agent currently connected.")
             self.remove_all_status()
-            session.commit()
             return
 
         # Don't do a 'tabadmin status -v' if the user is doing an action.
@@ -424,7 +567,8 @@ class TableauStatusMonitor(threading.Thread):
         session = meta.Session()
         prev_tableau_status = self.get_tableau_status()
 
-        self.remove_all_status()
+        self.hostmap.refresh()
+        processes = {}
 
         tableau_status = None
 
@@ -443,7 +587,7 @@ class TableauStatusMonitor(threading.Thread):
                                        str(machine.attrib))
 
                     host = machine.attrib['name']
-                    agentid = Agent.get_agentid_from_host(self.envid, host)
+                    agentid = self.hostmap.get_agentid(host)
 
                     if not agentid:
                         logger.error("_systeminfo_parse: No such" + \
@@ -451,11 +595,7 @@ class TableauStatusMonitor(threading.Thread):
                                      host)
                         continue
 
-                    machine_agent = Agent.get_by_id(agentid)
-                    if machine_agent:
-                        machine_displayname = machine_agent.displayname
-                    else:
-                        machine_displayname = "Unknown"
+                    machine_displayname = self.hostmap.get_displayname(agentid)
 
                     for info in machine:
                         #print "    ", info.tag, "attributes:", info.attrib
@@ -470,6 +610,8 @@ class TableauStatusMonitor(threading.Thread):
                                       "'status' in machine %s attrib: %s") % \
                                       (host, str(info.attrib)))
 
+                        # Without a worker, there is one instance.
+                        port = -1
                         if 'worker' in info.attrib:
                             worker_info = info.attrib['worker']
                             parts = worker_info.split(':')
@@ -501,7 +643,8 @@ class TableauStatusMonitor(threading.Thread):
                                                  (machine_displayname,
                                                  service_name, service_status)
 
-                        self._add(agentid, service_name, port, service_status)
+                        processes[(agentid, service_name, port)] = \
+                                                    service_status
                         logger.debug("system_info_parse: logged: " + \
                                      "%d, %s, %d, %s",
                                      agentid, service_name, port,
@@ -535,7 +678,7 @@ class TableauStatusMonitor(threading.Thread):
                 # Note: The status can never be STOPPED since if Tableau
                 # is stopped, then it won't respond to the systeminfo
                 # GET URL.
-                self._add(agent.agentid, "Status", 0, tableau_status)
+                processes[(agent.agentid, "Status", 0)] = tableau_status
             else:
                 logger.error("_systeminfo_parse: Unexpected child.tag: '%s'",
                              child.tag)
@@ -553,6 +696,7 @@ class TableauStatusMonitor(threading.Thread):
         else:
             body = None
 
+        self._write_status(processes)
         self._finish_status(agent, tableau_status, prev_tableau_status, body)
         return self.SYSTEMINFO_SUCCESS
 
@@ -654,11 +798,10 @@ class TableauStatusMonitor(threading.Thread):
            assume tableau is stopped."""
 
         prev_tableau_status = self.get_tableau_status()
-        self.remove_all_status()
         name = "Status"
         pid = 0
         tableau_status = TableauProcess.STATUS_STOPPED
-        self._add(agent.agentid, name, 0, tableau_status)
+        self._write_status({(agent.agentid, name): (pid, tableau_status)})
         logger.debug("_set_status_stopped: logged: %s, %d, %s",
                      name, pid, tableau_status)
 
@@ -781,9 +924,8 @@ class TableauStatusMonitor(threading.Thread):
         """Remove all status and set tableau status to UNKNOWN."""
 
         prev_tableau_status = self.get_tableau_status()
-        self.remove_all_status()
         tableau_status = TableauProcess.STATUS_UNKNOWN
-        self._add(agent.agentid, "Status", 0, tableau_status)
+        self._write_status({(agent.agentid, "Status"): (0, tableau_status)})
         self._finish_status(agent, tableau_status, prev_tableau_status, body)
 
     def _systeminfo_eventit(self, agent, data, systeminfo_url):
@@ -861,17 +1003,14 @@ class TableauStatusMonitor(threading.Thread):
 
         prev_tableau_status = self.get_tableau_status()
 
-        self.remove_all_status()
-        # Do not commit until after the table is added to.
-        # Otherwise, the table could be empty temporarily.
+        # The table is written only after all the lines are parsed
+        # and is not committed until _finish_status().
+        self.hostmap.refresh()
+        processes = {}
 
         tableau_status = None
         failed_proc_str = ""
-        machine_agent = Agent.get_by_id(agentid)
-        if machine_agent:
-            machine_displayname = machine_agent.displayname
-        else:
-            machine_displayname = "Unknown"
+        machine_displayname = self.hostmap.get_displayname(agentid)
         for line in lines:
             line = line.strip()
             parts = line.split(' ')
@@ -909,7 +1048,7 @@ class TableauStatusMonitor(threading.Thread):
                                      "in line: %s", line)
                         continue
 
-                    self._add(agentid, service, pid, status)
+                    processes[(agentid, service, pid)] = status
                     logger.debug("status-check: logged: %s, %d, %s", service,
                                  pid, status)
 
@@ -925,7 +1064,7 @@ class TableauStatusMonitor(threading.Thread):
             elif parts[0] == 'Status:':
                 server_status = parts[1].strip()
                 if agentid:
-                    self._add(agentid, "Status", 0, server_status)
+                    processes[(agentid, "Status", 0)] = server_status
                     if tableau_status == None or server_status == 'DEGRADED':
                         tableau_status = server_status
                 else:
@@ -936,12 +1075,9 @@ class TableauStatusMonitor(threading.Thread):
                 if line[-1:] == ':':
                     # A hostname or IP address is specified: new section
                     host = parts[0].strip().replace(':', '')
-                    agentid = Agent.get_agentid_from_host(self.envid, host)
-                    machine_agent = Agent.get_by_id(agentid)
-                    if machine_agent:
-                        machine_displayname = machine_agent.displayname
-                    else:
-                        machine_displayname = "Unknown"
+                    agentid = self.hostmap.get_agentid(host)
+                    machine_displayname = \
+                                    self.hostmap.get_displayname(agentid)
                 else:
                     # Examples:
                     #   "Connection error contacting worker 1"
@@ -953,7 +1089,7 @@ class TableauStatusMonitor(threading.Thread):
                                      "unknown or disabled agent: %s, %d, %s",
                                      line, -1, 'error')
                     else:
-                        self._add(agentid, line, -1, 'error')
+                        processes[(agentid, line, -1)] = 'error'
                         logger.debug("status-check: logged: %s, %d, %s",
                                      line, -1, 'error')
 
@@ -967,6 +1103,7 @@ class TableauStatusMonitor(threading.Thread):
             # Failed process(es) for the event
             body['info'] = failed_proc_str
 
+        self._write_status(processes)
         self._finish_status(agent, tableau_status, prev_tableau_status, body)
 
     def _finish_status(self, agent, tableau_status, prev_tableau_status, body):
@@ -989,4 +1126,7 @@ class TableauStatusMonitor(threading.Thread):
         self._set_main_state(prev_tableau_status, tableau_status, agent, body)
 
         meta.Session.commit()
+        with self.status_lock:
+            if self.pending_generation == self.generation:
+                self.processes = self.pending_processes
         aconn.user_action_unlock()
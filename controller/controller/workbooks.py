@@ -12,11 +12,11 @@ from sqlalchemy.orm.exc import NoResultFound
 import akiri.framework.sqlalchemy as meta
 
 from archive_mixin import ArchiveUpdateMixin, ArchiveException, ArchiveError
-from mixin import BaseMixin, BaseDictMixin
+from mixin import BaseMixin, BaseDictMixin, BulkSync
 from cache import TableauCacheManager #FIXME
 from manager import synchronized
 from util import failed
-from odbc import ODBC
+from revision_store import RevisionStore
 from .system import SystemKeys
 
 from diskcheck import DiskCheck, DiskException
@@ -142,7 +142,11 @@ class WorkbookUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     system_user_id = Column(Integer)
     url = Column(String)  # FIXME: make this unique.
     note = Column(String)
-    twb = deferred(Column(Text))    # the contents of the .twb file
+    # The contents of the .twb file for revisions archived before the
+    # revision store: see WorkbookManager.migrate_twb().
+    twb = deferred(Column(Text))
+
+    store = RevisionStore('workbook', 'workbook_updates', 'wuid')
 
     # NOTE: system_user_id is not a foreign key to avoid load dependencies.
 
@@ -167,6 +171,13 @@ class WorkbookUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     def get_by_url(cls, url, **kwargs):
         return cls.get_unique_by_keys({'url': url}, **kwargs)
 
+    def get_twb(self):
+        """Returns the contents of the .twb file or None."""
+        contents = self.store.get(self.wuid)
+        if contents is None:
+            contents = self.twb
+        return contents
+
 
 class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
     NAME = 'workbook'
@@ -204,7 +215,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                 logger.error("move_twb_to_db open failed: %s", str(err))
                 continue
 
-            row.twb = contents
+            WorkbookUpdateEntry.store.put(row.wuid, row.workbookid, contents)
             session.commit()
 
             twb_path = os.path.join(controller_path, row.url)
@@ -242,66 +253,58 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         if last_updated_at:
             stmt += " WHERE updated_at > '" + last_updated_at + "'"
 
-        data = agent.odbc.execute(stmt)
+        cursor = agent.odbc.cursor(stmt)
 
         updates = []
+        wuids = []
 
-        if 'error' in data or '' not in data:
-            logger.debug("workbooks load: bad data: %s", str(data))
-            return data
-
-        logger.debug(data)
+        if cursor.error:
+            logger.debug("workbooks load: bad data: %s", cursor.error)
+            return {u'error': cursor.error}
 
         # Get users only if needed
         users = None
 
-        for odbcdata in ODBC.load(data):
-            name = odbcdata.data['name']
-            revision = odbcdata.data['revision']
-            site_id = odbcdata.data['site_id']
-            project_id = odbcdata.data['project_id']
-            luid = odbcdata.data['luid']
-
-            if project_id == self.sample_project_id:
-                logger.debug(
+        sync = BulkSync(WorkbookEntry, envid,
+                        ['site_id', 'project_id', 'luid'])
+        for page in cursor.pages():
+            rows = []
+            revisions = {}
+            for odbcdata in page:
+                name = odbcdata.data['name']
+                revision = odbcdata.data['revision']
+                project_id = odbcdata.data['project_id']
+
+                if project_id == self.sample_project_id:
+                    logger.debug(
                         "workbooks load: Ignoring Tableau Sample wb: %s, %s",
                         name, revision)
-                continue
-
-            wbe = WorkbookEntry.get(envid, site_id, project_id, luid,
-                                                            default=None)
-            if wbe is None:
-                wbe = WorkbookEntry(envid=envid, site_id=site_id,
-                                    project_id=project_id, luid=luid)
-                session.add(wbe)
-
-            # NOTE: id is updated with each revision.
-            odbcdata.copyto(wbe, excludes=['revision'])
-
-            if not users:
-                users = self.load_users(agent)
-
-            system_user_id = users.get(wbe.site_id, wbe.owner_id)
-            wbe.system_user_id = system_user_id
-
-            # must commit here so that update foreign keys work.
-            session.commit()
-
-            wbu = WorkbookUpdateEntry.get(wbe.workbookid,
-                                          revision,
-                                          default=None)
-            if not wbu:
-                # The updated_at time is the publish time.
-                wbu = WorkbookUpdateEntry(workbookid=wbe.workbookid,
-                                          revision=revision,
-                                          system_user_id=system_user_id,
-                                          timestamp=wbe.updated_at,
-                                          url='')
-                session.add(wbu)
-                updates.append(wbu)
-
-            logger.debug("workbook update '%s', revision %s", name, revision)
-
+                    continue
+
+                if not users:
+                    users = self.load_users(agent)
+
+                # NOTE: id is updated with each revision.
+                row = dict(odbcdata.data)
+                del row['revision']
+                row['system_user_id'] = users.get(row['site_id'],
+                                                  row['owner_id'])
+                rows.append(row)
+                revisions[sync.key(row)] = (revision, row)
+
+            # The primary keys come back from the sync so the update rows
+            # can be added without a commit per workbook.
+            sync.run(rows)
+            new_updates = self._add_updates(sync, revisions)
+            session.flush()
+            wuids += [wbu.wuid for wbu in new_updates]
+            updates += new_updates
+
+        # Nothing is committed unless every page was read: the most recent
+        # 'updated_at' is where the next load starts.
+        if cursor.error:
+            session.rollback()
+            return {u'error': cursor.error}
         session.commit()
 
         prune_count = self._prune_missed_revisions()
@@ -312,15 +315,45 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         elif not self.cred_check():
             result = {u'error': 'Can not load workbooks: missing credentials.'}
         else:
-            # Second pass - build the archive files.
-            result = self._archive_updates(agent, updates)
+            # Second pass - the archive workers build the archive files.
+            result = self._queue_updates(wuids)
 
-        result[u'schema'] = self.schema(data)
+        result[u'schema'] = self.schema(cursor.schema_data)
+        result[u'sync'] = sync.todict()
         result[u'updates-new'] = len(updates)
         result[u'updates-missed'] = prune_count
 
         return result
 
+    def _add_updates(self, sync, revisions):
+        """Add a WorkbookUpdateEntry for each (workbook, revision) that
+           doesn't have one yet.  'revisions' maps the sync key to
+           (revision, row).  Returns the new entries."""
+        if not revisions:
+            return []
+        wbids = [sync.pks[key] for key in revisions]
+        session = meta.Session()
+        existing = set(session.query(WorkbookUpdateEntry.workbookid,
+                                     WorkbookUpdateEntry.revision).\
+                       filter(WorkbookUpdateEntry.workbookid.in_(wbids)).\
+                       all())
+        updates = []
+        for key, (revision, row) in revisions.items():
+            workbookid = sync.pks[key]
+            if (workbookid, revision) in existing:
+                continue
+            # The updated_at time is the publish time.
+            wbu = WorkbookUpdateEntry(workbookid=workbookid,
+                                      revision=revision,
+                                      system_user_id=row['system_user_id'],
+                                      timestamp=row['updated_at'],
+                                      url='')
+            session.add(wbu)
+            updates.append(wbu)
+            logger.debug("workbook update '%s', revision %s",
+                         row['name'], revision)
+        return updates
+
     def _prune_missed_revisions(self):
         """Remove rows from workbook_updates that we didn't manage to
            archive.  It may be due to bad credentials, failed tabcmd, etc.
@@ -382,6 +415,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                     all()
 
             for row in rows:
+                WorkbookUpdateEntry.store.remove([row.wuid])
                 # We have to remove the WorkbookUpdateEntry first
                 # due to the foreign key constraint in files pointing to it.
                 session.query(WorkbookUpdateEntry).\
@@ -396,10 +430,24 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                 # Fixme: We could increment only if it successfully deleted.
                 removed_count += 1
 
+        # Contents of workbooks that were deleted altogether.
+        WorkbookUpdateEntry.store.prune()
+
         return removed_count
 
+    @synchronized('workbook.migrate')
+    def migrate_twb(self):
+        """Convert the .twb contents stored in workbook_updates.twb
+           to the compressed revision store."""
+        count = WorkbookUpdateEntry.store.migrate(WorkbookUpdateEntry,
+                                                  'workbookid', 'twb')
+        result = WorkbookUpdateEntry.store.stats()
+        result[u'migrated'] = count
+        return result
+
     @synchronized('workbook.fixup')
     def fixup(self, agent):
+        # pylint: disable=unused-argument
         if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
             logger.debug("Workbook archives are not enabled. Fixup not done.")
             return {u'disabled':
@@ -408,61 +456,48 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         session = meta.Session()
 
         # potentially serveral thousand?
-        updates = session.query(WorkbookUpdateEntry).\
-                  filter(or_(WorkbookUpdateEntry.url == "",
-                         WorkbookUpdateEntry.url == None)).\
-                         all()
-
-        return self._archive_updates(agent, updates)
-
-    def _archive_updates(self, agent, updates):
-        """Attempt to archive workbooks from WorkbookUpdate rows."""
-
-        session = meta.Session()
-
-        count = 0
-        data = {}
-        logger.debug("Workbook archive update count: %d\n", len(updates))
-        for update in updates:
-            if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
-                logger.info(
-                          "Workbook Archive disabled during fixup." + \
-                          "  Exiting for now.")
-                break
-
-            if not self.server.odbc_ok():
-                logger.info("Workbook Archive Fixup: Archive build " + \
-                          "stopping due to current state")
-                break
-
-            logger.debug("Workbook archive update refresh wid %d",
-                           update.workbookid)
-            session.refresh(update)
-            try:
-                self._archive_wb(agent, update)
-            except ArchiveException as ex:
-                if ex.value == ArchiveError.BAD_CREDENTIALS:
-                    msg = "workbook _archive_updates: tabcmd failed due to " + \
-                          "bad credentials. " + \
-                          "Skipping any remaining workbook updates now."
-                    logger.info(msg)
-                    data[u'error'] = msg
-                    break
-                else:
-                    raise # should never happen
-            count += 1
-
-        # Retain only configured number of versions
-        if count:
-            retain_removed_count = self._retain_some()
-        else:
-            retain_removed_count = 0
-
-        data[u'updates-archived'] = count
-        data[u'retain-removed-count'] = retain_removed_count
-        return data
-
-    def _archive_wb(self, agent, update):
+        rows = session.query(WorkbookUpdateEntry.wuid).\
+               filter(or_(WorkbookUpdateEntry.url == "",
+                      WorkbookUpdateEntry.url == None)).\
+                      all()
+
+        return self._queue_updates([row[0] for row in rows])
+
+    def _queue_updates(self, wuids):
+        """Queue WorkbookUpdate rows for the archive workers."""
+        count = self.server.archive_queue.add(self.NAME, wuids)
+        logger.debug("Workbook archive update count: %d, newly queued: %d",
+                     len(wuids), count)
+        return {u'updates-queued': count}
+
+    def archive_enabled(self, kind):
+        # pylint: disable=unused-argument
+        """Called by the ArchiveQueue before starting an update."""
+        if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
+            return False
+        return bool(self.cred_check())
+
+    def archive_item(self, agent, job):
+        """Archive one WorkbookUpdate row for the ArchiveQueue.
+           Returns True when the update is archived or no longer exists
+           and False if it should be tried again."""
+        update = WorkbookUpdateEntry.get_by_id(job.itemid, default=None)
+        if update is None or update.url:
+            return True
+
+        logger.debug("Workbook archive update wid %d", update.workbookid)
+        self._archive_wb(agent, update, job)
+
+        # The row is removed if the workbook was deleted from Tableau.
+        update = WorkbookUpdateEntry.get_by_id(job.itemid, default=None)
+        return update is None or bool(update.url)
+
+    def archive_retain(self, kind):
+        # pylint: disable=unused-argument
+        """Retain only configured number of versions."""
+        return self._retain_some()
+
+    def _archive_wb(self, agent, update, job):
         """
             Retrieve the twb/twbx file of an update and set the url.
         """
@@ -471,7 +506,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         repository_url = update.workbook.repository_url
         revision = update.revision
 
-        filename = self._build_twb(agent, update)
+        filename = self._build_twb(agent, update, job)
         if not filename:
             logger.error('Failed to retrieve twb: %s %s', repository_url,
                                                             revision)
@@ -482,10 +517,11 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         # retrieval is a long process, so commit after each.
         meta.Session.commit()
 
-    def _build_twb(self, agent, update):
+    def _build_twb(self, agent, update, job):
         # pylint: disable=too-many-return-statements
         # pylint: disable=too-many-branches
-        """Returns the filename *on the agent* or None on error."""
+        """Returns the filename *on the agent* or None on error.
+           job.stage is updated as each step starts."""
 
         try:
             # fixme: Specify a minimum disk space required other than 0?
@@ -496,6 +532,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
             return None
 
         tmpdir = dcheck.primary_dir
+        job.stage = 'download'
         dst = self._tabcmd_get(agent, update, tmpdir)
         if dst is None:
             # _tabcmd_get generates an event on failure.
@@ -507,6 +544,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
             self._eventgen(update, error=str(ex))
             return None
 
+        job.stage = 'extract'
         if file_type == 'zip':
             dst_twb = self._extract_twb_from_twbx(agent, update, dst)
             if not dst_twb:
@@ -524,9 +562,11 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         # Pull the twb file contents over to the controller before sending the
         # file away (and deleting it on the primary if it will reside
         # elsewhere).
+        job.stage = 'ingest'
         if not self._copy_twb_to_controller(agent, update, dst_twb):
             return None
 
+        job.stage = 'place'
         place = self.archive_file(agent, dcheck, dst_twb)
         update.fileid = place.placed_file_entry.fileid
 
@@ -549,7 +589,8 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
             logger.debug("Error getting workbook '%s': %s", dst_twb, str(ex))
             return None
 
-        update.twb = contents
+        WorkbookUpdateEntry.store.put(update.wuid, update.workbookid,
+                                      contents)
         return True
 
     def _tabcmd_get(self, agent, update, tmpdir):
@@ -106,6 +106,12 @@ class YmlEntry(meta.Base, BaseMixin, BaseDictMixin):
 
 class YmlManager(Manager):
 
+    def __init__(self, server):
+        super(YmlManager, self).__init__(server)
+        # Incremented after every sync so that values derived from the
+        # yml (e.g. the ODBC connection string) can be cached until then.
+        self.generation = 0
+
     def get(self, key, **kwargs):
         return YmlEntry.get(self.envid, key, **kwargs)
 
@@ -122,6 +128,7 @@ class YmlManager(Manager):
         timestamp = datetime.now().strftime(DATEFMT)
         contents = agent.filemanager.get(path)
         body = YmlEntry.sync(self.envid, contents)
+        self.generation += 1
         self.system.save(SystemKeys.YML_LOCATION, location)
         self.system.save(SystemKeys.YML_TIMESTAMP, timestamp)
         return body
@@ -1 +1,5 @@
 from test_agent import AgentTest
+from test_bulk_sync import BulkSyncTest
+from test_cloud_upload import MultipartUploadTest
+from test_http_control import PatternListTest
+from test_revision_store import RevisionDeltaTest, RevisionStoreTest
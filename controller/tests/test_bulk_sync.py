@@ -0,0 +1,72 @@
+import unittest
+from datetime import datetime
+
+from controller.mixin import BulkSync
+from controller.projects import Project
+
+class RecordingSync(BulkSync):
+    """BulkSync with the SQL replaced by lists of the rows it would
+       insert, update and delete."""
+
+    def __init__(self, existing):
+        super(RecordingSync, self).__init__(Project, 1, ['id'])
+        self.existing = existing
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+
+    def _insert(self, rows, defaults):
+        for row in rows:
+            self.pks[self.key(row)] = 100 + len(self.inserts)
+            self.inserts.append(row)
+
+    def _update(self, rows, columns):
+        self.updates.extend(rows)
+
+    def _delete(self, pks):
+        self.deletes.extend(pks)
+
+
+class BulkSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.existing = {
+            (5,): {'projectid': 1, 'envid': 1, 'id': 5, 'name': 'Default',
+                   'updated_at': datetime(2015, 6, 1, 12, 30, 15)},
+            (6,): {'projectid': 2, 'envid': 1, 'id': 6, 'name': 'Sales',
+                   'updated_at': datetime(2015, 6, 2, 8, 0, 0)}
+        }
+
+    def test_unchanged_timestamp_string(self):
+        # Raw ODBC rows have the timestamps as strings.
+        sync = RecordingSync(self.existing)
+        sync.run([{'id': 5, 'name': 'Default',
+                   'updated_at': '2015-06-01 12:30:15Z'}])
+        self.assertEqual(sync.updates, [])
+        self.assertEqual(sync.inserts, [])
+        self.assertEqual(sync.unchanged, 1)
+        self.assertEqual(sync.pks[(5,)], 1)
+
+    def test_changed(self):
+        sync = RecordingSync(self.existing)
+        sync.run([{'id': 5, 'name': 'Default',
+                   'updated_at': '2015-06-03 09:00:00Z'},
+                  {'id': 6, 'name': 'Marketing',
+                   'updated_at': datetime(2015, 6, 2, 8, 0, 0)}])
+        self.assertEqual(len(sync.updates), 2)
+        self.assertEqual(sync.updates[0]['updated_at'],
+                         datetime(2015, 6, 3, 9, 0, 0))
+        self.assertEqual(sync.updates[1]['projectid'], 2)
+        self.assertEqual(sync.unchanged, 0)
+
+    def test_insert_and_delete(self):
+        sync = RecordingSync(self.existing)
+        sync.run([{'id': 5, 'name': 'Default',
+                   'updated_at': datetime(2015, 6, 1, 12, 30, 15)},
+                  {'id': 7, 'name': 'New',
+                   'updated_at': '2015-06-04 10:00:00Z'}], delete=True)
+        self.assertEqual([row['id'] for row in sync.inserts], [7])
+        self.assertEqual(sync.inserts[0]['envid'], 1)
+        self.assertEqual(sync.pks[(7,)], 100)
+        self.assertEqual(sync.deletes, [2])
+        self.assertEqual(sync.unchanged, 1)
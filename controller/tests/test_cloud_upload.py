@@ -0,0 +1,190 @@
+import hashlib
+import posixpath
+import unittest
+
+from controller.cloud_upload import MultipartUpload
+
+MB = 1024 * 1024
+
+class StubConfig(object):
+
+    def __init__(self, values):
+        self.values = values
+
+    def getint(self, section, name, default=None):
+        return self.values.get(name, default)
+
+class StubFileManager(object):
+    """The agent side: the file is a string."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def filesize(self, path):
+        return {'size': len(self.data)}
+
+    def read(self, path, offset, length):
+        return self.data[offset:offset + length]
+
+    def checksums(self, path, ranges):
+        return {'checksums': [hashlib.md5(self.read(path, offset,
+                                                    length)).hexdigest() \
+                              for offset, length in ranges]}
+
+class StubPart(object):
+
+    def __init__(self, part_number, etag):
+        self.part_number = part_number
+        self.etag = '"' + etag + '"'
+
+class StubBucket(object):
+    """The S3 side of one multipart upload."""
+
+    def __init__(self):
+        self.id = 'upload-1'
+        self.parts = {}         # part number -> md5 hexdigest
+        self.uploads = []       # part numbers in the order received
+        self.lose = set()       # part numbers to drop once
+        self.fail = False
+        self.completed = None
+        self.cancelled = False
+
+    def initiate_multipart_upload(self, key_name):
+        return self
+
+    def complete_multipart_upload(self, key_name, upload_id, xml):
+        self.completed = xml
+
+class StubMultipart(object):
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        data = fp.read()
+        if self.bucket.fail:
+            raise IOError('connection reset')
+        assert md5[0] == hashlib.md5(data).hexdigest()
+        assert size == len(data)
+        self.bucket.uploads.append(part_num)
+        if part_num in self.bucket.lose:
+            self.bucket.lose.remove(part_num)
+            return
+        self.bucket.parts[part_num] = md5[0]
+
+    def cancel_upload(self):
+        self.bucket.cancelled = True
+
+    def __iter__(self):
+        for part_num in sorted(self.bucket.parts):
+            yield StubPart(part_num, self.bucket.parts[part_num])
+
+class StubUpload(MultipartUpload):
+
+    MIN_PART_SIZE = MB
+
+    def _bucket(self):
+        return self.server.bucket
+
+    def _multipart(self):
+        return StubMultipart(self.server.bucket)
+
+class Stub(object):
+    pass
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Stub()
+        self.server.cloud = Stub()
+        self.server.cloud.s3 = None
+        self.server.config = StubConfig({'cloud_part_size': 1,
+                                         'cloud_upload_workers': 2,
+                                         'cloud_part_retries': 0})
+        self.server.bucket = StubBucket()
+        self.agent = Stub()
+        self.agent.path = posixpath
+        self.agent.filemanager = StubFileManager(self.contents(3 * MB + 100))
+        self.entry = Stub()
+        self.entry.bucket = 'bucket'
+
+    def contents(self, size, seed='a'):
+        data = ''
+        block = 0
+        while len(data) < size:
+            data += hashlib.sha256(seed + str(block)).digest() * 1024
+            block += 1
+        return data[:size]
+
+    def upload(self):
+        upload = StubUpload(self.server, self.agent, self.entry,
+                            '/backups/x.tsbak')
+        upload.start(follow=False)
+        return upload
+
+    def check_completed(self, nparts):
+        data = self.agent.filemanager.data
+        etags = [hashlib.md5(data[i * MB:(i + 1) * MB]).hexdigest() \
+                 for i in range(nparts)]
+        xml = self.server.bucket.completed
+        self.assertTrue(xml is not None)
+        self.assertEqual(xml.count('<Part>'), nparts)
+        for partnum, etag in enumerate(etags):
+            self.assertTrue(('<PartNumber>%d</PartNumber>' + \
+                             '<ETag>"%s"</ETag>') % (partnum + 1, etag) in xml)
+
+    def test_complete(self):
+        upload = self.upload()
+        body = upload.finish()
+        self.assertEqual(body['status'], 'OK')
+        self.assertEqual(body['parts'], 4)
+        self.assertEqual(body['early-parts'], 0)
+        self.assertEqual(sorted(self.server.bucket.uploads), [1, 2, 3, 4])
+        self.check_completed(4)
+        # Nothing to abort once complete.
+        upload.cancel()
+        self.assertFalse(self.server.bucket.cancelled)
+
+    def test_early_parts(self):
+        upload = self.upload()
+        # Parts sent while the backup is written...
+        upload._read_parts(len(self.agent.filemanager.data))
+        upload.queue.join()
+        self.assertEqual(sorted(self.server.bucket.uploads), [1, 2, 3])
+        # ...then part 2 is rewritten and the file grows.
+        data = self.agent.filemanager.data
+        data = data[:MB] + self.contents(MB, seed='b') + data[2 * MB:] + \
+               self.contents(MB, seed='c')
+        self.agent.filemanager.data = data
+
+        body = upload.finish()
+        self.assertEqual(body['status'], 'OK')
+        self.assertEqual(body['parts'], 5)
+        self.assertEqual(body['early-parts'], 2)
+        self.assertEqual(sorted(self.server.bucket.uploads),
+                         [1, 2, 2, 3, 4, 5])
+        self.check_completed(5)
+
+    def test_resume(self):
+        # S3 doesn't list part 3: it is sent again before completing.
+        self.server.bucket.lose.add(3)
+        upload = self.upload()
+        body = upload.finish()
+        self.assertEqual(body['status'], 'OK')
+        self.assertEqual(sorted(self.server.bucket.uploads), [1, 2, 3, 3, 4])
+        self.assertEqual(self.server.bucket.uploads[-1], 3)
+        self.check_completed(4)
+
+    def test_failed_part(self):
+        self.server.bucket.fail = True
+        upload = self.upload()
+        body = upload.finish()
+        self.assertTrue('error' in body)
+        self.assertTrue(self.server.bucket.cancelled)
+        self.assertTrue(self.server.bucket.completed is None)
+
+    def test_cancel(self):
+        upload = self.upload()
+        upload.cancel()
+        self.assertTrue(self.server.bucket.cancelled)
+        self.assertEqual(upload.threads, [])
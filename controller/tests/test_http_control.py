@@ -0,0 +1,50 @@
+import unittest
+
+from controller.http_control import HttpControl, PatternList
+from controller.http_control import list_re, match_re
+
+class PatternListTest(unittest.TestCase):
+
+    URLS = ['/views/Sales/Overview.png',
+            '/views/Sales/Overview?format=pdf',
+            '/views/Sales/Overview',
+            '/VIEWS/sales/overview',
+            '/vizql/w/Sales/v/Overview/bootstrapSession',
+            '/t/site/views/a/a',
+            '/t/site/views/a/b',
+            '/favicon.ico',
+            '']
+
+    def check(self, arg):
+        patterns = list_re(arg)
+        patterns_list = PatternList(arg)
+        self.assertEqual(len(patterns_list), len(patterns))
+        for url in self.URLS:
+            self.assertEqual(patterns_list.match(url),
+                             match_re(patterns, url), url)
+
+    def test_single(self):
+        self.check(HttpControl.exclude_str)
+
+    def test_combined(self):
+        self.check(HttpControl.exclude_str + ' /vizql/.* ,/favicon\\.ico')
+
+    def test_inline_flags(self):
+        # (?i) only applies to its own pattern.
+        arg = '(?i)/vizql/.* /views/Sales/Overview'
+        self.check(arg)
+        self.assertTrue(PatternList(arg).match('/VIZQL/w/Sales'))
+        self.assertFalse(PatternList(arg).match('/VIEWS/sales/overview'))
+        self.check('/views/sales/.* /t/site/.*')
+
+    def test_backreference(self):
+        self.check(r'/t/site/views/(\w+)/\1 /vizql/.*')
+
+    def test_many_groups(self):
+        arg = ' '.join(['/g%d/(a)(b)(c)' % i for i in range(50)] + \
+                       ['/views/(Sales)/.*'])
+        self.check(arg)
+        self.assertTrue(PatternList(arg).match('/g49/abc'))
+
+    def test_empty(self):
+        self.check('')
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from controller.revision_store import RevisionStore
+
+import akiri.framework.sqlalchemy as meta
+
+TWB = u"""<?xml version='1.0' encoding='utf-8' ?>
+<workbook version='8.3'>
+  <datasources>
+    <datasource name='Sales' version='8.3'>
+      <connection class='postgres' dbname='sales' server='db1' />
+    </datasource>
+  </datasources>
+  <worksheets>
+    <worksheet name='Overview'>
+      <table />
+    </worksheet>
+  </worksheets>
+</workbook>
+"""
+
+class RevisionDeltaTest(unittest.TestCase):
+
+    def check(self, base, contents):
+        ops = RevisionStore._delta(base, contents)
+        self.assertEqual(RevisionStore._apply(base, ops), contents)
+        return ops
+
+    def test_changed_line(self):
+        ops = self.check(TWB, TWB.replace("server='db1'", "server='db2'"))
+        # Only the changed line is stored as text.
+        self.assertEqual([op for op in ops if not isinstance(op, list)],
+                         [u"      <connection class='postgres' " + \
+                          u"dbname='sales' server='db2' />\n"])
+
+    def test_insert_and_delete(self):
+        contents = TWB.replace(u"    <worksheet name='Overview'>\n",
+                               u"    <worksheet name='Détail'>\n" + \
+                               u"      <table />\n" + \
+                               u"    </worksheet>\n" + \
+                               u"    <worksheet name='Overview'>\n")
+        self.check(TWB, contents)
+        self.check(contents, TWB)
+        self.check(TWB, u'\n'.join(TWB.splitlines()[2:]))
+
+    def test_no_final_newline(self):
+        self.check(TWB, TWB.rstrip())
+        self.check(TWB.rstrip(), TWB)
+
+    def test_empty(self):
+        self.check(u'', TWB)
+        self.check(TWB, u'')
+
+
+class RevisionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = meta.create_engine('sqlite://', echo=False)
+        self.session = meta.Session()
+        self.store = RevisionStore('workbook', 'workbook_updates', 'wuid')
+
+    def tearDown(self):
+        meta.sqa.dispose_session()
+        meta.sqa.engine.dispose()
+        meta.sqa.engine = None
+
+    def test_delta_chain(self):
+        contents = TWB
+        for updateid in range(1, 5):
+            contents = contents.replace("version='8.%d'" % (updateid + 2),
+                                        "version='8.%d'" % (updateid + 3))
+            self.store.put(updateid, 7, contents)
+        self.session.commit()
+        self.store.cache = type(self.store.cache)(RevisionStore.CACHE_SIZE)
+        self.assertEqual(self.store.get(4), contents)
+
+    def test_cached_after_commit(self):
+        self.store.put(1, 7, TWB)
+        self.assertEqual(self.store.get(1), TWB)
+        self.assertIsNone(self.store.cache.get(1))
+        self.session.commit()
+        self.assertEqual(self.store.cache.get(1), TWB)
+
+    def test_not_cached_after_rollback(self):
+        self.store.put(1, 7, TWB)
+        self.session.rollback()
+        self.assertIsNone(self.store.cache.get(1))
+        self.assertIsNone(self.store.get(1))
+
+    def test_remove(self):
+        self.store.put(1, 7, TWB)
+        self.store.put(2, 7, TWB + u'<!-- 2 -->\n')
+        self.session.commit()
+        self.store.remove([1])
+        self.session.commit()
+        self.assertIsNone(self.store.get(1))
+        self.assertEqual(self.store.get(2), TWB + u'<!-- 2 -->\n')